@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Offline discovery of the spelling variants of the organisation names.
+The output csv (alias, canonical, similarity) should be reviewed before being passed to
+FileNormalisation (aliases=load_alias_table(...)).
+
+usage : python aliases.py file1.parquet file2.parquet --threshold .6 --out aliases.csv
+"""
+
+import argparse
+import pandas as pd
+from time import time
+
+from bb8TSA.FilesPrepration.filesPrepModules import extract_file_list, FileNormalisation
+from bb8TSA.FilesPrepration.aliasModules import name_counts, find_alias_clusters, alias_table
+
+pd.set_option('display.max_rows', 1000)
+
+t0 = time()
+if __name__=="__main__" :
+
+    parser = argparse.ArgumentParser(description="Spelling variants of the organisation names.")
+    parser.add_argument("files", nargs="+", help="input parquet files")
+    parser.add_argument("--threshold", type=float, default=.6, help="minimum estimated similarity")
+    parser.add_argument("--out", default=None, help="output csv file")
+    args = parser.parse_args()
+
+    file_list = extract_file_list( args.files )
+    fn = FileNormalisation( file_list, prefetch=2 )
+    counts = name_counts( fn.iter_Normal_DFs() )
+
+    df_clusters = find_alias_clusters( counts, threshold=args.threshold )
+    df_aliases = alias_table( df_clusters )
+
+    if args.out is None :
+        print( "aliases : candidate merges : \n", df_clusters )
+    else :
+        df_aliases.to_csv( args.out, index=False )
+
+    print( "Time elapsed : ", round( time()-t0, 1 ), "s" )
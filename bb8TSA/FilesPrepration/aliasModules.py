@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Discovery of the spelling variants of the organisation names ("giletsjaune" / "giletsjaunes")
+through MinHash signatures of character n-grams and LSH banding.
+"""
+from zlib import crc32
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def name_counts(DFs, nameCol="name"):
+    """
+    :param DFs: list of normalised dataframes (FileNormalisation.get_Normal_DFs)
+    :param nameCol: str
+    :return: series of the number of mentions per name
+    """
+    counts = [df[nameCol].value_counts() for df in DFs]
+    return pd.concat(counts).groupby(level=0).sum().sort_values(ascending=False)
+
+
+def minhash_signatures(names, ngram=3, numPerm=128, seed=0, maxElements=2.e7):
+    """ MinHash signatures of the character n-gram sets of the names.
+        The names are padded with '^' and '$' so that prefixes and suffixes count.
+        Each permutation is a multiply-shift hash of the 32 bits n-gram hash.
+
+    Parameters
+    ----------
+    names : list of str
+    ngram : int
+        n-gram length
+    numPerm : int
+        number of hash functions (signature length)
+    seed : int
+    maxElements : float
+        maximum number of (n-gram, hash function) values kept in memory at once
+
+    Return
+    ----------
+    Array (len(names), numPerm) of uint32
+    """
+    print("minhash_signatures : Hashing the", ngram, "-grams of", len(names), "names ...")
+    shingles, owners = [], []
+    for i, name in enumerate(names):
+        padded = "^" + name + "$"
+        grams = {crc32(padded[k:k + ngram].encode("utf-8")) for k in range(max(len(padded) - ngram + 1, 1))}
+        shingles.extend(grams)
+        owners.extend([i] * len(grams))
+    shingles = np.array(shingles, dtype=np.uint64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(owners, minlength=len(names)))])
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 63, size=numPerm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 2 ** 63, size=numPerm, dtype=np.uint64)
+
+    print("    Computing the", numPerm, "minimum hashes per name ...")
+    signatures = np.empty((len(names), numPerm), dtype=np.uint32)
+    step = max(int(maxElements // numPerm), 1)
+    start = 0
+    while start < len(names):
+        # block of names whose n-grams fit in maxElements
+        end = max(int(np.searchsorted(offsets, offsets[start] + step, side="right")) - 1, start + 1)
+        end = min(end, len(names))
+        block = shingles[offsets[start]:offsets[end], None]
+        hashes = ((a[None, :] * block + b[None, :]) >> np.uint64(32)).astype(np.uint32)
+        signatures[start:end] = np.minimum.reduceat(hashes, offsets[start:end] - offsets[start], axis=0)
+        start = end
+    return signatures
+
+
+def lsh_candidate_pairs(signatures, bands=32, maxBucket=200):
+    """ Pairs of names sharing at least one band of their signatures.
+        With r = numPerm / bands rows per band, a pair of similarity s is a candidate with
+        probability 1 - (1 - s^r)^bands.
+
+    Parameters
+    ----------
+    signatures : array (nNames, numPerm)
+    bands : int
+        number of bands (should divide numPerm)
+    maxBucket : int
+        buckets larger than maxBucket (very common n-gram patterns) are skipped
+
+    Return
+    ----------
+    Array (nPairs, 2) of name indexes with i < j
+    """
+    nNames, numPerm = signatures.shape
+    rows = numPerm // bands
+    print("lsh_candidate_pairs :", bands, "bands of", rows, "rows.")
+    pairs = []
+    for band in range(bands):
+        keys = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        _, bucket = np.unique(keys.view(np.dtype((np.void, keys.dtype.itemsize * rows))).ravel(),
+                              return_inverse=True)
+        order = np.argsort(bucket, kind="mergesort")
+        sizes = np.bincount(bucket)
+        starts = np.concatenate([[0], np.cumsum(sizes)])
+        for k in np.nonzero((sizes > 1) & (sizes <= maxBucket))[0]:
+            members = order[starts[k]:starts[k + 1]]
+            i, j = np.triu_indices(len(members), 1)
+            pairs.append(np.stack([members[i], members[j]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def find_alias_clusters(counts, threshold=.6, ngram=3, numPerm=128, bands=32, minLength=4, seed=0):
+    """ Clusters of organisation names which are probably spelling variants of each other.
+
+    Parameters
+    ----------
+    counts : series
+        number of mentions per normalised name (name_counts)
+    threshold : float
+        minimum estimated Jaccard similarity of the n-gram sets to link two names
+    ngram, numPerm, bands, seed :
+        MinHash and LSH parameters (see minhash_signatures and lsh_candidate_pairs)
+    minLength : int
+        shorter names (acronyms) are left out
+
+    Return
+    ----------
+    Dataframe (cluster, organName, count, canonical, similarity) : the canonical name of a
+    cluster is its most cited name, similarity is the estimated similarity to the canonical name.
+    """
+    print("find_alias_clusters : Searching the spelling variants, similarity threshold :", threshold)
+    counts = counts[counts.index.str.len() >= minLength]
+    names = counts.index.values
+    signatures = minhash_signatures(names, ngram=ngram, numPerm=numPerm, seed=seed)
+    pairs = lsh_candidate_pairs(signatures, bands=bands)
+
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+    pairs = pairs[similarity >= threshold]
+    print("    Candidate pairs :", len(similarity), ", linked pairs :", len(pairs))
+
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(names), len(names)))
+    _, cluster = connected_components(graph, directed=False)
+    sizes = np.bincount(cluster)
+    inCluster = sizes[cluster] > 1
+
+    idx = np.nonzero(inCluster)[0]
+    df = pd.DataFrame({"cluster": cluster[idx], "organName": names[idx], "count": counts.values[idx]})
+    # counts are sorted : the first name of each cluster is the most cited one
+    canonicalIdx = pd.Series(idx).groupby(df["cluster"]).transform("first").values
+    df["canonical"] = names[canonicalIdx]
+    df["similarity"] = (signatures[idx] == signatures[canonicalIdx]).mean(axis=1)
+
+    print("    Returning", df["cluster"].nunique(), "clusters ...")
+    return df.sort_values(["count"], ascending=False) \
+        .sort_values(["cluster"], kind="mergesort") \
+        .reset_index(drop=True)
+
+
+def alias_table(df_clusters, minSimilarity=0.):
+    """ Canonicalisation entries of the non canonical names of the clusters.
+
+    :param df_clusters: dataframe (find_alias_clusters)
+    :param minSimilarity: float
+    :return: dataframe (alias, canonical, similarity) to be reviewed and passed to
+        FileNormalisation through filesPrepModules.load_alias_table
+    """
+    df = df_clusters[(df_clusters["organName"] != df_clusters["canonical"]) &
+                     (df_clusters["similarity"] >= minSimilarity)]
+    return df.rename(columns={"organName": "alias"})[["alias", "canonical", "similarity"]]
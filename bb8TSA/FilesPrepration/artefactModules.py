@@ -0,0 +1,80 @@
+import hashlib
+from os import path, makedirs, replace
+
+# pyarrow is imported by the functions using it (see the import time benchmark test/importtime.py)
+
+
+def artefact_path(artefactDir, stage, fname, *params):
+    """ Name of the file keeping the output of a pipeline stage for a given data file.
+        The name ends with a hash of the absolute path of the data file : files with the same
+        name in different directories get different artefacts.
+
+    :param artefactDir: str
+        directory of the artefacts.
+    :param stage: str
+        name of the stage {"normal", "binned", "clean"}.
+    :param fname: str
+        data file name (or label) the dataframe comes from.
+    :param params: parameters the stage output depends on (freq, minNumBins, ...).
+    :return: str
+    """
+    base = path.splitext(path.basename(str(fname)))[0]
+    digest = hashlib.blake2b(path.abspath(str(fname)).encode(), digest_size=6).hexdigest()
+    name = "_".join([stage] + [str(p) for p in params] + [base, digest])
+    return path.join(artefactDir, name + ".arrow")
+
+
+def write_artefact(df, fpath):
+    """ Writes a dataframe as an uncompressed Arrow IPC (Feather v2) file.
+        Uncompressed buffers can be memory mapped and read back without copies.
+        The file is written under a temporary name and then renamed, so readers never see
+        a partially written artefact.
+
+    :param df: dataframe (or pyarrow Table)
+    :param fpath: str
+        artefact file name (see artefact_path)
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    print("write_artefact : Writing", fpath, "...")
+    makedirs(path.dirname(fpath) or ".", exist_ok=True)
+    tmp = fpath + ".tmp"
+    feather.write_feather(df if isinstance(df, pa.Table) else df.reset_index(drop=True), tmp,
+                          compression="uncompressed")
+    replace(tmp, fpath)
+
+
+def read_artefact(fpath, asTable=False):
+    """ Opens an artefact with memory mapping.
+        The numerical and date columns of the returned dataframe point directly to the mapped
+        file (no copy), only the string columns are materialised.
+
+    :param fpath: str
+        artefact file name (see artefact_path)
+    :param asTable: boolean
+        True to return the pyarrow Table instead of a dataframe.
+    :return: dataframe (or pyarrow Table)
+    """
+    import pyarrow as pa
+
+    print("read_artefact : Memory mapping", fpath, "...")
+    table = pa.ipc.open_file(pa.memory_map(fpath, "r")).read_all()
+    if asTable:
+        return table
+    return table.to_pandas(split_blocks=True)
+
+
+def is_fresh_artefact(fpath, sourceFile=None):
+    """
+    :param fpath: str
+        artefact file name
+    :param sourceFile: str, optional
+        file the artefact has been computed from.
+    :return: True if the artefact exists and is not older than its source file.
+    """
+    if not path.isfile(fpath):
+        return False
+    if sourceFile is None or not path.isfile(sourceFile):
+        return True
+    return path.getmtime(fpath) >= path.getmtime(sourceFile)
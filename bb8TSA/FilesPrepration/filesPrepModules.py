@@ -1,8 +1,14 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 from os import path
 import sys
 
 import pandas as pd
 
+from bb8TSA.FilesPrepration.artefactModules import artefact_path, write_artefact, read_artefact, \
+    is_fresh_artefact
+
 
 def extract_file_list(fileList, minDays=89, memSeuil=5.):
     """ Parses the input data files from the console and verify if they are the right files
@@ -78,6 +84,182 @@ def extract_file_list(fileList, minDays=89, memSeuil=5.):
 
 ##################################################################################
 
+# Canonicalisation table : normalised name -> name of the organisation
+organAliases = {"bpi": "bpifrance",
+                "uniondesmétiersetdesindustriesdelhôtellerie": "umih",
+                "covid": "covid19", "corona": "covid19", "coronavirus": "covid19",
+                "giletsjaune": "giletsjaunes",
+                "organisationmondialedelasanté": "oms",
+                "unioneuropéenne": "ue"}
+
+
+def load_alias_table(fpath):
+    """ Reads a canonicalisation table written as a csv file with the columns alias and canonical
+    (see aliasModules.find_alias_clusters).
+
+    :param fpath: str
+    :return: dict alias -> canonical name
+    """
+    df = pd.read_csv(fpath, usecols=["alias", "canonical"])
+    return dict(zip(df["alias"], df["canonical"]))
+
+
+def canonical_name(name, aliases):
+    """ Normalised name of an organisation, as FileNormalisation.make_normal : lower case,
+    alphanumerics only, then the canonicalisation table.
+
+    :param name: str
+        raw name
+    :param aliases: dict
+    :return: str
+    """
+    name = "".join(filter(str.isalnum, name.lower()))
+    return aliases.get(name, name)
+
+
+def date_window(start=None, end=None):
+    """
+    :param start: str or date, optional
+        first day included
+    :param end: str or date, optional
+        last day included
+    :return: (start, stop) timestamps of the half open window [start, stop), None when open
+    """
+    start = pd.Timestamp(start).normalize() if start is not None else None
+    stop = pd.Timestamp(end).normalize() + pd.Timedelta(days=1) if end is not None else None
+    return start, stop
+
+
+def select_rows(df, start=None, end=None, organisations=None, nameCol="name", dateCol="date"):
+    """ Keeps the rows of a dataframe in a date window and/or of some organisations.
+
+    :param df: dataframe with a datetime date column
+    :param start, end: first and last days included (see date_window)
+    :param organisations: list of str, optional
+        names of the organisations to keep (normalised names)
+    :return: dataframe
+    """
+    start, stop = date_window(start, end)
+    mask = pd.Series(True, index=df.index)
+    if start is not None:
+        mask &= df[dateCol] >= start
+    if stop is not None:
+        mask &= df[dateCol] < stop
+    if organisations is not None:
+        mask &= df[nameCol].isin(organisations)
+    return df if mask.all() else df[mask]
+
+
+def scan_filters(file, start=None, end=None, rawNames=None):
+    """ Filters of a data file scan (pyarrow.parquet.read_table filters) : the row groups whose
+        date statistics are out of the window are skipped, and only the rows of the
+        organisations with the given raw names are materialised.
+        Dates stored as strings are compared as strings, which needs ISO dates
+        (YYYY-MM-DD...) : the date filters are left out otherwise.
+
+    :param file: str
+    :param start, end: first and last days included (see date_window)
+    :param rawNames: list of str, optional
+        raw values of the name column to keep
+    :return: list of filters
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    filters = [("variable", "=", "organisation")]
+    if rawNames is not None:
+        filters.append(("name", "in", set(rawNames)))
+
+    start, stop = date_window(start, end)
+    if start is None and stop is None:
+        return filters
+    dateType = pq.read_schema(file).field("date").type
+    if pa.types.is_timestamp(dateType):
+        bounds = [("date", ">=", start.to_pydatetime()) if start is not None else None,
+                  ("date", "<", stop.to_pydatetime()) if stop is not None else None]
+    else:
+        meta = pq.ParquetFile(file).metadata
+        column = meta.schema.names.index("date")
+        stats = [meta.row_group(i).column(column).statistics for i in range(meta.num_row_groups)]
+        iso = all(st is None or not st.has_min_max or
+                  (_is_iso_date(st.min) and _is_iso_date(st.max)) for st in stats)
+        if not iso:
+            return filters
+        bounds = [("date", ">=", start.strftime("%Y-%m-%d")) if start is not None else None,
+                  ("date", "<", stop.strftime("%Y-%m-%d")) if stop is not None else None]
+    return filters + [bound for bound in bounds if bound is not None]
+
+
+def filter_expression(filters):
+    """ Dataset expression of scan filters (see scan_filters), used to prune and read the
+        sampled row groups.
+
+    :param filters: list of (column, operator, value) with the operators "=", "in", ">=" and "<"
+    :return: pyarrow.dataset Expression
+    """
+    import pyarrow.dataset as ds
+
+    expr = None
+    for col, op, value in filters:
+        field = ds.field(col)
+        term = {"=": lambda: field == value, "in": lambda: field.isin(sorted(value)),
+                ">=": lambda: field >= value, "<": lambda: field < value}[op]()
+        expr = term if expr is None else expr & term
+    return expr
+
+
+def _is_iso_date(value):
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    return len(value) >= 10 and value[4] == "-" and value[7] == "-" and value[:4].isdigit()
+
+##################################################################################
+
+def iter_prefetched_DFs(fileList, prefetch=2, maxWorkers=2, columns=None, reader=pd.read_parquet):
+    """ Reads the data files in a bounded thread pool and yields them in the order of fileList.
+        While the caller processes file N, the reads of the next `prefetch` files are already
+        running (pyarrow releases the GIL while reading parquet files).
+        At most `prefetch` files are read ahead of the caller, which keeps the memory bounded.
+
+    :param fileList: list of str
+        list of data file names
+    :param prefetch: int
+        maximum number of files read ahead of the caller.
+    :param maxWorkers: int
+        number of reading threads.
+    :param columns: list of str, optional
+        columns to read. All columns by default.
+    :param reader: function
+        reader of a data file, called as reader(file, columns=columns).
+        pyarrow.parquet.read_table yields Arrow tables instead of dataframes.
+    :return: generator of (file name, dataframe)
+    """
+    if prefetch < 1:
+        raise ValueError("iter_prefetched_DFs : prefetch should be at least 1")
+
+    files = iter(fileList)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, min(maxWorkers, prefetch))) as pool:
+
+        def submit_next():
+            file = next(files, None)
+            if file is not None:
+                pending.append((file, pool.submit(reader, file, columns=columns)))
+
+        try:
+            for _ in range(prefetch):
+                submit_next()
+            while pending:
+                file, future = pending.popleft()
+                df = future.result()
+                # Back-pressure : a new read starts only when a file is handed to the caller
+                submit_next()
+                yield file, df
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+##################################################################################
+
 class FileNormalisation:
     """ Renrmalising the columns of the input data files
 
@@ -85,19 +267,197 @@ class FileNormalisation:
     ----------
     fileList : list of str
         list of data file names
+    prefetch : int
+        0 by default : all the files are read at the initialisation.
+        Otherwise the files are read lazily, at most `prefetch` files ahead of the normalisation.
+    maxWorkers : int
+        number of reading threads when prefetch > 0.
+    artefactDir : str, optional
+        If given, each normalised dataframe is kept there as an Arrow IPC file and reused
+        (memory mapped) as long as it is not older than its data file.
+        The data files are then read lazily.
+    aliases : dict, optional
+        Additional canonicalisation entries (normalised name -> organisation name) on top of
+        organAliases (see load_alias_table).
+    backend : str
+        "pandas" (default) or "arrow". With "arrow" the files are read and normalised as Arrow
+        tables (see backendModules) and the normalised DFs are Arrow tables.
+    start, end : str or date, optional
+        First and last days to keep. The row groups out of the window are not read
+        (see scan_filters).
+    organisations : list of str, optional
+        Organisations to keep (normalised names). The raw names of the files mapping to them
+        through the canonicalisation table are looked up in the name column dictionary and only
+        their rows are read.
+    sample : float, optional
+        Quick-look mode : fraction of the data read (see sampleMode). The inclusion probability of
+        each file is kept in sampleFractions, to be passed to TimeSeriesAnalysis(sampleFraction=...)
+        which rescales the counts.
+    sampleMode : str
+        "rows" (default) : uniform (Bernoulli) sample of the mention rows, all the file is read.
+        "rowGroups" : uniform sample of the Parquet row groups left by start, end and organisations,
+        only those are read (with the filters). The counts
+        are then only unbiased if the row groups are not ordered by date or by name
+        (files with a single row group are sampled by rows).
+    seed : int
+        seed of the sampling
     """
 
-    def __init__(self, fileList):
+    def __init__(self, fileList, prefetch=0, maxWorkers=2, artefactDir=None, aliases=None, backend="pandas",
+                 start=None, end=None, organisations=None, sample=None, sampleMode="rows", seed=0):
         print("FileNormalisation class initialised.")
         self._fileList = fileList
-        self._DFs = list(map(lambda x: pd.read_parquet(x), fileList))
+        self.prefetch = prefetch
+        self.maxWorkers = maxWorkers
+        self.artefactDir = artefactDir
+        self.backend = backend
+        if backend == "pandas":
+            self._backend = None
+        else:
+            # pyarrow is imported only when another backend is used
+            from bb8TSA.TSA.backendModules import make_backend
+            self._backend = make_backend(backend)
+        self.aliases = dict(organAliases, **aliases) if aliases else organAliases
+        self.start, self.end = start, end
+        self.organisations = list(organisations) if organisations is not None else None
+        self._filtered = start is not None or end is not None or organisations is not None
+        self._reader = self._backend.read if self._backend is not None else pd.read_parquet
+        self._read = self._read_filtered if self._filtered else self._reader
+        if sample is not None:
+            if sampleMode not in ["rows", "rowGroups"]:
+                raise ValueError("sampleMode should be one of : ('rows', 'rowGroups')")
+            if not 0. < sample <= 1.:
+                raise ValueError("sample should be a fraction in ]0, 1]")
+            self._readAll, self._read = self._read, self._read_sampled
+        self.sample, self.sampleMode, self.seed = sample, sampleMode, seed
+        self.sampleFractions = {}
+        # normalised artefacts computed with other aliases or filters are not reused
+        self._artefactParams = [hashlib.md5(repr(sorted(aliases.items())).encode()).hexdigest()[:8]] \
+            if aliases else []
+        if sample is not None:
+            self._artefactParams.append("s" + str(sample) + sampleMode[0] + str(seed))
+        if self._filtered:
+            self._artefactParams.append(hashlib.md5(repr((str(start), str(end), sorted(self.organisations or [])))
+                                                    .encode()).hexdigest()[:8])
+        self._DFs = list(map(lambda x: self._read(x), fileList)) \
+            if prefetch < 1 and artefactDir is None else None
+
+    def raw_names(self, file):
+        """ Raw values of the name column mapping to the selected organisations, found from the
+            distinct values of the column (read dictionary encoded).
+
+        :param file: str
+        :return: list of str
+        """
+        import pyarrow.parquet as pq
+
+        column = pq.read_table(file, columns=["name"], read_dictionary=["name"])["name"]
+        values = set()
+        for chunk in column.chunks:
+            values.update(chunk.dictionary.to_pylist())
+        wanted = set(self.organisations)
+        return sorted(v for v in values if v is not None and canonical_name(v, self.aliases) in wanted)
+
+    def _scan_filters(self, file):
+        """
+        :return: filters of the date window and of the organisation list for a data file (see scan_filters)
+        """
+        rawNames = self.raw_names(file) if self.organisations is not None else None
+        filters = scan_filters(file, start=self.start, end=self.end, rawNames=rawNames)
+        print("file_normalisation : Reading", file, "with the filters", [f[:2] for f in filters],
+              "(" + str(len(rawNames)) + " raw names)" if rawNames is not None else "")
+        return filters
+
+    def _read_filtered(self, file, columns=None):
+        """ Reads a data file with the date window and the organisation list pushed down to the scan.
+        """
+        return self._reader(file, columns=columns, filters=self._scan_filters(file))
+
+    def _row_groups(self, file):
+        """ Row groups of a data file which may hold selected rows : with a date window or an
+            organisation list, the row groups whose statistics contradict the scan filters are left out.
+
+        :param file: str
+        :return: (Parquet file fragment, filter expression or None, list of row group ids)
+        """
+        import pyarrow.dataset as ds
+
+        fragment = next(iter(ds.dataset(file, format="parquet").get_fragments()))
+        expr = filter_expression(self._scan_filters(file)) if self._filtered else None
+        groups = fragment.subset(filter=expr) if expr is not None else fragment
+        return fragment, expr, [rowGroup.id for rowGroup in groups.row_groups]
+
+    def _group_fraction(self, nGroups):
+        # whole row groups are sampled : the fraction is rounded to a number of groups
+        return max(1, int(round(self.sample * nGroups))) / nGroups
+
+    def sample_fraction(self, file):
+        """
+        :param file: str
+        :return: inclusion probability of the rows of a data file in the quick-look mode
+            (1 without sampling)
+        """
+        if self.sample is None:
+            return 1.
+        if self.sampleMode == "rowGroups":
+            nGroups = len(self._row_groups(file)[2])
+            if nGroups > 1:
+                return self._group_fraction(nGroups)
+        return self.sample
+
+    def _read_sampled(self, file, columns=None):
+        """ Reads a uniform sample of a data file (quick-look mode, see sample) and records its
+            inclusion probability in sampleFractions.
+            The row groups are sampled among those left by the scan filters, and read with them.
+        """
+        import numpy as np
+
+        # one reproducible stream per file
+        rng = np.random.default_rng([self.seed, int(hashlib.md5(str(file).encode()).hexdigest()[:8], 16)])
+        if self.sampleMode == "rowGroups":
+            fragment, expr, groups = self._row_groups(file)
+            nGroups = len(groups)
+            if nGroups > 1:
+                self.sampleFractions[file] = self._group_fraction(nGroups)
+                k = int(round(self.sampleFractions[file] * nGroups))
+                chosen = np.sort(rng.choice(groups, size=k, replace=False))
+                print("file_normalisation : Reading", k, "row groups out of", nGroups, "of", file)
+                table = fragment.subset(row_group_ids=chosen.tolist()).to_table(columns=columns, filter=expr)
+                return table if self._backend is not None else table.to_pandas()
+            print("file_normalisation :", nGroups, "row group(s) to read in", file, ": sampling the rows.")
+        self.sampleFractions[file] = self.sample
+
+        df = self._readAll(file, columns=columns)
+        keep = rng.random(df.num_rows if self._backend is not None else len(df)) < self.sample
+        print("file_normalisation : Keeping", int(keep.sum()), "rows of", file, "(sample", self.sample, ")")
+        if self._backend is not None:
+            import pyarrow as pa
+            return df.filter(pa.array(keep))
+        return df[keep]
 
     def get_initial_DFs(self):
         """
         :return: list of dataframes read from the data files
         """
+        if self._DFs is None:
+            self._DFs = [df for _, df in self.iter_initial_DFs()]
         return self._DFs
 
+    def iter_initial_DFs(self, fileList=None):
+        """
+        :param fileList: list of str, optional
+            subset of the data files to read. All files by default.
+        :return: generator of (file name, dataframe) read from the data files
+        """
+        fileList = self._fileList if fileList is None else fileList
+        if self._DFs is not None:
+            DFs = dict(zip(self._fileList, self._DFs))
+            return ((file, DFs[file]) for file in fileList)
+        if self.prefetch < 1:
+            return ((file, self._read(file)) for file in fileList)
+        return iter_prefetched_DFs(fileList, prefetch=self.prefetch, maxWorkers=self.maxWorkers,
+                                   reader=self._read)
+
     def make_normal(self, df, fname):
         """ Some renormalisation steps :
         # --Converting date type from string to datetime.
@@ -113,37 +473,68 @@ class FileNormalisation:
         """
         print("file_normalisation : make_normal : Normalising", fname, "...")
 
-        df = df[df["variable"] == "organisation"].copy()
+        if self._backend is not None:
+            df = self._backend.make_normal(df, self.aliases)
+            if self._filtered:
+                df = self._backend.select_rows(df, self.start, self.end, self.organisations)
+        else:
+            df = df[df["variable"] == "organisation"].copy()
+
+            df["name"] = df["name"].apply(lambda x: x.lower()) \
+                .apply(lambda x: "".join(filter(str.isalnum, x)))
 
-        df["name"] = df["name"].apply(lambda x: x.lower()) \
-            .apply(lambda x: "".join(filter(str.isalnum, x)))
+            df["name"] = df["name"].map(self.aliases).fillna(df["name"])
 
-        df.loc[df.name == "bpi", "name"] = "bpifrance"
-        df.loc[df.name == "uniondesmétiersetdesindustriesdelhôtellerie", "name"] = "umih"
-        df.loc[df.name.isin(["covid", "corona", "coronavirus"]), "name"] = "covid19"
-        df.loc[df.name == "giletsjaune", "name"] = "giletsjaunes"
-        df.loc[df.name == "organisationmondialedelasanté", "name"] = "oms"
-        df.loc[df.name == "unioneuropéenne", "name"] = "ue"
+            df["date"] = pd.to_datetime(df["date"])
+            df = df.sort_values(["date"])
+            if self._filtered:
+                # exact selection, the scan filters only skip what is surely out
+                df = select_rows(df, self.start, self.end, self.organisations)
 
-        df["date"] = pd.to_datetime(df["date"])
-        df = df.sort_values(["date"])
+        if self.artefactDir is not None:
+            write_artefact(df, artefact_path(self.artefactDir, "normal", fname, *self._artefactParams))
 
         return df
 
+    def iter_Normal_DFs(self, reduced=False):
+        """ Normalises the dataframes one file at a time.
+            With prefetch > 0, the normalisation of a file (and whatever the caller does with it)
+            overlaps with the reading of the next files.
+
+        :param reduced: boolean
+            True to rename the 'name' column to 'organName' as in get_NormalReduced_DFs.
+        :return: generator of normalised dataframes
+        """
+        fresh = [] if self.artefactDir is None \
+            else [file for file in self._fileList
+                  if is_fresh_artefact(artefact_path(self.artefactDir, "normal", file, *self._artefactParams),
+                                       file)]
+        initial_DFs = self.iter_initial_DFs([file for file in self._fileList if file not in fresh])
+
+        for fname in self._fileList:
+            if fname in fresh:
+                self.sampleFractions[fname] = self.sample_fraction(fname)
+                df = read_artefact(artefact_path(self.artefactDir, "normal", fname, *self._artefactParams),
+                                   asTable=self._backend is not None)
+            else:
+                _, df = next(initial_DFs)
+                df = self.make_normal(df, fname)
+            if reduced and self._backend is not None:
+                df = self._backend.rename_columns(df, {"name": "organName"})
+            elif reduced:
+                df.rename(columns={"name": "organName"}, inplace=True)
+            yield df
+
     def get_Normal_DFs(self):
         """
         :return: list of normalised dataframes
         """
-        return list(map(self.make_normal, self._DFs, self._fileList))
+        return list(self.iter_Normal_DFs())
 
 
     def get_NormalReduced_DFs(self):
         """
         :return: list of normalised dataframes each of which contains only 3 columns
         """
-        normDfs = list(map(self.make_normal, self._DFs, self._fileList))
-        for df in normDfs :
-            df.rename(columns={"name": "organName"}, inplace=True)
-            df = df[["organName", "date", "count"]].copy()
-        return normDfs
+        return list(self.iter_Normal_DFs(reduced=True))
 
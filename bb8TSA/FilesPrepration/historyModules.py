@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only history of the result tables (TimeSeriesAnalysis.get_result_table) : one Parquet
+file per run in a hive partitioned directory
+
+    historyDir/runDate=2021-03-01/freq=M/part-<runId>.parquet
+
+The string columns are dictionary encoded and the rows are sorted by organName, so that the
+row group statistics (min / max of organName) let a reader skip the row groups, files and
+partitions which cannot contain the requested organisations (see read_history).
+"""
+from datetime import datetime
+from os import listdir, makedirs, path, replace
+
+import pandas as pd
+
+# pyarrow is imported by the functions using it (see the import time benchmark test/importtime.py)
+
+
+def partition_dir(historyDir, runDate, freq):
+    """
+    :return: str, directory of the (runDate, freq) partition
+    """
+    return path.join(historyDir, "runDate=" + str(runDate), "freq=" + str(freq))
+
+
+def write_run(df, historyDir, freq, runDate=None, runId=None, rowGroupSize=8192):
+    """ Adds the result table of a run to the history. Writing a run only creates a new file :
+        the other runs and partitions are not touched.
+
+    Parameters
+    ----------
+    df : dataframe
+        result table with an organName column
+    historyDir : str
+    freq : str
+        The bin size of the run {"W", "2W", "3W", "M"}
+    runDate : str, optional
+        "YYYY-MM-DD", today by default
+    runId : str, optional
+        identifies the run in its partition (file name and runId column), the current UTC time
+        by default : the runs of a same day and freq are kept side by side.
+    rowGroupSize : int
+        number of rows per row group, the granularity of the organName statistics.
+
+    Return
+    ----------
+    Path of the written file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    now = datetime.utcnow()
+    runDate = runDate or now.strftime("%Y-%m-%d")
+    runId = runId or now.strftime("%Y%m%dT%H%M%S%f")
+
+    df = df.sort_values("organName", kind="mergesort").reset_index(drop=True)
+    df.insert(0, "runId", runId)
+    # All the string columns are dictionary encoded in the file (use_dictionary). The labels are
+    # also kept as Arrow dictionaries (categories when read back), organName stays a plain
+    # string column so that the scan filters can be evaluated on it.
+    labels = [col for col in df.columns if df[col].dtype == object and col != "organName"]
+    df[labels] = df[labels].astype("category")
+
+    outDir = partition_dir(historyDir, runDate, freq)
+    makedirs(outDir, exist_ok=True)
+    fpath = path.join(outDir, "part-" + runId + ".parquet")
+    print("write_run : Writing", len(df), "rows to", fpath, "...")
+    tmp = fpath + ".tmp"
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp, row_group_size=rowGroupSize,
+                   use_dictionary=True, write_statistics=True)
+    # readers never see a partial file (the .tmp files are ignored by read_history)
+    replace(tmp, fpath)
+    return fpath
+
+
+def history_runs(historyDir):
+    """ Lists the runs of the history from the directory names only.
+
+    :return: dataframe (runDate, freq, runId, file) sorted by runDate
+    """
+    rows = []
+    if path.isdir(historyDir):
+        for dateDir in sorted(listdir(historyDir)):
+            if not dateDir.startswith("runDate="):
+                continue
+            for freqDir in sorted(listdir(path.join(historyDir, dateDir))):
+                if not freqDir.startswith("freq="):
+                    continue
+                for fname in sorted(listdir(path.join(historyDir, dateDir, freqDir))):
+                    if fname.startswith("part-") and fname.endswith(".parquet"):
+                        rows.append((dateDir[len("runDate="):], freqDir[len("freq="):],
+                                     fname[len("part-"):-len(".parquet")],
+                                     path.join(historyDir, dateDir, freqDir, fname)))
+    return pd.DataFrame(rows, columns=["runDate", "freq", "runId", "file"])
+
+
+def read_history(historyDir, organNames=None, freq=None, start=None, end=None, columns=None):
+    """ Reads the history with the filters pushed down to the scan : the partitions are selected
+        from their directory names and the row groups from their organName statistics, before
+        any data is read.
+
+    Parameters
+    ----------
+    historyDir : str
+    organNames : str or list of str, optional
+        organisations to read, all by default
+    freq : str, optional
+    start, end : str, optional
+        first and last run dates "YYYY-MM-DD" (included)
+    columns : list of str, optional
+        columns to read (runDate, freq, runId and organName are always returned)
+
+    Return
+    ----------
+    Dataframe sorted by runDate, runId and organName
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(pa.schema([("runDate", pa.string()), ("freq", pa.string())]), flavor="hive")
+    files = history_runs(historyDir)["file"].tolist()
+    if not files:
+        return pd.DataFrame(columns=["runDate", "freq", "runId", "organName"] + list(columns or []))
+    dataset = ds.dataset(files, format="parquet", partitioning=partitioning, partition_base_dir=historyDir)
+
+    filters = []
+    if organNames is not None:
+        organNames = [organNames] if isinstance(organNames, str) else list(organNames)
+        filters.append(ds.field("organName").isin(organNames))
+    if freq is not None:
+        filters.append(ds.field("freq") == freq)
+    if start is not None:
+        filters.append(ds.field("runDate") >= str(start))
+    if end is not None:
+        filters.append(ds.field("runDate") <= str(end))
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+
+    if columns is not None:
+        columns = list(dict.fromkeys(["runDate", "freq", "runId", "organName"] + list(columns)))
+    print("read_history : Reading", historyDir, "filter :", expression)
+    table = dataset.to_table(columns=columns, filter=expression)
+    df = table.to_pandas()
+    for col in ["runDate", "freq"]:
+        df[col] = df[col].astype(str)
+    return df.sort_values(["runDate", "runId", "organName"]).reset_index(drop=True)
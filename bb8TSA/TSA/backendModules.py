@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+pyarrow backend of the pipeline stages, selected with backend="arrow" in FileNormalisation
+and TimeSeriesAnalysis ("pandas" is the reference implementation).
+The data stay in Arrow tables and numpy arrays up to the binned time series, the outputs of the
+stages are the same dataframes as the pandas ones. pyarrow reads, filters and dictionary encodes
+the data, the binning and the statistical indicators are numpy reductions over integer keys.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from bb8TSA.TSA.kernelModules import stat_table
+from bb8TSA.TSA.panelModules import bin_labels
+
+
+backends = ["pandas", "arrow"]
+
+
+def make_backend(backend):
+    """
+    :param backend: str
+        one of backends
+    :return: ArrowBackend instance, None for the pandas backend
+    """
+    if backend not in backends:
+        raise ValueError("backend should be one of :", backends)
+    return ArrowBackend() if backend == "arrow" else None
+
+
+def _concat(column):
+    # ChunkedArray -> Array
+    if isinstance(column, pa.ChunkedArray):
+        return pa.concat_arrays(column.chunks) if column.num_chunks > 0 else pa.array([], column.type)
+    return column
+
+
+def _dictionary(column):
+    """ Hash encoding of a column through pyarrow.compute.
+    :return: (indices, values) : numpy array of int and sorted numpy array of the distinct values
+    """
+    arr = _concat(column)
+    if not pa.types.is_dictionary(arr.type):
+        arr = arr.dictionary_encode()
+    indices = arr.indices.to_numpy(zero_copy_only=False)
+    values, inv = np.unique(np.array(arr.dictionary.to_pylist(), dtype=object), return_inverse=True)
+    return inv[indices], values
+
+
+def _recode(indices, values, fun):
+    """ Applies fun to the distinct values only and merges the values mapped to the same result.
+    :return: (indices, values) as _dictionary
+    """
+    mapped = np.array([fun(v) for v in values], dtype=object)
+    uniq, inv = np.unique(mapped, return_inverse=True)
+    return inv[indices], uniq
+
+
+def _dates(column):
+    """
+    :return: numpy datetime64[ns] array of a timestamp or string date column
+    """
+    arr = _concat(column)
+    if pa.types.is_timestamp(arr.type) or pa.types.is_date(arr.type):
+        return np.asarray(arr.to_pandas(), dtype="datetime64[ns]")
+    indices, values = _dictionary(arr)
+    return pd.to_datetime(values).values[indices]
+
+
+def _segments(keys):
+    """
+    :param keys: sorted array
+    :return: offsets of the runs of equal keys (size number of runs + 1)
+    """
+    change = np.nonzero(keys[1:] != keys[:-1])[0] + 1
+    return np.concatenate([[0], change, [len(keys)]])
+
+
+class ArrowBackend:
+    """ Implementations of make_normal, make_binned_time_series, make_clean_cuts and compute_stat
+        for Arrow tables.
+        pyarrow covers the reading, the row filters and the dictionary encoding only : the
+        string normalisation works on the dictionary of the distinct names.
+        The binning sums, the clean cuts and the statistical indicators run on numpy arrays of
+        integer keys (np.unique / bincount, Table.group_by for the sums when pyarrow provides it,
+        and the kernels of kernelModules.stat_table).
+    """
+
+    def read(self, file, columns=None, filters=None):
+        return pq.read_table(file, columns=columns, filters=filters)
+
+    def to_table(self, df):
+        if isinstance(df, pa.Table):
+            return df
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+    def make_normal(self, table, aliases):
+        """ See FileNormalisation.make_normal
+        :return: Arrow table with a dictionary encoded name column, sorted by date
+        """
+        table = self.to_table(table)
+        table = table.filter(pc.equal(table["variable"], pa.scalar("organisation")))
+        if table.num_rows == 0:
+            # (take needs at least one chunk) the pushdown of a window may leave a file empty
+            columns = {field.name: pa.array([], field.type) for field in table.schema}
+            columns["name"] = pa.DictionaryArray.from_arrays(pa.array([], pa.int32()), pa.array([], pa.string()))
+            columns["date"] = pa.array([], pa.timestamp("ns"))
+            return pa.table([columns[name] for name in table.column_names], names=table.column_names)
+
+        def canonical(name):
+            name = "".join(filter(str.isalnum, name.lower()))
+            return aliases.get(name, name)
+
+        indices, names = _recode(*_dictionary(table["name"]), canonical)
+        dates = _dates(table["date"])
+        order = np.argsort(dates, kind="mergesort")
+
+        table = table.take(pa.array(order))
+        table = table.set_column(table.schema.get_field_index("name"), "name",
+                                 pa.DictionaryArray.from_arrays(pa.array(indices[order].astype(np.int32)),
+                                                                pa.array(names.tolist(), pa.string())))
+        table = table.set_column(table.schema.get_field_index("date"), "date", pa.array(dates[order]))
+        return table
+
+    def select_rows(self, table, start=None, end=None, organisations=None, nameCol="name", dateCol="date"):
+        """ See filesPrepModules.select_rows
+        :return: Arrow table
+        """
+        from bb8TSA.FilesPrepration.filesPrepModules import date_window
+
+        table = self.to_table(table)
+        start, stop = date_window(start, end)
+        mask = np.ones(table.num_rows, dtype=bool)
+        if start is not None or stop is not None:
+            dates = _dates(table[dateCol])
+            if start is not None:
+                mask &= dates >= start.to_datetime64()
+            if stop is not None:
+                mask &= dates < stop.to_datetime64()
+        if organisations is not None:
+            indices, names = _dictionary(table[nameCol])
+            mask &= np.isin(names, list(organisations))[indices]
+        return table if mask.all() else table.filter(pa.array(mask))
+
+    def select_columns(self, table, columns, newColumns):
+        """ See TimeSeriesAnalysis.select_columns
+        :return: Arrow table
+        """
+        missing = [col for col in columns if col not in table.column_names] if isinstance(table, pa.Table) \
+            else [col for col in columns if col not in table.columns]
+        if missing:
+            raise KeyError("{} not found in schema.".format(missing))
+        table = table.select(columns) if isinstance(table, pa.Table) else self.to_table(table[columns])
+        return table.rename_columns(newColumns)
+
+    def rename_columns(self, table, names):
+        """
+        :param names: dict old name -> new name
+        :return: Arrow table
+        """
+        table = self.to_table(table)
+        return table.rename_columns([names.get(col, col) for col in table.column_names])
+
+    def make_binned_time_series(self, table, freq, offsetDays, countFlag, organDict=None):
+        """ See BinnedOrganisations.make_binned_time_series
+        :param organDict: OrganDictionary, optional
+            to key the output by the codes of the names (int32) instead of the names
+        :return: dataframe (organName, date, binCount) sorted by organName and date
+        """
+        table = self.to_table(table)
+        indices, names = _dictionary(table["organName"])
+        if organDict is not None:
+            # distinct names only : the rows are recoded through their dictionary indices
+            indices = organDict.encode(names).astype(np.int64)[indices]
+            names = np.arange(max(len(organDict), 1), dtype=np.int32)
+        dates = _dates(table["date"])
+        uniqueDates, dateIndex = np.unique(dates, return_inverse=True)
+        labels, binOf = bin_labels(uniqueDates, freq)
+
+        key = indices.astype(np.int64) * len(labels) + binOf[dateIndex]
+        counts = _concat(table["count"]).to_numpy(zero_copy_only=False) if countFlag \
+            else np.ones(len(key), dtype=np.int64)
+
+        if hasattr(pa.Table, "group_by"):
+            agg = pa.table({"key": key, "count": counts}).group_by("key").aggregate([("count", "sum")])
+            keys, sums = agg["key"].to_numpy(), agg["count_sum"].to_numpy()
+            order = np.argsort(keys)
+            keys, sums = keys[order], sums[order]
+        else:
+            keys, inv = np.unique(key, return_inverse=True)
+            sums = np.bincount(inv, weights=counts)
+            if np.issubdtype(counts.dtype, np.integer):
+                sums = sums.astype(np.int64)
+
+        return pd.DataFrame({"organName": names[keys // len(labels)],
+                             "date": labels[keys % len(labels)] - np.timedelta64(offsetDays, "D"),
+                             "binCount": sums})
+
+    def make_clean_cuts(self, df_organ_binned, minNumBins):
+        """ See BinnedOrganisations.make_clean_cuts (df_organ_binned sorted by organName)
+        :return: dataframe
+        """
+        offsets = _segments(df_organ_binned["organName"].values)
+        sizes = np.diff(offsets)
+        numBins = np.repeat(sizes, sizes)
+        keep = numBins > minNumBins - 1
+        df_c = df_organ_binned[keep].reset_index(drop=True)
+        df_c["numBins"] = numBins[keep]
+        return df_c
+
+    def compute_stat(self, df, intp=True, numBins="numBins", groupKey="organName", targetCol="binCount"):
+        """ See StatIndic.compute_stat : same table, computed by the kernels on the sorted arrays of
+            the time series (kernelModules.stat_table).
+        :return: dataframe
+        """
+        return stat_table(df, intp=intp, numBins=numBins, groupKey=groupKey, targetCol=targetCol)
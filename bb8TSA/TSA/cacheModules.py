@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Content addressed cache of the per organisation results (stat table and fit rows) between runs.
+The key of an organisation hashes its binned time serie (dates, counts, number of bins) with the
+parameters of the computations : an organisation whose serie did not change is not computed again.
+The entries are kept in a local SQLite file, the least recently used ones are evicted beyond
+the size and count limits.
+"""
+import hashlib
+import pickle
+import sqlite3
+import time
+from contextlib import closing
+from os import makedirs, path
+
+import numpy as np
+import pandas as pd
+
+
+# Part of every key : changing the computations of the cached rows invalidates the old entries
+CACHE_VERSION = 2
+
+# Maximum number of parameters of a SQLite statement
+_chunkSize = 900
+
+
+def series_keys(df_c, params, groupKey="organName", targetCol="binCount", numBins="numBins", organDict=None):
+    """ Hashes the binned time serie of each organisation with the parameters.
+
+    Parameters
+    ----------
+    df_c : dataframe
+        stacked binned time series
+    params : dict
+        parameters the results depend on
+    groupKey, targetCol, numBins : str
+        column names
+    organDict : OrganDictionary, optional
+        dictionary of the codes when df_c is keyed by codes : the names are hashed, the codes
+        depend on the organisations seen before
+
+    Return
+    ----------
+    Series of hexadecimal keys indexed by the organisation names or codes (sorted)
+    """
+    prefix = repr((CACHE_VERSION, sorted(params.items()), str(df_c[targetCol].dtype))).encode()
+    codes, names = pd.factorize(df_c[groupKey], sort=True)
+    order = np.argsort(codes, kind="mergesort")
+    # rows of each organisation in the order of df_c : the results may depend on it
+    dates = np.ascontiguousarray(df_c["date"].values.astype("datetime64[ns]")[order])
+    y = np.ascontiguousarray(df_c[targetCol].values.astype(np.float64)[order])
+    nb = np.ascontiguousarray(df_c[numBins].values.astype(np.int64)[order])
+    offsets = np.searchsorted(codes[order], np.arange(len(names) + 1))
+    hashed = names if organDict is None else organDict.decode(names)
+
+    keys = []
+    for i, name in enumerate(hashed):
+        s, e = offsets[i], offsets[i + 1]
+        h = hashlib.blake2b(prefix, digest_size=16)
+        h.update(str(name).encode())
+        h.update(dates[s:e].tobytes())
+        h.update(y[s:e].tobytes())
+        h.update(nb[s:e].tobytes())
+        keys.append(h.hexdigest())
+    return pd.Series(keys, index=names)
+
+
+class ResultCache:
+    """ Key-value store of pickled results in a SQLite file with least recently used eviction.
+
+    Parameters
+    ----------
+    fpath : str
+        SQLite file, created if needed
+    maxBytes : int
+        Maximum total size of the stored values. 256 MB by default.
+    maxEntries : int, optional
+        Maximum number of entries.
+    """
+    def __init__(self, fpath, maxBytes=2**28, maxEntries=None):
+        self.fpath = fpath
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        if path.dirname(fpath):
+            makedirs(path.dirname(fpath), exist_ok=True)
+        with closing(self._connect()) as con, con:
+            con.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                        "size INTEGER NOT NULL, lastUsed REAL NOT NULL)")
+            con.execute("CREATE INDEX IF NOT EXISTS results_lastUsed ON results (lastUsed)")
+            # the limits may be lower than the ones of the previous runs
+            self._evict(con)
+
+    def _connect(self):
+        return sqlite3.connect(self.fpath, timeout=60.)
+
+    def get_many(self, keys):
+        """
+        :param keys: list of str
+        :return: dict {key: value} of the keys found, their last use is updated
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        with closing(self._connect()) as con, con:
+            for i in range(0, len(keys), _chunkSize):
+                chunk = keys[i:i + _chunkSize]
+                marks = ",".join("?" * len(chunk))
+                rows = con.execute("SELECT key, value FROM results WHERE key IN ({})".format(marks), chunk)
+                found.update((key, pickle.loads(value)) for key, value in rows)
+                con.execute("UPDATE results SET lastUsed = ? WHERE key IN ({})".format(marks), [now] + chunk)
+        return found
+
+    def put_many(self, items):
+        """ Stores the values and evicts the least recently used entries beyond the limits.
+
+        :param items: dict {key: value} of picklable values
+        """
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, sqlite3.Binary(blob), len(blob), now))
+        with closing(self._connect()) as con, con:
+            con.executemany("INSERT OR REPLACE INTO results (key, value, size, lastUsed) VALUES (?, ?, ?, ?)", rows)
+            self._evict(con)
+
+    def _evict(self, con):
+        size, count = con.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM results").fetchone()
+        maxEntries = count if self.maxEntries is None else self.maxEntries
+        if size <= self.maxBytes and count <= maxEntries:
+            return
+        evicted = []
+        for key, entrySize in con.execute("SELECT key, size FROM results ORDER BY lastUsed"):
+            if size <= self.maxBytes and count <= maxEntries:
+                break
+            evicted.append((key,))
+            size -= entrySize
+            count -= 1
+        con.executemany("DELETE FROM results WHERE key = ?", evicted)
+        print("ResultCache : Evicted", len(evicted), "entries from", self.fpath)
+
+    def info(self):
+        """
+        :return: dict (entries, bytes)
+        """
+        with closing(self._connect()) as con:
+            count, size = con.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {"entries": count, "bytes": size}
+
+    def clear(self):
+        with closing(self._connect()) as con, con:
+            con.execute("DELETE FROM results")
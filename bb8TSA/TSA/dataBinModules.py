@@ -5,12 +5,20 @@ Created on Tue Nov 24 13:06:33 2020
 @author: M77100
 """
 import datetime
+import hashlib
+
+import numpy as np
 import pandas as pd
 
+from bb8TSA.FilesPrepration.artefactModules import artefact_path, write_artefact
+from bb8TSA.TSA.organModules import OrganDictionary, decode_names
+from bb8TSA.TSA.sketchModules import sketch_binned_time_series
+
 
 class BinnedOrganisations:
     """Time series construction class.
         Time series are kept in a dataframe with 3 columns : organName, date and binCount
+        (organName holds the int32 codes of the names in organDict)
         Provides methods to bin the data according to given time-bin (freq)
         Each bin contains the citation count for a given organisation.
 
@@ -30,6 +38,31 @@ class BinnedOrganisations:
     minNumBins : int
         Minimum number of bins needed for statistical computations
 
+    artefactDir : str, optional
+        If given, the binned and the cleaned binned dataframes are written there as Arrow IPC
+        files (see artefactModules).
+
+    backend : str
+        "pandas" (default) or "arrow" : implementation of the binning and of the cuts
+        (see backendModules). Both give the same dataframes.
+
+    sketch : dict, optional
+        If given, the files are binned approximately through count-min sketches and only the
+        organisations whose total count can reach sketch["minTotal"] are kept (see sketchModules).
+        Keys : minTotal, and optionally width, depth, chunkSize, seed and verify (True to bin the
+        kept organisations exactly again). Pandas backend only.
+
+    sampleFraction : float or dict, optional
+        Quick-look mode : the input dataframes are uniform samples of the data files, with this
+        inclusion probability (or {file name: inclusion probability}, see
+        FileNormalisation.sampleFractions, with an entry for each file of fileList). The bin
+        counts are divided by it.
+
+    organDict : OrganDictionary, optional
+        Codes of the organisation names (see organModules), a new dictionary by default.
+        Pass the same dictionary to the analyses of different runs to share the codes.
+        The artefacts are written with the names.
+
     Attributes
     ----------
     extract_binned_DFs : list of dataframes
@@ -52,7 +85,8 @@ class BinnedOrganisations:
 
 #    def __init__(self, nameCol="organName", dateCol="date", countCol=None, freq="M",
 #                 minNumBins=3, countFlag=False):
-    def __init__(self, nameCol, dateCol, countCol, freq, minNumBins, countFlag):
+    def __init__(self, nameCol, dateCol, countCol, freq, minNumBins, countFlag, artefactDir=None,
+                 backend="pandas", sketch=None, sampleFraction=None, organDict=None):
 
         print("BinnedOrganisations class initialised.")
         offsets = {"W": 2, "2W": 0, "3W": 0, "M": 27}
@@ -61,6 +95,24 @@ class BinnedOrganisations:
         self.dateCol = dateCol
         self.countCol = countCol
         self.countFlag = countFlag
+        self.artefactDir = artefactDir
+        self.backend = backend
+        if backend == "pandas":
+            self._backend = None
+        else:
+            # pyarrow is imported only when another backend is used
+            from bb8TSA.TSA.backendModules import make_backend
+            self._backend = make_backend(backend)
+        if sketch is not None and self._backend is not None:
+            raise ValueError("The sketch binning is available with the pandas backend only.")
+        self.sketch = sketch
+        self.sampleFraction = sampleFraction
+        # rows selected by fit (start, end, organisations), part of the artefact names
+        self._selection = (None, None, None)
+        # the binned time series are keyed by the codes of the names
+        self.organDict = organDict if organDict is not None else OrganDictionary()
+        # sketch error bounds per data file
+        self.sketch_info = {}
         self._offsets = offsets
         self.freq = freq if freq in offsets.keys() else "NV"
         if self.freq == "NV" :
@@ -80,6 +132,10 @@ class BinnedOrganisations:
             else [ "file"+str(i+1) for i in range( len(DFs) ) ]
         self._organ_DFs = DFs
         self._fileList = _fileList
+        # binned dataframes already computed, per time frequency
+        self._binned = {}
+        # cleaned binned dataframes already computed, per (freq, minNumBins)
+        self._cleaned = {}
 
     def make_binned_time_series(self, df_organs, fname):
         """ Computes the time series
@@ -102,31 +158,125 @@ class BinnedOrganisations:
         print("    Grouping by orgnanisations' name and time  binned by {} then sum over".format(freq),
                     "the binn's count ...")
 
-        df_organs.rename(columns={self.nameCol:"organName", self.dateCol:"date"}, inplace=True)
-        if self.countFlag == False:
-            df_organs["count"] = 1
-        else :
-            df_organs.rename(columns={self.countCol: "count"}, inplace=True)
-
-        df_organ_binned = df_organs.groupby(["organName", pd.Grouper(key='date', freq=freq)]) \
-            .agg({"count": "sum"}) \
-            .reset_index()
-
-        # Adjusting the date bin centers to the first day of the month
         dd = self._offsets[self.freq]
-        df_organ_binned["date"] = df_organ_binned["date"] \
-            .apply(lambda x: x - datetime.timedelta(dd))
-        #            .apply( lambda x : x.replace(day=1) )
-
-        print("    Renaming the columns of the binned datafarme ...")
-        df_organ_binned.columns = ["organName", "date", "binCount"]
-        # binCount : number of enteries per bin
+        if self._backend is not None:
+            df_organs = self._backend.rename_columns(df_organs, {self.nameCol: "organName", self.dateCol: "date",
+                                                                 self.countCol: "count"})
+            df_organ_binned = self._backend.make_binned_time_series(df_organs, freq, dd, self.countFlag,
+                                                                    organDict=self.organDict)
+        else:
+            df_organs.rename(columns={self.nameCol:"organName", self.dateCol:"date"}, inplace=True)
+            if self.countFlag == False:
+                df_organs["count"] = 1
+            else :
+                df_organs.rename(columns={self.countCol: "count"}, inplace=True)
+
+            if self.sketch is not None:
+                sb = self.make_sketch(df_organs, fname)
+
+            if self.sketch is not None and not self.sketch.get("verify", False):
+                df_organ_binned = sb.to_frame()
+                df_organ_binned["date"] = df_organ_binned["date"] - datetime.timedelta(dd)
+                df_organ_binned["organName"] = self.organDict.encode(df_organ_binned["organName"].values)
+                df_organ_binned = df_organ_binned.sort_values(["organName", "date"], kind="mergesort") \
+                    .reset_index(drop=True)
+            else:
+                if self.sketch is not None:
+                    print("    Exact binning of the organisations kept by the sketch ...")
+                    df_organs = df_organs[df_organs["organName"].isin(sb.names)]
+
+                # the names are hashed once here, the groupby runs on the codes (missing names dropped)
+                codes = self.organDict.encode(df_organs["organName"].values)
+                df_organs = df_organs.assign(organName=codes)[codes >= 0]
+                df_organ_binned = df_organs.groupby(["organName", pd.Grouper(key='date', freq=freq)]) \
+                    .agg({"count": "sum"}) \
+                    .reset_index()
+
+                # Adjusting the date bin centers to the first day of the month
+                df_organ_binned["date"] = df_organ_binned["date"] \
+                    .apply(lambda x: x - datetime.timedelta(dd))
+                #            .apply( lambda x : x.replace(day=1) )
+
+                print("    Renaming the columns of the binned datafarme ...")
+                df_organ_binned.columns = ["organName", "date", "binCount"]
+                # binCount : number of enteries per bin
+                # (the groupby widens the codes)
+                df_organ_binned["organName"] = df_organ_binned["organName"].astype(np.int32)
+
+        if self.sampleFraction is not None:
+            fraction = self.get_sample_fraction(fname)
+            print("    Quick-look sample : bin counts divided by the sampling fraction", fraction)
+            df_organ_binned["binCount"] = df_organ_binned["binCount"] / fraction
+
+        if self.artefactDir is not None:
+            write_artefact(decode_names(df_organ_binned, self.organDict, sort=True),
+                           artefact_path(self.artefactDir, "binned", fname, *self.artefact_params(fname)))
 
         print("    Returning the binned datafarme ...")
         print("------------------------------------------- ")
         return df_organ_binned
 
 
+    def make_sketch(self, df_organs, fname):
+        """ Streams a dataframe through the count-min sketches (see sketchModules.SketchBinning)
+        and keeps the error bounds per time bin in sketch_info.
+
+        Parameters
+        ----------
+        df_organs : dataframe
+            organName, date and count columns
+        fname : string
+            original data file name
+
+        Return
+        ----------
+        SketchBinning instance
+        """
+        params = {key: value for key, value in self.sketch.items() if key != "verify"}
+        print("    Sketch binning : minimum total count :", params["minTotal"])
+        sb = sketch_binned_time_series(df_organs, self.freq, **params)
+        self.sketch_info[fname] = sb.error_table()
+
+        epsilon, delta, bounds = sb.sketch.error_bounds()
+        print("    Sketch :", sb.sketch.depth, "x", sb.sketch.width, "counters per bin, epsilon :",
+              round(epsilon, 6), ", delta :", round(delta, 3))
+        print("    Maximum error bound :", round(bounds.max(), 1) if len(bounds) else 0.,
+              ", exact counters :", len(sb.names), "organisations")
+        return sb
+
+    def artefact_params(self, fname, *params):
+        """ Parameters of the names of the binned and cleaned artefacts of a data file : the
+            frequency, the given ones and a hash of all the other parameters the binned time
+            series depend on (columns, counts, rows selected by fit, sampling fraction, sketch).
+            An artefact is never reused by a run with other parameters.
+
+        :param fname: str
+            data file name
+        :param params: other parameters (minNumBins for the cleaned artefacts)
+        :return: list
+        """
+        start, end, organisations = self._selection
+        config = (self.nameCol, self.dateCol, self.countFlag, self.countCol if self.countFlag else None,
+                  str(start), str(end), sorted(organisations) if organisations is not None else None,
+                  self.get_sample_fraction(fname), sorted((self.sketch or {}).items()))
+        return [self.freq] + list(params) + [hashlib.md5(repr(config).encode()).hexdigest()[:8]]
+
+    def get_sample_fraction(self, fname):
+        """
+        :param fname: str
+            data file name
+        :return: inclusion probability of the rows of the data file (1 without sampling)
+        """
+        if self.sampleFraction is None:
+            return 1.
+        if isinstance(self.sampleFraction, dict):
+            if fname not in self.sampleFraction:
+                # a wrong key would silently leave the counts of a sampled file unscaled
+                raise ValueError("sampleFraction has no entry for " + str(fname)
+                                 + " : the keys should be the file names of fileList")
+            return self.sampleFraction[fname]
+        return self.sampleFraction
+
     def make_clean_cuts(self, df_organ_binned, fname):
         """ Counts the number of measurement (bins) of all times series and drop those with low number
         of bins according to minNumBins value.
@@ -146,14 +296,22 @@ class BinnedOrganisations:
         print("BinnedOrganisations : make_clean_cuts : Filtering low count curves for ", fname, ".")
         print("    Minimum accepted number of bins : ", self.minNumBins)
 
-        df_c = df_organ_binned.groupby("organName")["date"] \
-            .count() \
-            .reset_index()
-        df_c.rename(columns={"date": "numBins"}, inplace=True)
-        # numBins : number of bins for an organisation
+        if self._backend is not None:
+            df_c = self._backend.make_clean_cuts(df_organ_binned, self.minNumBins)
+        else:
+            df_c = df_organ_binned.groupby("organName")["date"] \
+                .count() \
+                .reset_index()
+            df_c.rename(columns={"date": "numBins"}, inplace=True)
+            # numBins : number of bins for an organisation
+
+            df_c = df_c[df_c["numBins"] > self.minNumBins - 1]
+            df_c = df_organ_binned.merge(df_c, on="organName")
 
-        df_c = df_c[df_c["numBins"] > self.minNumBins - 1]
-        df_c = df_organ_binned.merge(df_c, on="organName")
+        if self.artefactDir is not None:
+            write_artefact(decode_names(df_c, self.organDict, sort=True),
+                           artefact_path(self.artefactDir, "clean", fname,
+                                         *self.artefact_params(fname, self.minNumBins)))
 
         print("    Returning the cleaned binned datafarme ...")
         print("------------------------------------------- ")
@@ -166,8 +324,11 @@ class BinnedOrganisations:
         ----------
         List of dataframes each of which contains cleaned time series
         """
-        binned_DFs = self.get_mbts()
-        return list(map(self.make_clean_cuts, binned_DFs, self._fileList))
+        key = (self.freq, self.minNumBins)
+        if key not in self._cleaned:
+            binned_DFs = self.get_mbts()
+            self._cleaned[key] = list(map(self.make_clean_cuts, binned_DFs, self._fileList))
+        return self._cleaned[key]
 
     extract_cleand_binned_DFs = property(get_mcc)
 
@@ -178,8 +339,11 @@ class BinnedOrganisations:
         List of dataframes each of which contains time series
         """
 
-        organ_DFs = self._organ_DFs
-        binned_DFs = list(map(self.make_binned_time_series, organ_DFs, self._fileList))
+        binned_DFs = self._binned.get(self.freq)
+        if binned_DFs is None:
+            organ_DFs = self._organ_DFs
+            binned_DFs = list(map(self.make_binned_time_series, organ_DFs, self._fileList))
+            self._binned[self.freq] = binned_DFs
         self._binned_DFs = binned_DFs
         return binned_DFs
 
@@ -211,9 +375,11 @@ class BinnedOrganisations:
 ##############################################################################
 
 
-def stack_c_DFs(c_DFs, memSeuil=5):
+def stack_c_DFs(c_DFs, memSeuil=5, sources=None):
     # Computing the memory used by all dataframes in GB
     # with memSeuil you can manage your memory resource usage
+    # sources : names of the corpora of c_DFs. If given, the stacked dataframe keeps them in a
+    #   source column, with the number of bins of each corpus in sourceNumBins.
     memUseList = list(
         map(lambda df: df.memory_usage(index=True).sum() * 1.e-9, c_DFs)
     )
@@ -222,6 +388,8 @@ def stack_c_DFs(c_DFs, memSeuil=5):
 
     df_c = pd.DataFrame()
     if memUse < memSeuil:
+        if sources is not None:
+            c_DFs = [df.assign(source=src, sourceNumBins=df["numBins"]) for df, src in zip(c_DFs, sources)]
         for df in c_DFs:
             df_c = pd.concat([df_c, df], ignore_index=True)\
                      .sort_values(by=["organName", "date"])
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Single pass kernels over time series stored as sorted contiguous arrays with segment offsets
+(the points of the i-th serie are values[offsets[i]:offsets[i+1]], sorted by date).
+The kernels are compiled with numba when it is installed, NumPy implementations are used
+otherwise : the choice is made at import and kept in KERNELS ("numba" or "numpy").
+"""
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit
+    KERNELS = "numba"
+except ImportError:
+    njit = None
+    KERNELS = "numpy"
+
+
+##############################################################################
+# NumPy implementations
+
+def _segment_stats_numpy(y, offsets):
+    starts, n = offsets[:-1], np.diff(offsets)
+    codes = np.repeat(np.arange(len(n)), n)
+    mean = np.add.reduceat(y, starts) / n
+    ySorted = y[np.lexsort((y, codes))]
+    median = .5 * (ySorted[starts + (n - 1) // 2] + ySorted[starts + n // 2])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma = np.sqrt(np.add.reduceat((y - mean[codes]) ** 2, starts) / (n - 1))
+    return mean, median, np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts), sigma
+
+
+def _internal_sigma_numpy(days, y, offsets, intp):
+    starts, n = offsets[:-1], np.diff(offsets)
+    codes = np.repeat(np.arange(len(n)), n)
+    pos = np.arange(len(y)) - starts[codes]
+    d2 = np.full(len(y), np.nan)
+    if intp:
+        inner = np.nonzero((pos >= 1) & (pos < n[codes] - 1))[0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slop = (y[inner + 1] - y[inner - 1]) / (days[inner + 1] - days[inner - 1])
+            slop[slop == np.inf] = 0.
+            d2[inner] = (y[inner] - (y[inner - 1] + slop * (days[inner] - days[inner - 1]))) ** 2
+    else:
+        inner = np.nonzero(pos >= 1)[0]
+        d2[inner] = (y[inner] - y[inner - 1]) ** 2
+    valid = ~np.isnan(d2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sqrt(np.bincount(codes[valid], weights=d2[valid], minlength=len(n)) /
+                       np.bincount(codes[valid], minlength=len(n)))
+
+
+def _line_fit_numpy(x, y, w, offsets):
+    starts, n = offsets[:-1], np.diff(offsets)
+    codes = np.repeat(np.arange(len(n)), n)
+    S = np.add.reduceat(w, starts)
+    xMean = np.add.reduceat(w * x, starts) / S
+    yMean = np.add.reduceat(w * y, starts) / S
+    dx, dy = x - xMean[codes], y - yMean[codes]
+    Sxx = np.add.reduceat(w * dx * dx, starts)
+    Sxy = np.add.reduceat(w * dx * dy, starts)
+    Syy = np.add.reduceat(w * dy * dy, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = Sxy / Sxx
+        intercept = yMean - slope * xMean
+        chi2 = np.clip(Syy - slope * Sxy, 0., None)
+        xi2 = chi2 / (n - 2.)
+        slopeErr = np.sqrt(xi2 / Sxx)
+        r = Sxy / np.sqrt(Sxx * Syy)
+    return slope, intercept, slopeErr, xi2, r
+
+
+##############################################################################
+# numba implementations
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _segment_stats_numba(y, offsets):
+        nSeg = len(offsets) - 1
+        mean, median = np.empty(nSeg), np.empty(nSeg)
+        yMin, yMax, sigma = np.empty(nSeg), np.empty(nSeg), np.empty(nSeg)
+        for i in range(nSeg):
+            seg = y[offsets[i]:offsets[i + 1]]
+            n = len(seg)
+            m = seg.sum() / n
+            ss = 0.
+            for v in seg:
+                ss += (v - m) * (v - m)
+            mean[i] = m
+            sigma[i] = np.sqrt(ss / (n - 1)) if n > 1 else np.nan
+            s = np.sort(seg)
+            median[i] = .5 * (s[(n - 1) // 2] + s[n // 2])
+            yMin[i], yMax[i] = s[0], s[n - 1]
+        return mean, median, yMin, yMax, sigma
+
+    @njit(cache=True)
+    def _internal_sigma_numba(days, y, offsets, intp):
+        nSeg = len(offsets) - 1
+        out = np.empty(nSeg)
+        for i in range(nSeg):
+            p0, p1 = offsets[i], offsets[i + 1]
+            total, count = 0., 0
+            if intp:
+                for k in range(p0 + 1, p1 - 1):
+                    slop = (y[k + 1] - y[k - 1]) / (days[k + 1] - days[k - 1])
+                    if slop == np.inf:
+                        slop = 0.
+                    d = y[k] - (y[k - 1] + slop * (days[k] - days[k - 1]))
+                    if not np.isnan(d):
+                        total += d * d
+                        count += 1
+            else:
+                for k in range(p0 + 1, p1):
+                    d = y[k] - y[k - 1]
+                    total += d * d
+                    count += 1
+            out[i] = np.sqrt(total / count) if count > 0 else np.nan
+        return out
+
+    @njit(cache=True)
+    def _line_fit_numba(x, y, w, offsets):
+        nSeg = len(offsets) - 1
+        slope, intercept = np.empty(nSeg), np.empty(nSeg)
+        slopeErr, xi2, r = np.empty(nSeg), np.empty(nSeg), np.empty(nSeg)
+        for i in range(nSeg):
+            p0, p1 = offsets[i], offsets[i + 1]
+            S, Sx, Sy = 0., 0., 0.
+            for k in range(p0, p1):
+                S += w[k]
+                Sx += w[k] * x[k]
+                Sy += w[k] * y[k]
+            xMean, yMean = Sx / S, Sy / S
+            Sxx, Sxy, Syy = 0., 0., 0.
+            for k in range(p0, p1):
+                dx, dy = x[k] - xMean, y[k] - yMean
+                Sxx += w[k] * dx * dx
+                Sxy += w[k] * dx * dy
+                Syy += w[k] * dy * dy
+            s = Sxy / Sxx if Sxx != 0. else np.nan
+            chi2 = max(Syy - s * Sxy, 0.)
+            n = p1 - p0
+            slope[i] = s
+            intercept[i] = yMean - s * xMean
+            xi2[i] = chi2 / (n - 2.) if n > 2 else (np.inf if chi2 > 0. else np.nan)
+            slopeErr[i] = np.sqrt(xi2[i] / Sxx) if Sxx != 0. else np.nan
+            r[i] = Sxy / np.sqrt(Sxx * Syy) if Sxx * Syy > 0. else np.nan
+        return slope, intercept, slopeErr, xi2, r
+
+    _segment_stats, _internal_sigma, _line_fit = _segment_stats_numba, _internal_sigma_numba, _line_fit_numba
+else:
+    _segment_stats, _internal_sigma, _line_fit = _segment_stats_numpy, _internal_sigma_numpy, _line_fit_numpy
+
+
+##############################################################################
+
+def segment_stats(y, offsets):
+    """
+    :param y: array of float
+    :param offsets: array of int, start of each serie (size number of series + 1)
+    :return: mean, median, min, max and sigma (ddof=1) of each serie
+    """
+    return _segment_stats(np.ascontiguousarray(y, dtype=float), np.asarray(offsets, dtype=np.int64))
+
+
+def internal_sigma(days, y, offsets, intp=True):
+    """ Internal dispersion of each serie (see StatIndic.compute_stat) : root mean square of the
+        differences to the interpolation between the previous and the next bins (compute_interpol),
+        or of the differences between consecutive bins if intp is False.
+
+    :param days: array of float, dates in days
+    :param y: array of float
+    :param offsets: array of int
+    :param intp: boolean
+    :return: array of float (NaN when a serie is too short)
+    """
+    return _internal_sigma(np.ascontiguousarray(days, dtype=float), np.ascontiguousarray(y, dtype=float),
+                           np.asarray(offsets, dtype=np.int64), bool(intp))
+
+
+def line_fit(x, y, w, offsets):
+    """ Weighted least squares line of each serie (two pass, centered sums).
+        Unit weights give the scipy.stats.linregress estimates, 1/err^2 weights the
+        scipy.optimize.curve_fit ones (relative sigma).
+
+    :return: slope, intercept, slope error, reduced chi2 and correlation coefficient of each serie
+    """
+    return _line_fit(np.ascontiguousarray(x, dtype=float), np.ascontiguousarray(y, dtype=float),
+                     np.ascontiguousarray(w, dtype=float), np.asarray(offsets, dtype=np.int64))
+
+
+##############################################################################
+
+def stat_table(df, intp=True, numBins="numBins", groupKey="organName", targetCol="binCount"):
+    """ StatIndic.compute_stat table computed by the kernels.
+
+    :param df: dataframe
+        stacked binned time series
+    :return: dataframe
+    """
+    codes, names = pd.factorize(df[groupKey].values, sort=True)
+    dates = df["date"].values.astype("datetime64[ns]")
+    order = np.lexsort((dates.astype(np.int64), codes))
+    codes, dates = codes[order], dates[order]
+    y = df[targetCol].values[order].astype(float)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(names)))])
+
+    mean, median, yMin, yMax, sigma = segment_stats(y, offsets)
+    internalSigma = internal_sigma(dates.astype(np.int64) / 86400.e9, y, offsets, intp)
+    if not intp:
+        internalSigma = np.round(internalSigma, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigmasRatio = np.where(np.abs(sigma) > 1.e-6, sigma / internalSigma, 0.)
+    sigmasRatio[sigmasRatio == np.inf] = 0.
+
+    # numBins : sum of the distinct values per organisation
+    nb = df[numBins].values[order]
+    pairs = np.unique(np.stack([codes, nb], axis=1), axis=0)
+    totalBins = np.bincount(pairs[:, 0], weights=pairs[:, 1], minlength=len(names)).astype(np.int64)
+
+    df_stat = pd.DataFrame({groupKey: names, "mean": np.round(mean, 0), "median": median,
+                            "min": yMin, "max": yMax, "sigma": np.round(sigma, 0),
+                            "sigmasRatio": np.round(sigmasRatio, 1), numBins: totalBins})
+    if np.issubdtype(df[targetCol].dtype, np.integer):
+        # pandas casts the aggregations back to the integer type when no value is lost
+        cols = ["min", "max"] + (["median"] if np.all(median == np.round(median)) else [])
+        df_stat[cols] = df_stat[cols].astype(df[targetCol].dtype)
+    keep = ~(np.isnan(internalSigma) | np.isnan(sigma) | np.isnan(sigmasRatio)) & \
+        np.isfinite(df_stat[["mean", "median", "min", "max", "sigma", "sigmasRatio"]].values.astype(float)).all(axis=1)
+    return df_stat[keep].reset_index(drop=True).sort_values("mean", ascending=False)
+
+
+def fit_table(df_c, freq, simpFit=True):
+    """ Tendance.compute_simple_lin_fit (simpFit) or Tendance.compute_lin_fit table computed
+        by the kernels.
+
+    :param df_c: dataframe
+        stacked binned time series
+    :param freq: str
+    :return: dataframe
+    """
+    from scipy.special import stdtr
+    from bb8TSA.TSA.panelModules import BinnedPanel
+
+    panel = BinnedPanel(df_c, freq)
+    w = np.ones_like(panel.y) if simpFit else 1. / panel.shot_noise() ** 2
+    slope, intercept, slopeErr, xi2, r = line_fit(panel.x, panel.y, w, panel.offsets)
+
+    def degrees(values):
+        return np.round(np.arctan(values) * 180 / np.pi, 1)
+
+    if simpFit:
+        n = panel.counts - 2.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = r * np.sqrt(n / ((1. - r) * (1. + r)))
+            pValue = 2. * stdtr(n, -np.abs(t))
+        return panel.to_frame(slope=degrees(slope), intercept=np.round(intercept, 1),
+                              R2=np.round(r * r, 2), linePValue=np.round(pValue, 2),
+                              slopeErr=degrees(slopeErr))
+    return panel.to_frame(slope=degrees(slope), intercept=np.round(intercept, 1),
+                          slopeErr=degrees(slopeErr), xi2=xi2)
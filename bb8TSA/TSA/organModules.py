@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Global dictionary of the organisation names. The binned time series are keyed by the int32 code
+of each name (see BinnedOrganisations) : the groupbys, merges and sorts of the analysis compare
+integers, the names are restored in the output tables only. A code never changes once assigned,
+so one dictionary can be shared by the files and the runs of an analysis (save / load).
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+
+from bb8TSA.FilesPrepration.artefactModules import read_artefact, write_artefact
+
+
+class OrganDictionary:
+    """ Append-only mapping between the organisation names and int32 codes.
+
+    Parameters
+    ----------
+    names : list of str, optional
+        initial names, coded 0, 1, ... in this order
+    """
+    def __init__(self, names=None):
+        self._codes = {}
+        self._names = []
+        self._array = np.empty(0, dtype=object)
+        # the analyses of a service may share the dictionary (TimeSeriesAnalysis.afit)
+        self._lock = threading.Lock()
+        for name in names if names is not None else []:
+            if name not in self._codes:
+                self._codes[name] = len(self._names)
+                self._names.append(name)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._codes
+
+    @property
+    def names(self):
+        """
+        :return: array of the names, indexed by their codes
+        """
+        if len(self._array) != len(self._names):
+            self._array = np.array(self._names, dtype=object)
+        return self._array
+
+    def encode(self, names):
+        """ Codes of the names, the new names are added to the dictionary in sorted order (the
+            codes do not depend on the order of the rows). Each distinct name is hashed once.
+
+        :param names: array-like of str
+        :return: array of int32, -1 for the missing names
+        """
+        inverse, uniques = pd.factorize(pd.Series(names, dtype=object), sort=True)
+        codes = np.empty(len(uniques) + 1, dtype=np.int32)
+        codes[-1] = -1
+        with self._lock:
+            for i, name in enumerate(uniques):
+                code = self._codes.get(name)
+                if code is None:
+                    code = self._codes[name] = len(self._names)
+                    self._names.append(name)
+                codes[i] = code
+        return codes[inverse]
+
+    def decode(self, codes):
+        """
+        :param codes: array-like of int
+        :return: array of the names (object)
+        """
+        return self.names[np.asarray(codes)]
+
+    def save(self, fpath):
+        """ Writes the names in the order of their codes (Arrow IPC file, see write_artefact). """
+        write_artefact(pd.DataFrame({"organName": self.names}), fpath)
+
+    @classmethod
+    def load(cls, fpath):
+        """
+        :return: the dictionary written by save
+        """
+        return cls(read_artefact(fpath)["organName"].tolist())
+
+
+def decode_names(df, organDict, groupKey="organName", sort=False):
+    """ Restores the names of a dataframe keyed by codes (unchanged if it is keyed by names).
+
+    :param df: dataframe
+    :param organDict: OrganDictionary
+    :param sort: boolean
+        True to sort the rows by name and date (order of the time series keyed by names)
+    :return: dataframe
+    """
+    if groupKey not in df.columns or not np.issubdtype(df[groupKey].dtype, np.integer):
+        return df
+    df = df.assign(**{groupKey: organDict.decode(df[groupKey].values)})
+    if sort:
+        df = df.sort_values([groupKey, "date"], kind="mergesort").reset_index(drop=True)
+    return df
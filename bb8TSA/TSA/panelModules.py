@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Array representation of the binned time series shared by the vectorised computations.
+"""
+import numpy as np
+import pandas as pd
+
+
+# Width of the time bins in days, used to express the dates in number of bins.
+binDays = {"W": 7., "2W": 14., "3W": 21., "M": 30.}
+
+
+def date_to_num(dates, freq=None):
+    """ Converts dates to number of days since 1970-01-01 (as matplotlib.dates.date2num),
+        divided by the bin width if freq is given.
+
+    Parameters
+    ----------
+    dates : series or array of datetime64
+    freq : str, optional
+        The bin size in weeks or a month {"W", "2W", "3W", "M"}
+
+    Return
+    ----------
+    Array of floats
+    """
+    days = np.asarray(dates, dtype="datetime64[ns]").astype(np.int64) / 86400.e9
+    if freq is not None:
+        days = days / binDays[freq]
+    return days
+
+
+def bin_labels(dates, freq):
+    """ Time bins of distinct dates, with the bins of pd.Grouper(freq=freq) used by
+        BinnedOrganisations.make_binned_time_series (before the offset of the labels).
+
+    Parameters
+    ----------
+    dates : sorted array of distinct datetime64
+    freq : str
+        The bin size in weeks or a month {"W", "2W", "3W", "M"}
+
+    Return
+    ----------
+    Array of the bin labels and array of the bin index of each date
+    """
+    df_dates = pd.DataFrame({"date": dates})
+    labels, binOf = [], np.zeros(len(dates), dtype=np.int64)
+    for label, grp in df_dates.groupby(pd.Grouper(key="date", freq=freq)):
+        binOf[grp.index.values] = len(labels)
+        labels.append(label)
+    return np.array(labels, dtype="datetime64[ns]"), binOf
+
+
+def bin_index(dates, freq):
+    """ Position of the dates on the regular grid of the time bins, 0 for the earliest bin.
+
+    Parameters
+    ----------
+    dates : series or array of datetime64 (bin dates of make_binned_time_series)
+    freq : str
+        The bin size in weeks or a month {"W", "2W", "3W", "M"}
+
+    Return
+    ----------
+    Array of int
+    """
+    dates = np.asarray(dates, dtype="datetime64[ns]")
+    if len(dates) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if freq == "M":
+        months = dates.astype("datetime64[M]").astype(np.int64)
+        return months - months.min()
+    days = dates.astype("datetime64[D]").astype(np.int64)
+    return (days - days.min()) // int(binDays[freq])
+
+
+def next_bin_dates(lastDate, freq, horizon):
+    """ Dates of the horizon bins following the bin of lastDate, with the same offset to the
+        end of the month (freq "M") or the same spacing (weekly bins).
+
+    :param lastDate: datetime64
+        bin date of make_binned_time_series
+    :param freq: str
+    :param horizon: int
+    :return: array of datetime64
+    """
+    lastDate = np.datetime64(lastDate, "D")
+    steps = np.arange(1, horizon + 1)
+    if freq == "M":
+        month = lastDate.astype("datetime64[M]")
+        toEnd = (month + 1).astype("datetime64[D]") - lastDate
+        return ((month + 1 + steps).astype("datetime64[D]") - toEnd).astype("datetime64[ns]")
+    return (lastDate + steps * np.timedelta64(int(binDays[freq]), "D")).astype("datetime64[ns]")
+
+
+class BinnedPanel:
+    """ Binned time series kept as contiguous arrays sorted by organisation and date.
+        The points of the i-th organisation are x[offsets[i]:offsets[i+1]].
+
+    Parameters
+    ----------
+    df_c : dataframe
+        stacked dataframes of all time series (binned data).
+    freq : str
+        The bin size in weeks or a month {"W", "2W", "3W", "M"}
+    groupKey : str
+        Column containing the name of the organisations
+    targetCol : str
+        Column containing the bin counts
+
+    Attributes
+    ----------
+    names : array of organisation names
+    offsets : array of int, start of each organisation in the point arrays (size len(names)+1)
+    counts : array of int, number of points per organisation
+    codes : array of int, organisation index of each point
+    dates : array of datetime64, bin dates
+    x : array of float, bin dates in number of bins (see date_to_num)
+    y : array of float, bin counts
+    """
+
+    def __init__(self, df_c, freq, groupKey="organName", targetCol="binCount"):
+        df = df_c[[groupKey, "date", targetCol]].sort_values([groupKey, "date"], kind="mergesort")
+        names, codes = np.unique(df[groupKey].values, return_inverse=True)
+        self.freq = freq
+        self.names = names
+        self.codes = codes
+        self.counts = np.bincount(codes, minlength=len(names))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        self.dates = df["date"].values
+        self.x = date_to_num(self.dates, freq)
+        self.y = df[targetCol].values.astype(float)
+
+    def shot_noise(self):
+        """
+        Return
+        ----------
+        Poisson uncertainty of each bin count (as Tendance.prep_to_fit)
+        """
+        return np.round(np.sqrt(self.y), 0)
+
+    def segment_sum(self, values, axis=-1):
+        """ Sums values per organisation.
+
+        Parameters
+        ----------
+        values : array whose last (or given) axis runs over the points
+
+        Return
+        ----------
+        Array whose last (or given) axis runs over the organisations
+        """
+        return np.add.reduceat(values, self.offsets[:-1], axis=axis)
+
+    def to_frame(self, **columns):
+        """
+        Parameters
+        ----------
+        columns : arrays with one value per organisation
+
+        Return
+        ----------
+        Dataframe with organName and the given columns
+        """
+        df = pd.DataFrame({"organName": self.names})
+        for col, values in columns.items():
+            df[col] = values
+        return df
+
+
+def lin_fit_from_sums(S, Sx, Sy, Sxx, Sxy, Syy, n):
+    """ Weighted least squares line from the weighted sums of the points.
+        With unit weights it gives the scipy.stats.linregress estimates,
+        with 1/err^2 weights the scipy.optimize.curve_fit ones (relative sigma).
+
+    Parameters
+    ----------
+    S, Sx, Sy, Sxx, Sxy, Syy : arrays
+        sums of w, w*x, w*y, w*x^2, w*x*y, w*y^2
+    n : array
+        number of points
+
+    Return
+    ----------
+    slope, intercept, slope error and the reduced chi2 (arrays)
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = S * Sxx - Sx * Sx
+        slope = (S * Sxy - Sx * Sy) / delta
+        intercept = (Sxx * Sy - Sx * Sxy) / delta
+        chi2 = Syy - 2. * slope * Sxy - 2. * intercept * Sy + slope * slope * Sxx \
+            + 2. * slope * intercept * Sx + intercept * intercept * S
+        xi2 = np.clip(chi2, 0., None) / (n - 2.)
+        slopeErr = np.sqrt(S / delta * xi2)
+    return slope, intercept, slopeErr, xi2
+
+
+def huber_line_fit(panel, simpFit=True, k=1.345, maxIter=50, tol=1.e-4, minScale=1.):
+    """ Robust line (Huber loss) of each organisation of a panel through iteratively reweighted
+        least squares. Each iteration is one weighted solve from the grouped sums of the
+        organisations which have not converged yet (lin_fit_from_sums).
+        A bin whose normalised residual exceeds k robust standard deviations gets the weight
+        k/|u| instead of 1.
+
+    Parameters
+    ----------
+    panel : BinnedPanel
+    simpFit : boolean
+        True : unit base weights, False : residuals normalised by the shot noises.
+    k : float
+        Huber threshold in robust standard deviations.
+    maxIter : int
+        Maximum number of iterations.
+    tol : float
+        Relative change of the slope and the intercept below which an organisation has converged.
+    minScale : float
+        Floor of the robust standard deviation (in counts, or in shot noises) : with more than
+        half of the bins on the line, the median absolute residual is 0 and all the other bins
+        would get a zero weight.
+
+    Return
+    ----------
+    slope, intercept (at x = 0), slope error, reduced chi2 and number of iterations per
+    organisation, Huber weight of each point (arrays)
+    """
+    nOrg = len(panel.names)
+    codes = panel.codes
+    # Centering the dates per organisation keeps the sums well conditioned
+    xMean = (panel.segment_sum(panel.x) / panel.counts)
+    x = panel.x - xMean[codes]
+    y = panel.y
+    sigma2 = np.ones_like(y) if simpFit else panel.shot_noise() ** 2
+    h = np.ones_like(y)
+
+    def solve(points):
+        w = h[points] / sigma2[points]
+        c, xp, yp = codes[points], x[points], y[points]
+        sums = [np.bincount(c, weights=v, minlength=nOrg)
+                for v in [w, w * xp, w * yp, w * xp * xp, w * xp * yp, w * yp * yp]]
+        return lin_fit_from_sums(*sums, panel.counts)
+
+    slope, intercept, slopeErr, xi2 = solve(np.arange(len(y)))
+    numIter = np.zeros(nOrg, dtype=np.int64)
+    active = panel.counts > 2
+    for it in range(maxIter):
+        if not active.any():
+            break
+        points = np.nonzero(active[codes])[0]
+        c = codes[points]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            e = (y[points] - slope[c] * x[points] - intercept[c]) / np.sqrt(sigma2[points])
+            # robust scale of the normalised residuals (median absolute residual)
+            order = np.lexsort((np.abs(e), c))
+            absSorted = np.abs(e)[order]
+            start = np.searchsorted(c[order], np.nonzero(active)[0])
+            n = panel.counts[active]
+            mad = .5 * (absSorted[start + (n - 1) // 2] + absSorted[start + n // 2])
+            scale = np.zeros(nOrg)
+            scale[active] = np.maximum(1.4826 * mad, minScale)
+            u = np.abs(e) / scale[c]
+            h[points] = np.where(u > k, k / u, 1.)
+
+        s, b, sErr, x2 = solve(points)
+        act = np.nonzero(active)[0]
+        with np.errstate(invalid="ignore"):
+            done = (np.abs(s[act] - slope[act]) <= tol * (np.abs(slope[act]) + tol)) & \
+                   (np.abs(b[act] - intercept[act]) <= tol * (np.abs(intercept[act]) + tol))
+        slope[act], intercept[act], slopeErr[act], xi2[act] = s[act], b[act], sErr[act], x2[act]
+        numIter[act] = it + 1
+        active[act[done | ~np.isfinite(s[act])]] = False
+    return slope, intercept - slope * xMean, slopeErr, xi2, numIter, h
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Batch rendering of the time series plots of selected organisations : binned counts, fitted
+tendency line and shock events, drawn with the headless Agg backend in a pool of processes.
+Each worker draws all its plots on one figure, only the data of the artists change between
+two organisations. An index page links the plots of each organisation list.
+"""
+import html
+import re
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count, makedirs, path
+
+import numpy as np
+import pandas as pd
+
+from bb8TSA.TSA.kernelModules import line_fit
+from bb8TSA.TSA.panelModules import BinnedPanel, huber_line_fit
+
+
+# Organisation lists of a TimeSeriesAnalysis instance which can be plotted
+listNames = ["leaders", "mostVar", "shocks", "constrained"]
+
+
+def report_lists(tsa, lists):
+    """
+    :param tsa: fitted TimeSeriesAnalysis instance
+    :param lists: list of names of listNames, or dict {title: list of organisation names}
+    :return: dict {title: list of organisation names}
+    """
+    if isinstance(lists, dict):
+        return {title: list(names) for title, names in lists.items()}
+    getters = {"leaders": tsa.get_leader_list_DFs,
+               "mostVar": tsa.get_most_var_list_DFs,
+               "shocks": tsa.compute_schock_list_DFs,
+               "constrained": lambda: tsa.constrained_tendance_DFs()["organName"].tolist()}
+    for name in lists:
+        if name not in getters:
+            raise ValueError("report_lists : list should be one of : {}".format(listNames))
+    return {name: getters[name]() for name in lists}
+
+
+def file_stem(organName):
+    return re.sub(r"[^\w-]", "_", str(organName))
+
+
+def plot_payloads(df_c, df_tendance, df_events, organNames, freq, simpFit=True, fitMode="ls"):
+    """ Data of the plots, sliced out of the stacked time series in one pass.
+        The lines are fitted again as in the tendency table (kernelModules.line_fit or
+        panelModules.huber_line_fit) : its slopes are rounded angles.
+
+    Parameters
+    ----------
+    df_c : dataframe
+        stacked binned time series
+    df_tendance : dataframe
+        tendency table (organName, slope, slopeErr) for the titles
+    df_events : dataframe
+        shock events (StatIndic.compute_shock_events)
+    organNames : list of str
+    freq : str
+    simpFit : boolean
+        True to fit the lines excluding the shot noises, False otherwise
+    fitMode : str
+        "ls" or "huber" (see Tendance.compute_fit)
+
+    Return
+    ----------
+    List of dict (organName, dates, y, lineY, shockDates, shockY, title) : lineY is the fitted line
+    at the bin dates.
+    """
+    panel = BinnedPanel(df_c[df_c["organName"].isin(organNames)], freq)
+    if fitMode == "huber":
+        a, b, _, _, _, _ = huber_line_fit(panel, simpFit=simpFit)
+    else:
+        w = np.ones_like(panel.y) if simpFit else 1. / panel.shot_noise() ** 2
+        a, b, _, _, _ = line_fit(panel.x, panel.y, w, panel.offsets)
+    fits = df_tendance.set_index("organName").reindex(panel.names)
+    events = df_events[df_events["organName"].isin(organNames)].groupby("organName")
+
+    payloads = []
+    for i, name in enumerate(panel.names):
+        start, end = panel.offsets[i], panel.offsets[i + 1]
+        shocks = events.get_group(name) if name in events.groups else df_events.iloc[:0]
+        payloads.append({"organName": name,
+                         "dates": panel.dates[start:end],
+                         "y": panel.y[start:end],
+                         "lineY": a[i] * panel.x[start:end] + b[i],
+                         "shockDates": shocks["date"].values,
+                         "shockY": shocks["binCount"].values,
+                         "title": "{} : slope {} +/- {} deg".format(name, fits["slope"].values[i],
+                                                                    fits["slopeErr"].values[i])})
+    return payloads
+
+
+# Figure of the worker process (see _init_worker)
+_canvas = None
+
+
+def _init_worker(figsize, dpi):
+    """ Creates the figure, the axes and the artists reused for all the plots of the process. """
+    global _canvas
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.dates import AutoDateLocator, ConciseDateFormatter
+    from matplotlib.figure import Figure
+    from matplotlib.ticker import MaxNLocator
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    # few ticks : most of the drawing time goes to the axis labels
+    locator = AutoDateLocator(minticks=3, maxticks=6)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(ConciseDateFormatter(locator))
+    ax.yaxis.set_major_locator(MaxNLocator(5))
+    counts, = ax.plot([], [], "o-", ms=3, lw=1, label="binCount")
+    line, = ax.plot([], [], "--", lw=1.5, label="tendency")
+    shocks, = ax.plot([], [], "x", color="red", ms=9, mew=2, label="shock")
+    ax.set_ylabel("binCount")
+    ax.legend(loc="upper left", fontsize="small")
+    # margins computed once, with room for the title
+    ax.set_title("organisation", fontsize="medium")
+    fig.tight_layout()
+    _canvas = (fig, ax, counts, line, shocks)
+
+
+def _render_chunk(payloads, outDir, formats):
+    """
+    :return: list of (organName, file names) of the rendered plots
+    """
+    from matplotlib.dates import date2num
+
+    fig, ax, counts, line, shocks = _canvas
+    rendered = []
+    for p in payloads:
+        x = date2num(p["dates"])
+        counts.set_data(x, p["y"])
+        line.set_data(x, p["lineY"])
+        shocks.set_data(date2num(p["shockDates"]), p["shockY"])
+        ax.set_title(p["title"], fontsize="medium")
+        ax.relim()
+        ax.autoscale_view()
+        files = []
+        for fmt in formats:
+            files.append(file_stem(p["organName"]) + "." + fmt)
+            # fast png compression : the encoder is the second cost after the axes
+            fig.savefig(path.join(outDir, files[-1]), format=fmt,
+                        **({"pil_kwargs": {"compress_level": 1}} if fmt == "png" else {}))
+        rendered.append((p["organName"], files))
+    return rendered
+
+
+def render_plots(payloads, outDir, formats=("png",), maxWorkers=None, figsize=(8, 4), dpi=80):
+    """ Renders the plots in a pool of processes (in the current process if maxWorkers is 1).
+
+    Parameters
+    ----------
+    payloads : list of dict
+        see plot_payloads
+    outDir : str
+    formats : list of str
+        "png" and/or "svg"
+    maxWorkers : int, optional
+        number of processes, the number of CPUs by default
+
+    Return
+    ----------
+    dict {organName: list of file names}
+    """
+    makedirs(outDir, exist_ok=True)
+    maxWorkers = min(maxWorkers or cpu_count() or 1, max(len(payloads), 1))
+    print("render_plots : Rendering", len(payloads), "plots in", outDir, "with", maxWorkers, "processes ...")
+    if maxWorkers == 1:
+        _init_worker(figsize, dpi)
+        return dict(_render_chunk(payloads, outDir, formats))
+
+    # a few chunks per process to balance the load
+    chunks = np.array_split(np.arange(len(payloads)), 4 * maxWorkers)
+    rendered = {}
+    with ProcessPoolExecutor(max_workers=maxWorkers, initializer=_init_worker, initargs=(figsize, dpi)) as pool:
+        futures = [pool.submit(_render_chunk, [payloads[i] for i in chunk], outDir, formats)
+                   for chunk in chunks if len(chunk)]
+        for future in futures:
+            rendered.update(future.result())
+    return rendered
+
+
+def write_index(outDir, lists, rendered, fit_info, title="Time series report"):
+    """ Writes index.html : one table per organisation list with the classification of each
+        organisation and a link to its plots.
+
+    :param lists: dict {title: list of organisation names}
+    :param rendered: dict {organName: list of file names} (render_plots)
+    :param fit_info: dataframe (organName, tendency, variability, count_shoot, slope, slopeErr)
+    :return: path of the index page
+    """
+    info = fit_info.set_index("organName")
+    columns = [col for col in ["mean_citation", "slope", "slopeErr", "tendency", "variability", "count_shoot"]
+               if col in info.columns]
+    lines = ["<!DOCTYPE html>", "<html><head><meta charset='utf-8'><title>{}</title>".format(html.escape(title)),
+             "<style>body{font-family:sans-serif} td,th{padding:2px 8px} img{height:120px}</style>",
+             "</head><body>", "<h1>{}</h1>".format(html.escape(title))]
+    for listTitle, names in lists.items():
+        lines.append("<h2>{} ({})</h2>".format(html.escape(listTitle), len(names)))
+        lines.append("<table><tr><th>#</th><th>organName</th>" +
+                     "".join("<th>{}</th>".format(col) for col in columns) + "<th>plot</th></tr>")
+        for rank, name in enumerate(names, 1):
+            files = rendered.get(name, [])
+            row = info.loc[name, columns] if name in info.index else pd.Series(index=columns, dtype=object)
+            cells = "".join("<td>{}</td>".format(html.escape(str(v))) for v in row.values)
+            links = " ".join("<a href='{0}'>{1}</a>".format(html.escape(f), f.rsplit(".", 1)[-1]) for f in files)
+            thumb = "<a href='{0}'><img src='{0}'></a> ".format(html.escape(files[0])) \
+                if files and files[0].endswith(".png") else ""
+            lines.append("<tr><td>{}</td><td>{}</td>{}<td>{}{}</td></tr>".format(rank, html.escape(str(name)),
+                                                                             cells, thumb, links))
+        lines.append("</table>")
+    lines.append("</body></html>")
+
+    indexPath = path.join(outDir, "index.html")
+    with open(indexPath, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    return indexPath
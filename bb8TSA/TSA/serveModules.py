@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP server (TCP or Unix socket) answering queries on a result snapshot
+written by TimeSeriesAnalysis.write_snapshot. Standard library only (asyncio).
+
+Routes (GET, JSON answers) :
+    /organisation/<organName>
+    /leaders?n=120
+    /most_variable?minNumBins=6&meanCount=20&n=120
+    /shocks?n=120
+    /tendency?tendency=Increase&variability=high&count_shoot=Yes&maxP0=.05&minNumBins=6&minMean=20&limit=100
+    /status
+"""
+import asyncio
+import json
+import os
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import numpy as np
+
+from bb8TSA.FilesPrepration.artefactModules import read_artefact
+
+
+def _to_json(obj):
+    return json.dumps(obj, default=lambda o: o.item() if hasattr(o, "item") else str(o)).encode()
+
+
+def _snapshot_version(fpath):
+    st = os.stat(fpath)
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class ResultSnapshot:
+    """ Result table of a fitted analysis kept in memory with the indexes needed by the queries.
+
+    Parameters
+    ----------
+    fpath : str
+        snapshot file (TimeSeriesAnalysis.write_snapshot)
+
+    Attributes
+    ----------
+    version : tuple
+        identifies the snapshot file (inode, modification time, size)
+    """
+
+    def __init__(self, fpath):
+        self.version = _snapshot_version(fpath)
+        df = read_artefact(fpath).sort_values("citation_rank").reset_index(drop=True)
+        records = df.astype(object).where(df.notnull(), None).to_dict("records")
+
+        self.names = df["organName"].values
+        self._records = records
+        self._byName = {rec["organName"]: _to_json(rec) for rec in records}
+        self._cols = {col: df[col].values for col in ["tendency", "variability", "count_shoot", "p_0",
+                                                      "numBins", "mean_citation"]}
+        # most variable first (as StatIndic.get_most_var_list)
+        self._varOrder = np.argsort(-df["sigmasRatio"].values, kind="mergesort")
+        self._shocks = self.names[self._cols["count_shoot"] == "Yes"]
+
+    def organisation(self, name):
+        """
+        :return: encoded JSON row of an organisation, None if not found
+        """
+        return self._byName.get(name)
+
+    def leaders(self, n=120):
+        return self.names[:n].tolist()
+
+    def shocks(self, n=120):
+        return self._shocks[:n].tolist()
+
+    def most_variable(self, minNumBins=6, meanCount=20, n=120):
+        order = self._varOrder
+        cond = (self._cols["numBins"][order] > minNumBins) & (self._cols["mean_citation"][order] > meanCount)
+        return self.names[order[cond][:n]].tolist()
+
+    def tendency(self, tendency=None, variability=None, count_shoot=None, maxP0=None, minNumBins=None,
+                 minMean=None, limit=100):
+        """
+        :return: rows (sorted by citation rank) satisfying all the given conditions
+        """
+        cond = np.ones(len(self.names), dtype=bool)
+        for col, value in [("tendency", tendency), ("variability", variability), ("count_shoot", count_shoot)]:
+            if value is not None:
+                cond &= self._cols[col] == value
+        if maxP0 is not None:
+            cond &= self._cols["p_0"] <= maxP0
+        if minNumBins is not None:
+            cond &= self._cols["numBins"] >= minNumBins
+        if minMean is not None:
+            cond &= self._cols["mean_citation"] >= minMean
+        return [self._records[i] for i in np.nonzero(cond)[0][:limit]]
+
+
+class ResultServer:
+    """ asyncio HTTP/1.1 server over a ResultSnapshot.
+        The snapshot file is polled and, when a new one appears (written atomically, see
+        TimeSeriesAnalysis.write_snapshot), it is loaded in a worker thread and swapped in at once :
+        each request is answered from a single snapshot.
+
+    Parameters
+    ----------
+    fpath : str
+        snapshot file
+    host, port :
+        TCP address (used if unixSocket is None). port=0 picks a free port.
+    unixSocket : str, optional
+        path of a Unix socket to listen on instead of TCP.
+    pollInterval : float
+        seconds between two checks of the snapshot file.
+    """
+
+    def __init__(self, fpath, host="127.0.0.1", port=8080, unixSocket=None, pollInterval=1.):
+        print("ResultServer class initialised.")
+        self.fpath = fpath
+        self.host = host
+        self.port = port
+        self.unixSocket = unixSocket
+        self.pollInterval = pollInterval
+        self.snapshot = None
+        self._server = None
+        self._watcher = None
+
+    async def start(self):
+        """ Loads the snapshot and starts listening.
+        """
+        self.snapshot = ResultSnapshot(self.fpath)
+        if self.unixSocket is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.unixSocket)
+            print("ResultServer : listening on", self.unixSocket)
+        else:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+            print("ResultServer : listening on", self.host, ":", self.port)
+        self._watcher = asyncio.ensure_future(self._watch())
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def reload(self):
+        """ Loads the snapshot file again if it changed.
+        :return: True if a new snapshot has been swapped in.
+        """
+        try:
+            version = _snapshot_version(self.fpath)
+        except FileNotFoundError:
+            return False
+        if version == self.snapshot.version:
+            return False
+        loop = asyncio.get_event_loop()
+        snapshot = await loop.run_in_executor(None, ResultSnapshot, self.fpath)
+        self.snapshot = snapshot
+        print("ResultServer : snapshot reloaded.")
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.pollInterval)
+            try:
+                await self.reload()
+            except Exception as err:
+                # a broken snapshot leaves the current one in service
+                print("ResultServer : Warning : reload failed :", err)
+
+    def answer(self, target):
+        """ Answers a GET request.
+        :param target: str
+            request target (path and query string)
+        :return: (status, encoded JSON body)
+        """
+        snapshot = self.snapshot
+        url = urlsplit(target)
+        route = url.path.rstrip("/").split("/")[1:] or [""]
+        args = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            if route[0] == "organisation" and len(route) == 2:
+                body = snapshot.organisation(unquote(route[1]))
+                return (200, body) if body is not None else (404, _to_json({"error": "unknown organisation"}))
+            if route == ["leaders"]:
+                return 200, _to_json(snapshot.leaders(int(args.get("n", 120))))
+            if route == ["shocks"]:
+                return 200, _to_json(snapshot.shocks(int(args.get("n", 120))))
+            if route == ["most_variable"]:
+                return 200, _to_json(snapshot.most_variable(minNumBins=int(args.get("minNumBins", 6)),
+                                                            meanCount=float(args.get("meanCount", 20)),
+                                                            n=int(args.get("n", 120))))
+            if route == ["tendency"]:
+                conv = {"maxP0": float, "minNumBins": int, "minMean": float, "limit": int}
+                query = {key: conv.get(key, str)(value) for key, value in args.items()}
+                return 200, _to_json(snapshot.tendency(**query))
+            if route == ["status"]:
+                return 200, _to_json({"snapshot": self.fpath, "version": snapshot.version,
+                                      "organisations": len(snapshot.names)})
+        except (TypeError, ValueError) as err:
+            return 400, _to_json({"error": str(err)})
+        except Exception as err:
+            # a failing query is answered, the connection and the server stay up
+            print("ResultServer : Error : answering", target, "failed :", repr(err))
+            return 500, _to_json({"error": "internal error"})
+        return 404, _to_json({"error": "unknown route"})
+
+    async def _handle(self, reader, writer):
+        reasons = {200: b"OK", 400: b"Bad Request", 404: b"Not Found", 405: b"Method Not Allowed",
+                   500: b"Internal Server Error"}
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                line, _, headers = head.partition(b"\r\n")
+                method, target, version = line.decode("latin-1").split(" ", 2)
+                if method == "GET":
+                    status, body = self.answer(target)
+                else:
+                    status, body = 405, _to_json({"error": "only GET is supported"})
+                keepAlive = version.strip() == "HTTP/1.1" and b"connection: close" not in headers.lower()
+                writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n%s\r\n"
+                             % (status, reasons[status], len(body),
+                                b"" if keepAlive else b"Connection: close\r\n") + body)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def query(target, host="127.0.0.1", port=8080, unixSocket=None):
+    """ Minimal client : sends one GET request.
+
+    :param target: str
+        request target, e.g. "/leaders?n=10"
+    :return: (status, decoded JSON body)
+    """
+    if unixSocket is not None:
+        reader, writer = await asyncio.open_unix_connection(unixSocket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    writer.write(("GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n" % (target, host)).encode())
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = int([h for h in head.split(b"\r\n") if h.lower().startswith(b"content-length")][0].split(b":")[1])
+    body = await reader.readexactly(length)
+    writer.close()
+    return status, json.loads(body)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Approximate binning of very large feeds : count-min sketches per time bin and exact counters
+only for the organisations which can reach the minimum total count (heavy hitters).
+"""
+import numpy as np
+import pandas as pd
+
+from bb8TSA.TSA.panelModules import bin_labels
+
+
+class CountMinSketch:
+    """ Count-min sketch of the counts per (key, time bin) : depth rows of width counters per bin.
+        With width = e / epsilon and depth = ln(1 / delta), an estimate exceeds the true count
+        by more than epsilon * (total count of the bin) with a probability lower than delta,
+        and is never lower than the true count.
+
+    Parameters
+    ----------
+    width : int
+        number of counters per row, rounded up to a power of 2.
+    depth : int
+        number of rows (hash functions).
+    nBins : int
+        number of time bins.
+    seed : int
+    """
+
+    def __init__(self, width=2 ** 16, depth=4, nBins=1, seed=0):
+        self.shift = 64 - int(np.ceil(np.log2(width)))
+        self.width = 2 ** (64 - self.shift)
+        self.depth = depth
+        self.nBins = nBins
+        self.table = np.zeros((depth, nBins, self.width), dtype=np.int64)
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 63, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=depth, dtype=np.uint64)
+
+    def columns(self, keyHashes):
+        """
+        :param keyHashes: array of uint64 (see hash_keys)
+        :return: array (depth, len(keyHashes)) of counter indexes
+        """
+        return ((self._a[:, None] * keyHashes[None, :] + self._b[:, None]) >> np.uint64(self.shift)) \
+            .astype(np.int64)
+
+    def add(self, columns, bins, counts):
+        """
+        :param columns: counter indexes of the keys (see columns)
+        :param bins: array of bin indexes
+        :param counts: array of counts
+        """
+        size = self.nBins * self.width
+        for d in range(self.depth):
+            self.table[d] += np.bincount(bins * self.width + columns[d], weights=counts, minlength=size) \
+                .astype(np.int64).reshape(self.nBins, self.width)
+
+    def query(self, columns):
+        """
+        :param columns: counter indexes of the keys (see columns)
+        :return: array (number of keys, nBins) of estimated counts
+        """
+        estimates = self.table[0][:, columns[0]]
+        for d in range(1, self.depth):
+            estimates = np.minimum(estimates, self.table[d][:, columns[d]])
+        return estimates.T
+
+    def bin_totals(self):
+        return self.table[0].sum(axis=1)
+
+    def error_bounds(self):
+        """
+        :return: (epsilon, delta, array of the additive error bound of each bin)
+        """
+        epsilon = np.e / self.width
+        return epsilon, np.exp(-self.depth), epsilon * self.bin_totals()
+
+
+def hash_keys(names):
+    """
+    :param names: array of str
+    :return: array of uint64
+    """
+    return pd.util.hash_array(np.asarray(names, dtype=object))
+
+
+class SketchBinning:
+    """ Streaming binning of (organName, bin, count) records.
+        All the records go to a count-min sketch per time bin and to a sketch of the totals.
+        An organisation gets exact counters once the estimate of its total reaches minTotal :
+        its past bins are taken from the sketches (over-estimates, within the error bounds),
+        its later records are counted exactly. The memory of the sketches is fixed by
+        width * depth * (number of bins + 1), the exact counters grow with the number of
+        organisations which can pass the thresholds only.
+
+    Parameters
+    ----------
+    labels : array of datetime64
+        labels of the time bins
+    minTotal : float
+        minimum total count of an organisation (minNumBins * meanCount for the organisations which
+        can pass the thresholds of TimeSeriesAnalysis).
+    width, depth, seed :
+        sketch parameters (see CountMinSketch)
+
+    Attributes
+    ----------
+    names : array of the organisations with exact counters
+    """
+
+    def __init__(self, labels, minTotal, width=2 ** 16, depth=4, seed=0):
+        self.labels = labels
+        self.minTotal = minTotal
+        self.sketch = CountMinSketch(width, depth, len(labels), seed)
+        self.totals = CountMinSketch(width, depth, 1, seed)
+        self.names = np.array([], dtype=object)
+        self._index = pd.Index([], dtype=object)
+        self._counts = np.zeros((0, len(labels)), dtype=np.int64)
+        self._errors = np.zeros((0, len(labels)))
+
+    def ingest(self, names, bins, counts):
+        """ Adds a chunk of records.
+
+        :param names: array of organisation names
+        :param bins: array of bin indexes (in labels)
+        :param counts: array of counts
+        """
+        codes, uniqueNames = pd.factorize(names)
+        columns = self.sketch.columns(hash_keys(uniqueNames))
+        nBins = len(self.labels)
+
+        # Promotion of the organisations whose total (sketch + this chunk) reaches minTotal
+        exactRow = self._index.get_indexer(uniqueNames)
+        chunkTotals = np.bincount(codes, weights=counts, minlength=len(uniqueNames))
+        candidates = np.nonzero(exactRow < 0)[0]
+        estTotals = self.totals.query(columns[:, candidates])[:, 0] + chunkTotals[candidates]
+        promoted = candidates[estTotals >= self.minTotal]
+        if len(promoted):
+            past = self.sketch.query(columns[:, promoted])
+            _, _, bounds = self.sketch.error_bounds()
+            self.names = np.concatenate([self.names, uniqueNames[promoted]])
+            self._index = pd.Index(self.names)
+            self._counts = np.concatenate([self._counts, past])
+            self._errors = np.concatenate([self._errors, np.where(past > 0, bounds[None, :], 0.)])
+            exactRow[promoted] = np.arange(len(self.names) - len(promoted), len(self.names))
+
+        # Exact counts of the organisations with counters
+        rows = exactRow[codes]
+        isExact = rows >= 0
+        self._counts += np.bincount(rows[isExact] * nBins + bins[isExact], weights=counts[isExact],
+                                    minlength=self._counts.size).astype(np.int64).reshape(self._counts.shape)
+
+        self.sketch.add(columns[:, codes], bins, counts)
+        self.totals.add(columns[:, codes], np.zeros(len(codes), dtype=np.int64), counts)
+
+    def to_frame(self):
+        """
+        :return: binned dataframe (organName, date, binCount, errorBound) of the organisations with
+            exact counters, sorted by organName and date. errorBound is the additive error bound of
+            the bins counted before the promotion (0 for exact bins).
+        """
+        order = np.argsort(self.names, kind="mergesort")
+        rows, bins = np.nonzero(self._counts[order] > 0)
+        return pd.DataFrame({"organName": self.names[order][rows],
+                             "date": self.labels[bins],
+                             "binCount": self._counts[order][rows, bins],
+                             "errorBound": np.round(self._errors[order][rows, bins], 1)})
+
+    def error_table(self):
+        """
+        :return: dataframe of the sketch error bounds per time bin (date, total, epsilon, delta, bound)
+        """
+        epsilon, delta, bounds = self.sketch.error_bounds()
+        return pd.DataFrame({"date": self.labels, "total": self.sketch.bin_totals(),
+                             "epsilon": epsilon, "delta": delta, "bound": bounds})
+
+
+def sketch_binned_time_series(df_organs, freq, minTotal, width=2 ** 16, depth=4, chunkSize=1000000, seed=0):
+    """ Approximate binning of a dataframe read as a stream of chunks (see SketchBinning).
+
+    Parameters
+    ----------
+    df_organs : dataframe
+        organName, date and count columns
+    freq : str
+        The bin size in weeks or a month {"W", "2W", "3W", "M"}
+    minTotal : float
+        total count from which an organisation gets exact counters
+    width, depth, seed :
+        sketch parameters (see CountMinSketch)
+    chunkSize : int
+        number of records ingested at once
+
+    Return
+    ----------
+    SketchBinning instance (to_frame, error_table, names)
+    """
+    dates = df_organs["date"].values.astype("datetime64[ns]")
+    uniqueDates, dateIndex = np.unique(dates, return_inverse=True)
+    labels, binOf = bin_labels(uniqueDates, freq)
+    binIndex = binOf[dateIndex]
+
+    sb = SketchBinning(labels, minTotal, width=width, depth=depth, seed=seed)
+    names = df_organs["organName"].values
+    counts = df_organs["count"].values
+    for start in range(0, len(names), chunkSize):
+        sb.ingest(names[start:start + chunkSize], binIndex[start:start + chunkSize],
+                  counts[start:start + chunkSize])
+    return sb
@@ -8,6 +8,8 @@ Created on Tue Nov 24 13:13:33 2020
 import numpy as np
 import pandas as pd
 
+from bb8TSA.TSA.panelModules import BinnedPanel, bin_index, binDays
+
 
 def compute_interpol(df, **gt):
     """ For a given date it computes a binCount by interpolating the binCounts of the previous and next dates
@@ -80,6 +82,15 @@ class StatIndic:
         """
 
         print("---> Calling compute_stat : variability search through internal dispersion method.")
+        backend = getattr(self, "_backend", None)
+        if backend is not None:
+            print("Arrow backend : interpolation", "active" if intp else "inactive")
+            return backend.compute_stat(df, intp=intp, numBins=numBins, groupKey=gt["groupKey"],
+                                        targetCol=gt["targetCol"])
+        if getattr(self, "accelerate", False):
+            from bb8TSA.TSA.kernelModules import KERNELS, stat_table
+            print("Accelerated kernels (" + KERNELS + ") : interpolation", "active" if intp else "inactive")
+            return stat_table(df, intp=intp, numBins=numBins, groupKey=gt["groupKey"], targetCol=gt["targetCol"])
         if (intp):
             print("Interpolation : active ")
         else:
@@ -240,5 +251,286 @@ class StatIndic:
         """
         return df_stat["organName"].tolist()[:nLeader]
 
+
+    def compute_shock_events(self, df_c, halfWindow=3, zSeuil=5., freq="M"):
+        """ Localises the shocks in time : each bin is compared to the median of the bins around it
+            through a robust z-score, (binCount - median) / (1.4826 * MAD).
+            The scale is bounded from below by the shot noise sqrt(median) so that flat
+            series do not give infinite scores.
+            All the bins of all the organisations are scored in one vectorised pass.
+
+        Parameters
+        ----------
+        df_c : dataframe
+            stacked dataframes of all time series (binned data).
+        halfWindow : int
+            The window includes halfWindow bins on each side of the scored bin
+            (fewer at the edges of a time serie).
+        zSeuil : float
+            A bin is a shock if its score is larger than zSeuil.
+        freq : str
+            The bin size in weeks or a month {"W", "2W", "3W", "M"}
+
+        Return
+        ----------
+         Dataframe of shock events (organName, date, binCount, median, score) sorted by date
+        """
+
+        print("---> Calling compute_shock_events : robust rolling z-scores of all bins.")
+        print("    Half window :", halfWindow, "bins, score threshold :", zSeuil)
+        panel = BinnedPanel(df_c, freq)
+        nPoints = len(panel.y)
+
+        # Index of the neighbours of each bin, NaN outside of its own time serie
+        shifts = np.arange(-halfWindow, halfWindow + 1)
+        idx = np.arange(nPoints)[:, None] + shifts[None, :]
+        inSerie = (idx >= panel.offsets[panel.codes][:, None]) & \
+                  (idx < panel.offsets[panel.codes + 1][:, None])
+        idx = np.clip(idx, 0, nPoints - 1)
+
+        def rolling_median(values):
+            # NaNs are sorted at the end of each row
+            values = np.sort(np.where(inSerie, values, np.nan), axis=1)
+            nValid = inSerie.sum(axis=1)
+            rows = np.arange(nPoints)
+            return .5 * (values[rows, (nValid - 1) // 2] + values[rows, nValid // 2])
+
+        print("    Computing the rolling medians and absolute deviations ...")
+        median = rolling_median(panel.y[idx])
+        mad = rolling_median(np.abs(panel.y[idx] - median[:, None]))
+        scale = np.maximum(1.4826 * mad, np.sqrt(np.maximum(median, 1.)))
+        score = (panel.y - median) / scale
+
+        shock = score > zSeuil
+        df_events = pd.DataFrame({"organName": panel.names[panel.codes[shock]],
+                                  "date": panel.dates[shock],
+                                  "binCount": panel.y[shock],
+                                  "median": median[shock],
+                                  "score": np.round(score[shock], 1)}) \
+            .sort_values(["date", "score"], ascending=[True, False]) \
+            .reset_index(drop=True)
+
+        print("    Returning", len(df_events), "shock events ...")
+        print("------------------------------------------- ")
+        return df_events
+
+
+    def compute_periodicity(self, df_c, freq="W", groupKey="organName", targetCol="binCount", acfSeuil=.3,
+                            maxElements=2.e7):
+        """ Autocorrelation and dominant period of all the time series.
+            The series are put in a matrix (one row per organisation, one column per time bin,
+            zero for the bins without citation), detrended (least squares line) over their own
+            time span, and
+            transformed with one batched rfft : the power spectrum gives the dominant period and
+            its inverse transform the autocorrelation function (Wiener-Khinchin).
+
+        Parameters
+        ----------
+        df_c : dataframe
+            stacked dataframes of all time series (binned data).
+        freq : str
+            The bin size in weeks or a month {"W", "2W", "3W", "M"}.
+            Weekly bins resolve the monthly cycles, monthly bins the yearly ones.
+        acfSeuil : float
+            A time serie is periodic if its autocorrelation at the dominant period is larger.
+        maxElements : float
+            Maximum number of matrix elements transformed at once.
+
+        Return
+        ----------
+         Dataframe with per organisation :
+            acf1 : autocorrelation at 1 bin
+            period, periodDays : dominant period in bins and in days (between 2 bins and half
+                of the time span of the serie)
+            periodPower : fraction of the spectral power at the dominant period
+            periodAcf : autocorrelation at the dominant period
+            periodic : periodAcf > acfSeuil
+        """
+
+        print("---> Calling compute_periodicity : batched FFT of the zero-filled time series.")
+        panel = BinnedPanel(df_c, freq, groupKey=groupKey, targetCol=targetCol)
+        nOrg = len(panel.names)
+        t = bin_index(panel.dates, freq)
+        nBins = int(t.max()) + 1 if len(t) else 1
+        # padding to 2 * nBins makes the autocorrelation linear instead of circular
+        nfft = 1 << int(np.ceil(np.log2(2 * nBins)))
+        print("    Number of bins :", nBins, ", FFT length :", nfft)
+
+        first = t[panel.offsets[:-1]] if nOrg else t
+        last = t[panel.offsets[1:] - 1] if nOrg else t
+        span = last - first + 1
+
+        # candidate periods (in bins) of the positive frequencies
+        k = np.arange(1, nfft // 2 + 1)
+        periods = nfft / k
+        res = {col: np.full(nOrg, np.nan) for col in ["acf1", "period", "periodPower", "periodAcf"]}
+
+        rows = max(int(maxElements // nfft), 1)
+        for b0 in range(0, nOrg, rows):
+            b1 = min(b0 + rows, nOrg)
+            p0, p1 = panel.offsets[b0], panel.offsets[b1]
+            grid = np.arange(nBins)[None, :]
+            inSpan = (grid >= first[b0:b1, None]) & (grid <= last[b0:b1, None])
+            X = np.zeros((b1 - b0, nBins))
+            X[panel.codes[p0:p1] - b0, t[p0:p1]] = panel.y[p0:p1]
+            # removing the line fitted over the span of each serie
+            tc = np.where(inSpan, grid - (first[b0:b1, None] + last[b0:b1, None]) / 2., 0.)
+            Stt = (tc * tc).sum(axis=1)
+            slope = np.divide((tc * X).sum(axis=1), Stt, out=np.zeros(b1 - b0), where=Stt > 0)
+            X = np.where(inSpan, X - (X.sum(axis=1) / span[b0:b1])[:, None] - slope[:, None] * tc, 0.)
+
+            F = np.fft.rfft(X, n=nfft, axis=1)
+            power = F.real ** 2 + F.imag ** 2
+            with np.errstate(divide="ignore", invalid="ignore"):
+                acf = np.fft.irfft(power, n=nfft, axis=1)[:, :nBins]
+                acf = acf / acf[:, :1]
+                power = power[:, 1:]
+                valid = (periods[None, :] >= 2.) & (periods[None, :] <= span[b0:b1, None] / 2.)
+                peak = np.argmax(np.where(valid, power, -1.), axis=1)
+                rowIdx = np.arange(b1 - b0)
+                hasPeriod = valid[rowIdx, peak]
+                lag = np.minimum(np.round(periods[peak]).astype(np.int64), nBins - 1)
+
+                res["acf1"][b0:b1] = acf[:, min(1, nBins - 1)]
+                res["period"][b0:b1] = np.where(hasPeriod, periods[peak], np.nan)
+                res["periodPower"][b0:b1] = np.where(hasPeriod, power[rowIdx, peak] / power.sum(axis=1), np.nan)
+                res["periodAcf"][b0:b1] = np.where(hasPeriod, acf[rowIdx, lag], np.nan)
+
+        df_period = pd.DataFrame({groupKey: panel.names,
+                                  "acf1": np.round(res["acf1"], 2),
+                                  "period": np.round(res["period"], 1),
+                                  "periodDays": np.round(res["period"] * binDays[freq], 0),
+                                  "periodPower": np.round(res["periodPower"], 2),
+                                  "periodAcf": np.round(res["periodAcf"], 2)})
+        df_period["periodic"] = df_period["periodAcf"] > acfSeuil
+
+        print("    Returning", int(df_period["periodic"].sum()), "periodic time series out of", nOrg, "...")
+        print("------------------------------------------- ")
+        return df_period
+
+
+    def compute_neighbours(self, df_c, freq="M", topK=10, minCorr=None, groupKey="organName",
+                           targetCol="binCount", maxElements=2.e7, maxDensity=.2):
+        """ Co-citation correlations : the organisations whose time series move together.
+            The Pearson correlations of the zero-filled series (over the whole time range) are
+            computed from blocked matrix products of the count matrix with itself, sparse when the
+            matrix is sparse enough. Only the topK partners of each organisation are kept, so the
+            memory stays in O(number of organisations * topK).
+
+        Parameters
+        ----------
+        df_c : dataframe
+            stacked dataframes of all time series (binned data).
+        freq : str
+            The bin size in weeks or a month {"W", "2W", "3W", "M"}
+        topK : int
+            Number of partners kept per organisation.
+        minCorr : float, optional
+            Partners less correlated than minCorr are dropped.
+        maxElements : float
+            Maximum number of correlations held in memory at once (one block of rows).
+        maxDensity : float
+            The products are sparse if the fraction of non empty bins is lower.
+
+        Return
+        ----------
+         Dataframe of neighbours (organName, neighbour, corr, rank) sorted by organName and rank
+        """
+
+        print("---> Calling compute_neighbours : top", topK, "correlated partners of each organisation.")
+        panel = BinnedPanel(df_c, freq, groupKey=groupKey, targetCol=targetCol)
+        nOrg = len(panel.names)
+        t = bin_index(panel.dates, freq)
+        nBins = int(t.max()) + 1 if len(t) else 1
+        topK = max(min(topK, nOrg - 1), 0)
+
+        mean = panel.segment_sum(panel.y) / nBins if nOrg else np.zeros(0)
+        std = np.sqrt(np.maximum(panel.segment_sum(panel.y ** 2) / nBins - mean ** 2, 0.)) if nOrg else mean
+        density = len(t) / float(max(nOrg * nBins, 1))
+        if density < maxDensity:
+            from scipy.sparse import csr_matrix
+            X = csr_matrix((panel.y, (panel.codes, t)), shape=(nOrg, nBins))
+        else:
+            X = np.zeros((nOrg, nBins))
+            X[panel.codes, t] = panel.y
+        XT = X.T.tocsc() if density < maxDensity else X.T
+        print("    Number of bins :", nBins, ", density :", round(density, 3),
+              ", sparse products" if density < maxDensity else ", dense products")
+
+        neighbours = np.zeros((nOrg, topK), dtype=np.int64)
+        corrs = np.zeros((nOrg, topK))
+        rows = max(int(maxElements // max(nOrg, 1)), 1)
+        for b0 in range(0, nOrg, rows):
+            b1 = min(b0 + rows, nOrg)
+            G = X[b0:b1] @ XT
+            G = G.toarray() if hasattr(G, "toarray") else G
+            with np.errstate(divide="ignore", invalid="ignore"):
+                C = (G / nBins - mean[b0:b1, None] * mean[None, :]) / (std[b0:b1, None] * std[None, :])
+            C[~np.isfinite(C)] = -np.inf
+            C[np.arange(b1 - b0), np.arange(b0, b1)] = -np.inf
+            if topK == 0:
+                continue
+            best = np.argpartition(-C, topK - 1, axis=1)[:, :topK]
+            bestCorr = np.take_along_axis(C, best, axis=1)
+            order = np.argsort(-bestCorr, axis=1, kind="mergesort")
+            neighbours[b0:b1] = np.take_along_axis(best, order, axis=1)
+            corrs[b0:b1] = np.take_along_axis(bestCorr, order, axis=1)
+
+        df_neighbours = pd.DataFrame({groupKey: np.repeat(panel.names, topK),
+                                      "neighbour": panel.names[neighbours.ravel()],
+                                      "corr": np.round(corrs.ravel(), 3),
+                                      "rank": np.tile(np.arange(1, topK + 1), nOrg)})
+        keep = np.isfinite(corrs.ravel())
+        if minCorr is not None:
+            keep &= corrs.ravel() >= minCorr
+        df_neighbours = df_neighbours[keep].reset_index(drop=True)
+
+        print("    Returning", len(df_neighbours), "neighbours ...")
+        print("------------------------------------------- ")
+        return df_neighbours
+
+
+    def get_neighbours(self, df_neighbours, organName, k=None, groupKey="organName"):
+        """ Partners of an organisation.
+
+        Parameters
+        ----------
+        df_neighbours : dataframe
+            table of neighbours sorted by organName ( compute_neighbours )
+        organName : str
+        k : int, optional
+            Number of partners (all the kept ones by default).
+
+        Return
+        ----------
+         Dataframe of neighbours sorted by decreasing correlation
+        """
+        names = df_neighbours[groupKey].values
+        lo = np.searchsorted(names, organName, side="left")
+        hi = np.searchsorted(names, organName, side="right")
+        if k is not None:
+            hi = min(hi, lo + k)
+        return df_neighbours.iloc[lo:hi]
+
+
+    def get_shock_events(self, df_events, start=None, end=None):
+        """ Selects the shock events between two dates (included).
+
+        Parameters
+        ----------
+        df_events : dataframe
+            table of shock events sorted by date ( compute_shock_events )
+        start, end : str or datetime, optional
+
+        Return
+        ----------
+         Dataframe of shock events
+        """
+        dates = df_events["date"].values
+        lo = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start)), side="left")
+        hi = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end)),
+                                                            side="right")
+        return df_events.iloc[lo:hi]
+
     ##############################################################################
 
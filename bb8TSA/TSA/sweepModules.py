@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps over the TimeSeriesAnalysis pipeline sharing the intermediate results.
+"""
+import itertools
+
+import pandas as pd
+
+from bb8TSA.TSA.tsaModules import TimeSeriesAnalysis
+from bb8TSA.TSA.tendanceModules import constrained_tendance
+
+
+# Pipeline stage each parameter acts on, from the most to the least expensive.
+# A stage is computed once per combination of its own parameters and those of the stages above.
+stageParams = {"binning": ["freq"],
+               "cuts": ["minNumBins"],
+               "stat": ["intp"],
+               "fit": ["simpFit"],
+               "classification": ["medSeuil", "noiseRatio", "meanCount"]}
+
+paramTypes = {"freq": str, "minNumBins": int, "intp": bool, "simpFit": bool,
+              "medSeuil": float, "noiseRatio": float, "meanCount": int}
+
+
+def parse_grid(items):
+    """ Parses the grid given as strings "param=value1,value2,..."
+
+    :param items: list of str
+    :return: dict {param: list of values}
+    """
+    grid = {}
+    for item in items:
+        param, _, values = item.partition("=")
+        if param not in paramTypes:
+            raise KeyError("parse_grid : {} is not a sweepable parameter : {}".format(param, list(paramTypes)))
+        if paramTypes[param] is bool:
+            grid[param] = [v.strip().lower() in ["1", "true", "yes"] for v in values.split(",")]
+        else:
+            grid[param] = [paramTypes[param](v.strip()) for v in values.split(",")]
+    return grid
+
+
+class ParameterSweep:
+    """ Runs the TimeSeriesAnalysis pipeline for all the combinations of a parameter grid.
+        Each stage is computed once per combination of the parameters it depends on
+        (see stageParams) : the binning once per freq, the cuts once per (freq, minNumBins), the
+        statistical indicators once per intp and the fits once per simpFit for each cut, and only
+        the classification runs for every combination.
+
+    Parameters
+    ----------
+    grid : dict
+        {parameter: list of values} for the parameters of stageParams.
+        The parameters out of the grid keep their TimeSeriesAnalysis value.
+
+    tsaParams : keywords
+        Other TimeSeriesAnalysis parameters (nameCol, countFlag, countCol, ...)
+
+    Attributes
+    ----------
+    sweep_info : dataframe
+        Long format table : the transform() output of each combination, its slope and slopeErr,
+        whether the organisation is among the constrained tendencies and the most variable
+        organisations, and the parameter values of the combination.
+    """
+
+    def __init__(self, grid, **tsaParams):
+        print("ParameterSweep class initialised.")
+        for param in grid:
+            if param not in paramTypes:
+                raise KeyError("ParameterSweep : {} is not a sweepable parameter : {}"
+                               .format(param, list(paramTypes)))
+        self._tsa = TimeSeriesAnalysis(**tsaParams)
+        self.grid = {param: list(grid.get(param, [getattr(self._tsa, param)])) for param in paramTypes}
+        print("ParameterSweep : grid :", self.grid)
+
+    def fit(self, DFs, fileList=None):
+        """ Runs all the combinations of the grid.
+
+        Parameters
+        ----------
+        DFs : list (or iterable) of dataframes
+            Dataframes read from different files sources.
+
+        fileList : list of str, optional
+            List containing the name of the source files of the data frames with the same
+            order as DFs.
+        """
+        tsa = self._tsa
+        tsa.load_DFs([tsa.select_columns(df) for df in DFs], fileList)
+
+        results = []
+        for freq, minNumBins in itertools.product(self.grid["freq"], self.grid["minNumBins"]):
+            tsa.timeBinWidth = freq
+            tsa.minNumBins = minNumBins
+            df_c = tsa.stackDFs()
+
+            statTables = {intp: tsa.compute_stat(df_c, groupKey=tsa.groupKey, targetCol=tsa.targetCol,
+                                                 intp=intp, numBins=tsa.numBins)
+                          for intp in self.grid["intp"]}
+            fits = {simpFit: tsa.compute_fit(df_c, freq, simpFit=simpFit, fitMode=tsa.fitMode)
+                    for simpFit in self.grid["simpFit"]}
+
+            for intp, simpFit in itertools.product(self.grid["intp"], self.grid["simpFit"]):
+                statTable = statTables[intp]
+                df_tendance = statTable.merge(fits[simpFit], on="organName") \
+                    .sort_values("mean", ascending=False)
+                tsa.simpFit = simpFit
+
+                for medSeuil, noiseRatio, meanCount in itertools.product(
+                        self.grid["medSeuil"], self.grid["noiseRatio"], self.grid["meanCount"]):
+                    tsa.medSeuil = medSeuil
+                    tendance_info, fit_info = tsa.classify_tendance(df_tendance)
+                    fit_info = fit_info.merge(tendance_info[["organName", "slope", "slopeErr"]],
+                                              on="organName")
+
+                    constrained = constrained_tendance(df_tendance, noiseRatio=noiseRatio,
+                                                       minNumBins=minNumBins)["organName"]
+                    mostVar = tsa.get_most_var_list(statTable, minNumBins=minNumBins, meanCount=meanCount)
+                    fit_info["constrained"] = fit_info["organName"].isin(constrained)
+                    fit_info["most_variable"] = fit_info["organName"].isin(mostVar)
+
+                    for param, value in zip(paramTypes, [freq, minNumBins, intp, simpFit,
+                                                         medSeuil, noiseRatio, meanCount]):
+                        fit_info[param] = value
+                    results.append(fit_info)
+
+        self.sweep_info = pd.concat(results, ignore_index=True)
+        print("ParameterSweep : fit :", len(results), "combinations computed.")
+        return self
+
+    def transform(self):
+        """
+        :return: dataframe
+            Long format table of the results of all combinations.
+        """
+        return self.sweep_info
+
+    def fit_transform(self, DFs, fileList=None):
+        """ Performes fit and transform provided by the ParameterSweep class.
+        :param DFs: list of dataframes
+        :fileList: list of str, optional
+        :return: dataframe
+        """
+        return self.fit(DFs, fileList).transform()
@@ -4,13 +4,17 @@ Created on Wed Nov 25 11:20:34 2020
 
 @author: M77100
 """
+import warnings
+
 import numpy as np
 import pandas as pd
 
-import matplotlib.dates as mdates
+# scipy.stats, scipy.optimize and scipy.special are imported by the methods using them :
+# importing them costs more than the rest of the package.
 
-from scipy import stats
-from scipy.optimize import curve_fit
+from bb8TSA.TSA.kernelModules import line_fit
+from bb8TSA.TSA.panelModules import BinnedPanel, bin_index, date_to_num, huber_line_fit, lin_fit_from_sums, \
+    next_bin_dates
 
 
 class Tendance:
@@ -19,7 +23,7 @@ class Tendance:
     def __init__(self):
         print("Tendance class initialised.")
 
-    def compute_tendance(self, df_c, statTable, freq, simpFit=True):
+    def compute_tendance(self, df_c, statTable, freq, simpFit=True, fitMode="ls"):
         """ Computes the increase/decrease tendency of a time series
 
          Parameters
@@ -38,18 +42,54 @@ class Tendance:
             True by default apply a simple linear fit to each time series.
             False : shot noises included in linear fit
 
+        fitMode : str
+            "ls" (least squares, default) or "huber" (robust fit, see compute_huber_lin_fit)
+
         Return
         ----------
         Tendecy dataframe
         """
-        self._freq = freq
         print("Tendance : compute_tendance : computing the increase/decrease tendency of the organisations")
-        fitFun = self.compute_simple_lin_fit if simpFit else self.compute_lin_fit
-        df_c_fit = fitFun(df_c)
+        df_c_fit = self.compute_fit(df_c, freq, simpFit=simpFit, fitMode=fitMode)
         print("    Merging the tendencies with the statTable ... ")
         return statTable.merge(df_c_fit, on="organName") \
             .sort_values("mean", ascending=False)
 
+    def compute_fit(self, df_c, freq, simpFit=True, fitMode="ls"):
+        """ Fits a line to each time serie (compute_simple_lin_fit or compute_lin_fit)
+
+         Parameters
+         ----------
+         df_c : dataframe
+            stacked dataframes of all time series (binned data).
+
+        freq : str
+            The bin size in weeks or a month {"W", "2W", "3W", "M"}
+
+        simpFit : boolean
+            True : simple linear fit, False : shot noises included in linear fit
+
+        fitMode : str
+            "ls" : least squares (compute_simple_lin_fit or compute_lin_fit).
+            "huber" : robust fit (compute_huber_lin_fit) with the weights chosen by simpFit.
+
+        Return
+        ----------
+        Dataframe including the parameters and the characteristics of the fitted lines
+        """
+        self._freq = freq
+        if fitMode == "huber":
+            return self.compute_huber_lin_fit(df_c, freq, simpFit=simpFit)
+        if fitMode != "ls":
+            raise ValueError("Fit mode should be one of : ('ls', 'huber')")
+        if getattr(self, "accelerate", False):
+            from bb8TSA.TSA.kernelModules import KERNELS, fit_table
+            print("Tendance : compute_fit : accelerated kernels (" + KERNELS + "),",
+                  "uncertainities on bin counts excluded." if simpFit else "shot noises included.")
+            return fit_table(df_c, freq, simpFit=simpFit)
+        fitFun = self.compute_simple_lin_fit if simpFit else self.compute_lin_fit
+        return fitFun(df_c)
+
 
     def compute_simple_lin_fit(self, df_c):
         """ Fits a line to each time serie
@@ -97,6 +137,57 @@ class Tendance:
 
         return tbl_fit
 
+    def compute_huber_lin_fit(self, df_c, freq, simpFit=True, k=1.345, maxIter=50, tol=1.e-4, minScale=1.):
+        """ Robust linear fit (Huber loss) of all the time series at once through iteratively
+            reweighted least squares. Each iteration is one weighted solve from the grouped sums
+            of the organisations which have not converged yet (see panelModules.huber_line_fit).
+            A bin whose normalised residual exceeds k robust standard deviations gets the weight
+            k/|u| instead of 1, so a single count shoot does not drive the tendency.
+
+         Parameters
+         ----------
+         df_c : dataframe
+            stacked dataframes of all time series (binned data).
+
+        freq : str
+            The bin size in weeks or a month {"W", "2W", "3W", "M"}
+
+        simpFit : boolean
+            True : unit base weights, False : residuals normalised by the shot noises.
+
+        k : float
+            Huber threshold in robust standard deviations (1.345 : 95% efficiency for gaussian noise).
+
+        maxIter : int
+            Maximum number of iterations.
+
+        tol : float
+            An organisation has converged when its slope and intercept change by less than
+            tol (relative to their values).
+
+        minScale : float
+            Floor of the robust standard deviation, in counts (simpFit) or in shot noises : a serie
+            with most of its bins on a line has a zero median absolute residual.
+
+        Return
+        ----------
+        Dataframe with organName, slope, intercept, slopeErr (degrees as compute_lin_fit), xi2,
+        numIter (iterations needed) and downWeighted (number of bins with a weight below 1).
+        """
+        print("Tendance : compute_huber_lin_fit : Robust linear fit to all data points per organisation.")
+        print("    Huber threshold :", k, ", shot noises", "excluded." if simpFit else "included.")
+        panel = BinnedPanel(df_c, freq)
+        slope, intercept, slopeErr, xi2, numIter, h = huber_line_fit(panel, simpFit=simpFit, k=k, maxIter=maxIter,
+                                                                     tol=tol, minScale=minScale)
+        print("    Iterations :", numIter.max() if len(numIter) else 0, ", not converged :",
+              int((numIter == maxIter).sum()))
+
+        downWeighted = np.bincount(panel.codes, weights=h < 1., minlength=len(panel.names)).astype(np.int64)
+        return panel.to_frame(slope=np.round(np.arctan(slope) * 180 / np.pi, 1),
+                              intercept=np.round(intercept, 1),
+                              slopeErr=np.round(np.arctan(slopeErr) * 180 / np.pi, 1),
+                              xi2=xi2, numIter=numIter, downWeighted=downWeighted)
+
     def prep_to_fit(self):
         """ Prepare the dataframe of time series to fit a line
         Return
@@ -105,8 +196,7 @@ class Tendance:
         """
         df_befitted = self._df_c.copy()
         # Converting date formats to digits
-        df_befitted["modifDate"] = df_befitted["date"] \
-            .apply(lambda x: mdates.date2num(x))
+        df_befitted["modifDate"] = date_to_num(df_befitted["date"])
         if self._freq == "M" :
             df_befitted["modifDate"] /= 30.
         elif self._freq == "3W" :
@@ -142,6 +232,8 @@ class Tendance:
          List of output slopes, associated errors are in degrees and other fit characteristics
         """
 
+        from scipy import stats
+
         try:
             x = list(map(lambda f: f[0], liste))
             y = list(map(lambda f: f[1], liste))
@@ -167,6 +259,8 @@ class Tendance:
          List of output slopes, associated errors are in degrees and other fit characteristics
         """
 
+        from scipy.optimize import curve_fit
+
         def linear_model(x, a, b):
             return a * x + b
 
@@ -196,6 +290,342 @@ class Tendance:
             print("line_fit warning : uncertainties include zero(s) ")
             return np.nan
 
+    def compute_bootstrap_tendance(self, df_c, freq, simpFit=True, nBoot=1000, mode="bins", alpha=.05,
+                                   seed=None, maxElements=2.e7):
+        """ Bootstrap confidence intervals of the slope and p_0 for all the time series at once.
+            The resampling is done on arrays covering blocks of organisations (no loop on the
+            organisations nor on the replicates) and each replicate line is solved from its
+            weighted sums (see panelModules.lin_fit_from_sums).
+
+         Parameters
+         ----------
+         df_c : dataframe
+            stacked dataframes of all time series (binned data).
+
+        freq : str
+            The bin size in weeks or a month {"W", "2W", "3W", "M"}
+
+        simpFit : boolean
+            True : unweighted fits (as compute_simple_lin_fit).
+            False : shot noises included in the fits (as compute_lin_fit).
+
+        nBoot : int
+            Number of bootstrap replicates.
+
+        mode : str
+            "bins" : the bins of each time serie are resampled with replacement.
+            "residuals" : the residuals of the fitted line are resampled and added to the line.
+
+        alpha : float
+            The confidence intervals cover the [alpha/2, 1-alpha/2] percentiles.
+
+        seed : int, optional
+            Seed of the random generator.
+
+        maxElements : float
+            Maximum number of resampled points (nBoot * points of a block of organisations)
+            kept in memory at once.
+
+        Return
+        ----------
+        Dataframe with organName, slope and p_0 percentile intervals and the bootstrap
+        standard deviation of the slope (slopes are in degrees as in the other fits).
+        """
+        print("Tendance : compute_bootstrap_tendance : bootstrap of the linear fits.")
+        print("    Number of replicates :", nBoot, ", resampling mode :", mode)
+        if mode not in ["bins", "residuals"]:
+            raise ValueError("Bootstrap mode should be one of : ('bins', 'residuals')")
+        from scipy.special import ndtr
+
+        panel = BinnedPanel(df_c, freq)
+        # Centering the dates per organisation keeps the sums well conditioned
+        x = panel.x - (panel.segment_sum(panel.x) / panel.counts)[panel.codes]
+        y = panel.y
+        w = np.ones_like(y) if simpFit else 1. / panel.shot_noise() ** 2
+        rng = np.random.default_rng(seed)
+
+        if mode == "residuals":
+            sums = [panel.segment_sum(v) for v in [w, w * x, w * y, w * x * x, w * x * y, w * y * y]]
+            slope, intercept, _, _ = lin_fit_from_sums(*sums, panel.counts)
+            yFit = slope[panel.codes] * x + intercept[panel.codes]
+            resid = y - yFit
+
+        nOrg = len(panel.names)
+        res = {col: np.full(nOrg, np.nan) for col in ["slopeLow", "slopeHigh", "slopeBootErr",
+                                                        "p_0Low", "p_0High"]}
+        q = [100. * alpha / 2., 100. * (1. - alpha / 2.)]
+
+        # Blocks of consecutive organisations holding at most maxElements resampled points
+        blockStart = 0
+        while blockStart < nOrg:
+            p0 = panel.offsets[blockStart]
+            blockEnd = np.searchsorted(panel.offsets, p0 + max(maxElements / nBoot, 1.), side="right") - 1
+            blockEnd = min(max(blockEnd, blockStart + 1), nOrg)
+            p1 = panel.offsets[blockEnd]
+
+            codes = panel.codes[p0:p1]
+            start = panel.offsets[codes]
+            n = panel.counts[codes]
+            idx = start + (rng.random((nBoot, p1 - p0)) * n).astype(np.int64)
+
+            if mode == "bins":
+                xb, yb, wb = x[idx], y[idx], w[idx]
+            else:
+                xb = np.broadcast_to(x[p0:p1], idx.shape)
+                wb = np.broadcast_to(w[p0:p1], idx.shape)
+                yb = yFit[p0:p1] + resid[idx]
+
+            segStart = panel.offsets[blockStart:blockEnd] - p0
+            sums = [np.add.reduceat(v, segStart, axis=1)
+                    for v in [wb, wb * xb, wb * yb, wb * xb * xb, wb * xb * yb, wb * yb * yb]]
+            bSlope, _, bSlopeErr, _ = lin_fit_from_sums(*sums, panel.counts[blockStart:blockEnd])
+
+            bSlope = np.round(np.arctan(bSlope) * 180 / np.pi, 1)
+            bSlopeErr = np.round(np.arctan(bSlopeErr) * 180 / np.pi, 1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                bP0 = ndtr(-np.abs(bSlope) / bSlopeErr)
+
+            with warnings.catch_warnings():
+                # organisations with too few bins have no valid replicate
+                warnings.simplefilter("ignore", RuntimeWarning)
+                slopeQ = np.nanpercentile(bSlope, q, axis=0)
+                p0Q = np.nanpercentile(bP0, q, axis=0)
+            res["slopeLow"][blockStart:blockEnd], res["slopeHigh"][blockStart:blockEnd] = slopeQ
+            res["p_0Low"][blockStart:blockEnd], res["p_0High"][blockStart:blockEnd] = p0Q
+            res["slopeBootErr"][blockStart:blockEnd] = np.nanstd(bSlope, axis=0)
+
+            blockStart = blockEnd
+
+        print("    Returning the bootstrap intervals ...")
+        return panel.to_frame(**res)
+
+    def compute_rolling_tendance(self, df_c, freq, window=6, simpFit=True, intp=True):
+        """ Slope, slope error, dispersion and internal dispersion over the last `window` bins
+            of each time serie, for every bin position.
+            All the windows are computed at once from the prefix sums of the regression and
+            variance sums, in O(number of bins).
+
+         Parameters
+         ----------
+         df_c : dataframe
+            stacked dataframes of all time series (binned data).
+
+        freq : str
+            The bin size in weeks or a month {"W", "2W", "3W", "M"}
+
+        window : int
+            Number of bins of the windows (> 2). The windows run over the bins of an
+            organisation, empty time bins are not counted.
+
+        simpFit : boolean
+            True : unweighted fits (as compute_simple_lin_fit).
+            False : shot noises included in the fits (as compute_lin_fit).
+
+        intp : boolean
+            True : the internal sigma uses the interpolation between the adjacent bins
+            (as compute_interpol), False : the difference between consecutive bins.
+
+        Return
+        ----------
+        Dataframe with organName, date (last bin of the window), slope, slopeErr (in degrees),
+        sigma, internalSigma and sigmasRatio.
+        """
+        print("Tendance : compute_rolling_tendance : trends over the last", window, "bins.")
+        if window < 3:
+            raise ValueError("The rolling window should include at least 3 bins.")
+
+        panel = BinnedPanel(df_c, freq)
+        codes = panel.codes
+        first = panel.offsets[codes]
+        last = panel.offsets[codes + 1] - 1
+        pos = np.arange(len(codes)) - first
+
+        # Per organisation origins keep the prefix sums well conditioned.
+        x = panel.x - panel.x[first]
+        y = panel.y - (panel.segment_sum(panel.y) / panel.counts)[codes]
+        w = np.ones_like(y) if simpFit else 1. / panel.shot_noise() ** 2
+
+        print("    Computing the internal residuals ...")
+        d2 = np.zeros_like(y)
+        valid = np.zeros(len(y), dtype=bool)
+        if intp:
+            # interpolation between the previous and the next bins (compute_interpol)
+            days = date_to_num(panel.dates)
+            inner = np.nonzero((pos >= 1) & (np.arange(len(y)) < last))[0]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                slop = (y[inner + 1] - y[inner - 1]) / (days[inner + 1] - days[inner - 1])
+                slop[slop == np.inf] = 0.
+                intpol = y[inner - 1] + slop * (days[inner] - days[inner - 1])
+            d2[inner] = (y[inner] - intpol) ** 2
+            valid[inner] = np.isfinite(d2[inner])
+        else:
+            inner = np.nonzero(pos >= 1)[0]
+            d2[inner] = (y[inner] - y[inner - 1]) ** 2
+            valid[inner] = True
+        d2[~valid] = 0.
+
+        def window_sum(values, lo, hi):
+            # sums of values[lo:hi] from the prefix sums
+            prefix = np.concatenate([[0.], np.cumsum(values)])
+            return prefix[hi] - prefix[lo]
+
+        print("    Computing the window sums ...")
+        end = np.nonzero(pos >= window - 1)[0]
+        lo, hi = end - window + 1, end + 1
+        sums = [window_sum(v, lo, hi) for v in [w, w * x, w * y, w * x * x, w * x * y, w * y * y]]
+        slope, _, slopeErr, _ = lin_fit_from_sums(*sums, window)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sumY, sumY2 = window_sum(y, lo, hi), window_sum(y * y, lo, hi)
+            sigma = np.sqrt(np.clip(sumY2 - sumY * sumY / window, 0., None) / (window - 1.))
+
+            # internal residuals whose neighbours are inside the window
+            intHi = hi - 1 if intp else hi
+            internalSigma = np.sqrt(window_sum(d2, lo + 1, intHi) / window_sum(valid, lo + 1, intHi))
+            sigmasRatio = sigma / internalSigma
+
+        df_rolling = pd.DataFrame({"organName": panel.names[codes[end]],
+                                   "date": panel.dates[end],
+                                   "slope": np.round(np.arctan(slope) * 180 / np.pi, 1),
+                                   "slopeErr": np.round(np.arctan(slopeErr) * 180 / np.pi, 1),
+                                   "sigma": sigma,
+                                   "internalSigma": internalSigma,
+                                   "sigmasRatio": sigmasRatio})
+        print("    Returning the rolling tendencies ...")
+        return df_rolling
+
+    def compute_forecast(self, df_c, freq, horizon=1, model="linear", level=.95, alpha=(.1, .3, .5, .7, .9),
+                         beta=(.05, .1, .2, .4), simpFit=True, maxElements=2.e7):
+        """ Forecasts of the next horizon bins of all the time series with prediction intervals.
+            "linear" : projection of the least squares line of the bins (as compute_fit), with the
+            prediction interval of a new observation (Student t).
+            "ses" and "holt" : simple exponential smoothing and Holt's linear trend method over the
+            zero-filled bins from the first bin of each serie to the last bin of the panel.
+            The recursions run over the time bins for blocks of organisations at once, for every
+            value of the smoothing parameters : each organisation keeps the values giving the
+            smallest one step ahead squared errors. The intervals use the normal quantiles and
+            the variances of the equivalent state space models (additive errors).
+
+         Parameters
+         ----------
+         df_c : dataframe
+            stacked dataframes of all time series (binned data).
+
+        freq : str
+            The bin size in weeks or a month {"W", "2W", "3W", "M"}
+
+        horizon : int
+            Number of forecast bins after the last bin of the panel.
+
+        model : str
+            "linear", "ses" or "holt"
+
+        level : float
+            Probability of the prediction intervals.
+
+        alpha, beta : float or list of float
+            Smoothing parameters of the level and of the trend (Holt, component form) tried.
+
+        simpFit : boolean
+            linear model : True for unweighted fits, False to include the shot noises.
+
+        maxElements : float
+            Maximum number of (organisation, bin, parameter) values computed at once.
+
+        Return
+        ----------
+        Dataframe with organName, step, date, forecast, lower and upper (clipped at 0), and the
+        chosen alpha and beta for the smoothing models.
+        """
+        from scipy.special import ndtri, stdtrit
+
+        print("Tendance : compute_forecast :", model, "forecasts of the next", horizon, "bins.")
+        if model not in ["linear", "ses", "holt"]:
+            raise ValueError("Forecast model should be one of : ('linear', 'ses', 'holt')")
+
+        panel = BinnedPanel(df_c, freq)
+        nOrg = len(panel.names)
+        steps = np.arange(1, horizon + 1)
+        dates = next_bin_dates(panel.dates.max(), freq, horizon)
+        columns = {}
+
+        if model == "linear":
+            w = np.ones_like(panel.y) if simpFit else 1. / panel.shot_noise() ** 2
+            slope, intercept, _, xi2, _ = line_fit(panel.x, panel.y, w, panel.offsets)
+            S = panel.segment_sum(w)
+            xMean = panel.segment_sum(w * panel.x) / S
+            Sxx = panel.segment_sum(w * (panel.x - xMean[panel.codes]) ** 2)
+            x0 = date_to_num(dates, freq)[None, :]
+            forecast = slope[:, None] * x0 + intercept[:, None]
+            # variance of a new observation : unit weight, or its shot noise
+            w0 = 1. if simpFit else 1. / np.maximum(forecast, 1.)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                var = xi2[:, None] * (1. / w0 + 1. / S[:, None] + (x0 - xMean[:, None]) ** 2 / Sxx[:, None])
+                quantile = stdtrit(panel.counts - 2., (1. + level) / 2.)[:, None]
+        else:
+            t = bin_index(panel.dates, freq)
+            nBins = int(t.max()) + 1 if len(t) else 1
+            first = t[panel.offsets[:-1]]
+            alphas, betas = np.meshgrid(np.atleast_1d(alpha).astype(float),
+                                        np.atleast_1d(beta).astype(float) if model == "holt" else [0.])
+            alphas, betas = alphas.ravel(), betas.ravel()
+            nPar = len(alphas)
+            print("    Number of bins :", nBins, ", parameter values tried :", nPar)
+
+            lvl, trend, sigma2, chosen = (np.zeros(nOrg) for _ in range(4))
+            rows = max(int(maxElements // (nBins * nPar)), 1)
+            for b0 in range(0, nOrg, rows):
+                b1 = min(b0 + rows, nOrg)
+                p0, p1 = panel.offsets[b0], panel.offsets[b1]
+                X = np.zeros((b1 - b0, nBins))
+                X[panel.codes[p0:p1] - b0, t[p0:p1]] = panel.y[p0:p1]
+                f = first[b0:b1, None]
+                L, B = np.zeros((b1 - b0, nPar)), np.zeros((b1 - b0, nPar))
+                sse, nErr = np.zeros((b1 - b0, nPar)), np.zeros((b1 - b0, 1))
+                for k in range(nBins):
+                    y = X[:, k:k + 1]
+                    # one step ahead errors once the states are initialised
+                    fitted = k > f + (1 if model == "holt" else 0)
+                    err = np.where(fitted, y - L - B, 0.)
+                    sse += err * err
+                    nErr += fitted
+                    newL = L + B + alphas * err
+                    newB = B + alphas * betas * err
+                    # initialisation : level on the first bin, trend on the second one (Holt)
+                    newL = np.where(k == f, y, newL)
+                    if model == "holt":
+                        newL = np.where(k == f + 1, y, newL)
+                        newB = np.where(k == f + 1, y - L, newB)
+                    L, B = np.where(k >= f, newL, L), np.where(k >= f, newB, B)
+                best = np.argmin(sse, axis=1)
+                rowIdx = np.arange(b1 - b0)
+                lvl[b0:b1], trend[b0:b1] = L[rowIdx, best], B[rowIdx, best]
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    sigma2[b0:b1] = sse[rowIdx, best] / nErr[:, 0]
+                chosen[b0:b1] = best
+
+            chosen = chosen.astype(np.int64)
+            a, b = alphas[chosen][:, None], (alphas * betas)[chosen][:, None]
+            h = steps[None, :]
+            forecast = lvl[:, None] + h * trend[:, None]
+            var = sigma2[:, None] * (1. + (h - 1) * (a * a + a * b * h + b * b * h * (2 * h - 1) / 6.))
+            quantile = ndtri((1. + level) / 2.)
+            columns["alpha"] = np.repeat(alphas[chosen], horizon)
+            if model == "holt":
+                columns["beta"] = np.repeat(betas[chosen], horizon)
+
+        with np.errstate(invalid="ignore"):
+            halfWidth = quantile * np.sqrt(var)
+        df_forecast = pd.DataFrame(dict({"organName": np.repeat(panel.names, horizon),
+                                         "step": np.tile(steps, nOrg),
+                                         "date": np.tile(dates, nOrg),
+                                         "forecast": np.round(np.maximum(forecast, 0.), 1).ravel(),
+                                         "lower": np.round(np.maximum(forecast - halfWidth, 0.), 1).ravel(),
+                                         "upper": np.round(np.maximum(forecast + halfWidth, 0.), 1).ravel()},
+                                        **columns))
+        print("    Returning", len(df_forecast), "forecasts ...")
+        return df_forecast
+
 
 ##############################################################################
 
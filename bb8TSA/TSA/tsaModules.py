@@ -1,9 +1,54 @@
+import time
+from os import path
+
 import numpy as np
-from scipy.special import ndtr
+import pandas as pd
+from bb8TSA.FilesPrepration.artefactModules import artefact_path, read_artefact, write_artefact
+from bb8TSA.FilesPrepration.filesPrepModules import select_rows
+from bb8TSA.FilesPrepration.historyModules import write_run
+from bb8TSA.TSA.cacheModules import ResultCache, series_keys
 from bb8TSA.TSA.dataBinModules import BinnedOrganisations, stack_c_DFs
+from bb8TSA.TSA.organModules import decode_names
 from bb8TSA.TSA.statModules import StatIndic
 from bb8TSA.TSA.tendanceModules import Tendance, constrained_tendance
 
+
+# Labels of classify_tendance : for each label column, rules (label, column, operator, threshold)
+# tried in order, the first true one gives the label, the default otherwise. A threshold is a
+# number or the name of a column (or parameter, as medSeuil).
+defaultClassRules = {
+    "count_shoot": {"rules": [("Yes", "maxMedianRatio", ">", "medSeuil")], "default": "No"},
+    "variability": {"rules": [("high", "sigmasRatio", ">=", 2.),
+                              ("Moderate", "sigmasRatio", ">", 1.),
+                              ("None", "sigmasRatio", "<=", "nbinR"),
+                              ("Low", "sigmasRatio", "<=", 1.)], "default": ""},
+    "tendency": {"rules": [("Increase", "slope", ">", 1.e-6),
+                           ("Decrease", "slope", "<", -1.e-6)], "default": "Const"},
+}
+
+_operators = {">": np.greater, ">=": np.greater_equal, "<": np.less, "<=": np.less_equal, "==": np.equal}
+
+
+def apply_rules(values, rules):
+    """ Labels all the rows at once (see defaultClassRules).
+
+    :param values: dict-like of arrays and scalars (dataframe columns and parameters)
+    :param rules: dict {label column: {"rules": list of (label, column, operator, threshold), "default": label}}
+    :return: dict {label column: categorical} with the categories in the order of the rules
+    """
+    labels = {}
+    for name, rule in rules.items():
+        categories = list(dict.fromkeys([r[0] for r in rule["rules"]] + [rule["default"]]))
+        with np.errstate(invalid="ignore"):
+            conditions = [_operators[op](np.asarray(values[col], dtype=float),
+                                         values[threshold] if isinstance(threshold, str) else threshold)
+                          for _, col, op, threshold in rule["rules"]]
+        codes = np.select(conditions, [categories.index(r[0]) for r in rule["rules"]],
+                          default=categories.index(rule["default"]))
+        labels[name] = pd.Categorical.from_codes(codes, categories=categories)
+    return labels
+
+
 class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
     """Time Series Analysis Class.
 
@@ -68,6 +113,27 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
     simpFit : boolean
         True to fit a line to time series excluding the shot noises, False otherwise
 
+    fitMode : str
+        "ls" (default) : least squares fits.
+        "huber" : robust fits (iteratively reweighted, see Tendance.compute_huber_lin_fit),
+        less sensitive to the count shoots.
+
+    binning : str
+        "exact" (default) or "sketch" : approximate binning through count-min sketches keeping
+        only the organisations whose total count can reach minNumBins * meanCount
+        (see BinnedOrganisations and sketchModules).
+
+    sketchParams : dict, optional
+        Parameters of the sketch binning (width, depth, chunkSize, seed, minTotal, verify).
+
+    perSource : boolean
+        True to compute the tendencies of each source file (corpus) too, in the same pass
+        as the combined ones (see source_info and get_source_comparison). False by default.
+
+    periodicity : boolean
+        True to add the autocorrelation and dominant period columns (StatIndic.compute_periodicity)
+        to the stat table. False by default.
+
     noiseRatio : float
         This parameter is used to constrain the evident tendencies.
         If the ratio between the slope error and the slope of the fitted line are more
@@ -76,18 +142,73 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
     memSeuil : float
         Maximum memory to be used to load all dataframes in DFs
 
+    artefactDir : str, optional
+        Directory where the binned and cleaned binned dataframes are written as Arrow IPC files.
+        A later run with the same parameters can start from them through the resume method
+        (the names depend on the parameters, see BinnedOrganisations.artefact_params).
+
+    backend : str
+        "pandas" (default) or "arrow" : implementation of the binning, the cuts and the
+        statistical indicators (see backendModules). Both give the same results.
+
+    sampleFraction : float or dict, optional
+        Quick-look mode : the input dataframes are uniform samples of the data (see
+        FileNormalisation(sample=...) and its sampleFractions). The counts are rescaled and the
+        sampling errors of the classification are estimated (see compute_sample_errors).
+        The bins left empty by the sampling are missing : the organisations with a few mentions
+        per bin get overestimated means and fewer bins.
+
+    sampleReplicates : int
+        Number of replicates of the sampling error estimates. 20 by default.
+
+    stableSeuil : float
+        A classification (variability or tendency) is unstable if fewer than this share of the
+        replicates agree with it. 0.8 by default.
+
+    accelerate : boolean
+        True to compute the statistical indicators and the least squares fits with the single pass
+        kernels of kernelModules (compiled with numba when it is installed, NumPy otherwise).
+        Same results as the reference implementation. False by default.
+
+    cacheFile : str, optional
+        SQLite file caching the stat table and fit rows of each organisation between runs
+        (see cacheModules). Only the organisations whose binned serie or parameters changed
+        are computed again. Not used by the per source tendencies.
+
+    cacheMaxBytes : int
+        Maximum size of the cached rows, the least recently used ones are evicted. 256 MB by default.
+
+    cacheMaxEntries : int, optional
+        Maximum number of cached organisations.
+
+    organDict : OrganDictionary, optional
+        Codes of the organisation names (organModules). The binned time series, the cuts, the
+        statistical indicators and the fits are keyed by the int32 codes, the names are restored
+        in the output tables. A new dictionary by default, pass one to share the codes between runs.
+
+    classRules : dict, optional
+        Rules of the count_shoot, variability and tendency labels replacing the ones of the
+        module defaultClassRules (see apply_rules). The labels are categorical columns.
+
     Attributes
     ----------
     tendance_info : dataframe
         Contains the name of the organisation, the slope and slope error of the fitted line to the
         time serie and the p_value with horizontal line as the null-hypothesis.
 
+    sample_info : dataframe
+        Quick-look mode only : mean_citation, variability and tendency of each organisation with
+        their sampling errors and an unstable flag (see compute_sample_errors).
+
      """
 
     def __init__(self, nameCol="organName", dateCol="date", countCol=None, countFlag=False,
                  freq="M", groupKey="organName", targetCol="binCount", intp=True,
                  numBins="numBins", medSeuil=20., minNumBins=6, meanCount=20, nLeader=120, simpFit=False,
-                 noiseRatio=.5, memSeuil=5.):
+                 noiseRatio=.5, memSeuil=5., artefactDir=None, backend="pandas", fitMode="ls",
+                 periodicity=False, binning="exact", sketchParams=None, perSource=False, accelerate=False,
+                 sampleFraction=None, sampleReplicates=20, stableSeuil=.8, cacheFile=None, cacheMaxBytes=2**28,
+                 cacheMaxEntries=None, classRules=None, organDict=None):
         print("TimeSeriesAnalysis class initialised.")
         self.groupKey = groupKey
         self.nameCol= nameCol
@@ -96,6 +217,12 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
         self.targetCol = targetCol
         self.noiseRatio = noiseRatio
         self.simpFit = simpFit
+        self.fitMode = fitMode
+        self.periodicity = periodicity
+        self.perSource = perSource
+        self.accelerate = accelerate
+        self.sampleReplicates = sampleReplicates
+        self.stableSeuil = stableSeuil
         self.intp = intp
         self.numBins = numBins
         self.freq = freq
@@ -105,18 +232,27 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
         self.medSeuil = medSeuil
         self.nLeader = nLeader
         self.memSeuil = memSeuil
+        self.classRules = dict(defaultClassRules, **(classRules or {}))
+        self.resultCache = ResultCache(cacheFile, cacheMaxBytes, cacheMaxEntries) if cacheFile else None
+
+        if binning not in ["exact", "sketch"]:
+            raise ValueError("Binning should be one of : ('exact', 'sketch')")
+        sketch = dict({"minTotal": minNumBins * meanCount}, **(sketchParams or {})) \
+            if binning == "sketch" else None
 
         print("TimeSeriesAnalysis class initialised.")
-        BinnedOrganisations.__init__(self, nameCol, dateCol, countCol, freq, minNumBins, countFlag)
+        BinnedOrganisations.__init__(self, nameCol, dateCol, countCol, freq, minNumBins, countFlag,
+                                     artefactDir=artefactDir, backend=backend, sketch=sketch,
+                                     sampleFraction=sampleFraction, organDict=organDict)
         StatIndic.__init__(self)
         Tendance.__init__(self)
 
 
-    def fit(self, DFs, fileList=None):
+    def fit(self, DFs, fileList=None, start=None, end=None, organisations=None):
         """ Extracts statistical information from the input dataframes
         Parameters
         ----------
-        DFs : list of dataframes
+        DFs : list (or iterable) of dataframes
             Dataframes read from different files sources.
             Each dataframes should have at least 2 columns : name and date
 
@@ -124,65 +260,366 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
             List containing the name of the source files of the data frames with the same
             order as DFs.
 
+        start, end : str or date, optional
+            First and last days analysed.
+
+        organisations : list of str, optional
+            Organisations analysed (normalised names).
+            The rows out of the window or of other organisations are dropped before the binning.
+            Pass the same selection to FileNormalisation so that they are not even read.
         """
 
-        self.load_DFs(DFs, fileList)
+        # The dataframes are consumed one by one : DFs can be a generator (see
+        # FileNormalisation.iter_Normal_DFs) so that the binning of a file overlaps
+        # with the reading of the next ones.
+        organ_DFs, binned_DFs = [], []
+        for i, df in enumerate(DFs):
+            fname = fileList[i] if fileList is not None else "file" + str(i + 1)
+            df_organs, df_binned = self.bin_source(df, fname, start, end, organisations)
+            organ_DFs.append(df_organs)
+            binned_DFs.append(df_binned)
+
+        self.load_DFs(organ_DFs, fileList)
         # (BinnedOrganisations metheod)
+        self._binned[self.freq] = binned_DFs
 
-        if self.countFlag :
-            for i, df in enumerate(self._organ_DFs) :
-                if self.countCol == None :
-                    raise KeyError( "countCol name not specified." )
-                elif self.countCol not in self._organ_DFs[i].columns :
-                    raise KeyError("{} not found in schema.".format(self.countCol))
+        self.make_fit_info()
 
-                self._organ_DFs[i] = self._organ_DFs[i][[self.nameCol, self.dateCol, self.countCol]].copy()
-                self._organ_DFs[i].columns = ["organName", "date", "count"]
-        else :
-            for i, df in enumerate(self._organ_DFs):
-                self._organ_DFs[i] = self._organ_DFs[i][[self.nameCol, self.dateCol]].copy()
-                self._organ_DFs[i].columns = ["organName", "date"]
+    def bin_source(self, df, fname, start=None, end=None, organisations=None):
+        """ Selects the columns and the rows of a source dataframe and bins it (first stage of fit).
 
-        fit_info = self.compute_tendance_DFs()[ ["organName", "mean", "median", "sigmasRatio", "intercept",
-                                                "slope", "slopeErr", "max", "linePValue", "numBins"] ]\
-            if self.simpFit \
-            else self.compute_tendance_DFs()[ ["organName", "mean", "median", "sigmasRatio",
-                                                "slope", "slopeErr", "max", "numBins", "intercept"] ]
+        :param df: dataframe
+        :param fname: str
+            name of the source
+        :return: the selected dataframe and its binned time series
+        """
+        df_organs = self.select_columns(df)
+        self._selection = (start, end, organisations)
+        if start is not None or end is not None or organisations is not None:
+            df_organs = self.select_rows(df_organs, start, end, organisations)
+        return df_organs, self.make_binned_time_series(df_organs, fname)
+
+    async def afit_stages(self, DFs, fileList=None, start=None, end=None, organisations=None, executor=None):
+        """ Asynchronous fit : an async generator running the stages of fit in an executor, so that
+        the event loop is not blocked, and yielding the progress after each stage.
+        The dataframes are read one by one : DFs can be an async iterable, or an iterable whose
+        reads run in the executor too (as FileNormalisation.iter_Normal_DFs).
+        Cancelling the consumer stops the analysis before the next stage, the running stage ends
+        in the background : the instance is then left partially fitted.
 
+        Parameters
+        ----------
+        DFs : iterable or async iterable of dataframes
+        fileList, start, end, organisations :
+            see fit
+        executor : concurrent.futures.Executor, optional
+            executor of the current process (threads, the instance is shared), the default
+            executor of the event loop by default.
+
+        Return
+        ----------
+        Async iterator of dict (stage, source, step, total, elapsed) : stage is "binned" for each
+        source, then "tendance", "classify" and "sampleErrors" (quick-look mode only). total is None
+        when fileList is not given.
+        """
+        # asyncio is imported by the coroutines : the synchronous entry points do not need it
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        tStart = time.perf_counter()
+        step = 0
+
+        def progress(stage, source=None):
+            total = len(fileList) + 2 + (self.sampleFraction is not None) if fileList is not None else None
+            return {"stage": stage, "source": source, "step": step, "total": total,
+                    "elapsed": round(time.perf_counter() - tStart, 3)}
+
+        if hasattr(DFs, "__aiter__"):
+            sources = DFs.__aiter__()
+
+            async def read():
+                try:
+                    return await sources.__anext__()
+                except StopAsyncIteration:
+                    return None
+        else:
+            # (StopIteration cannot go through a future)
+            sources = iter(DFs)
+            read = lambda: loop.run_in_executor(executor, next, sources, None)
+
+        organ_DFs, binned_DFs = [], []
+        while True:
+            df = await read()
+            if df is None:
+                break
+            fname = fileList[step] if fileList is not None else "file" + str(step + 1)
+            df_organs, df_binned = await loop.run_in_executor(executor, self.bin_source, df, fname,
+                                                              start, end, organisations)
+            organ_DFs.append(df_organs)
+            binned_DFs.append(df_binned)
+            step += 1
+            yield progress("binned", fname)
+
+        self.load_DFs(organ_DFs, fileList)
+        self._binned[self.freq] = binned_DFs
+        for stage, fun in self.fit_info_stages():
+            await loop.run_in_executor(executor, fun)
+            step += 1
+            yield progress(stage)
+
+    async def afit(self, DFs, fileList=None, start=None, end=None, organisations=None, executor=None):
+        """ Coroutine of fit, see afit_stages. """
+        async for _ in self.afit_stages(DFs, fileList, start, end, organisations, executor):
+            pass
+
+    async def afit_transform(self, DFs, fileList=None, start=None, end=None, organisations=None, executor=None):
+        """ Coroutine of fit_transform, see afit_stages.
+
+        :return: the fit_info dataframe
+        """
+        import asyncio
+
+        await self.afit(DFs, fileList, start, end, organisations, executor)
+        return await asyncio.get_event_loop().run_in_executor(executor, self.transform)
 
-        fit_info["citation_rank"] = range(1, len(fit_info)+1)
+    def resume(self, fileList, stage="binned", start=None, end=None, organisations=None):
+        """ Runs the analysis from the artefacts of the binned or the cleaned binned dataframes
+        written by a previous run (see artefactDir). The artefacts are memory mapped.
 
-        shock_list = self.compute_schock_list(fit_info, medSeuil=self.medSeuil)
-        fit_info["count_shoot"] = "No"
-        fit_info.loc[ fit_info["organName"].isin(shock_list), "count_shoot" ] = "Yes"
+        Parameters
+        ----------
+        fileList : list of str
+            Names of the source files (or labels) used by the run which wrote the artefacts.
+            "file1", "file2", ... if fit was called without fileList. The artefact names depend
+            on the absolute paths (see artefact_path) : relative names and labels are resolved
+            from the working directory.
 
-        fit_info["nbinR"] = (fit_info["numBins"]-1.)/fit_info["numBins"]
-        fit_info["variability"] = ""
-        fit_info.loc[fit_info["sigmasRatio"]<=1, "variability"]="Low"
-        fit_info.loc[fit_info["sigmasRatio"]<=fit_info["nbinR"], "variability"]="None"
-        fit_info.loc[fit_info["sigmasRatio"]>1, "variability"]="Moderate"
-        fit_info.loc[fit_info["sigmasRatio"]>=2, "variability"]="high"
+        stage : str
+            "binned" or "clean" : the stage to start from.
+            Cleaned artefacts depend on minNumBins too (see artefact_params).
 
-        fit_info["tendency"] = "Const"
-        fit_info.loc[fit_info["slope"]<-1.e-6, "tendency"] = "Decrease"
-        fit_info.loc[fit_info["slope"]>1.e-6, "tendency"] = "Increase"
+        start, end, organisations : optional
+            selection passed to fit by the run which wrote the artefacts.
 
-        #fit_info["p_0"] = round(fit_info["linePValue"], 2)
+        The artefacts are those of a run with the same parameters (freq, countFlag, countCol,
+        selection, sampleFraction, sketch) : a ValueError is raised when one is missing.
+        """
+        if self.artefactDir is None:
+            raise ValueError("resume : artefactDir not specified.")
+        if stage not in ["binned", "clean"]:
+            raise ValueError("resume : stage should be one of : ('binned', 'clean')")
+        print("TimeSeriesAnalysis : resume : Resuming from the", stage, "artefacts in", self.artefactDir)
+
+        self._selection = (start, end, organisations)
+        params = [] if stage == "binned" else [self.minNumBins]
+        fpaths = [artefact_path(self.artefactDir, stage, fname, *self.artefact_params(fname, *params))
+                  for fname in fileList]
+        for fname, fpath in zip(fileList, fpaths):
+            if not path.isfile(fpath):
+                raise ValueError("resume : no " + stage + " artefact of " + str(fname) + " computed with "
+                                 "the parameters of this analysis (" + fpath + ").")
+        DFs = [read_artefact(fpath) for fpath in fpaths]
+
+        # The artefacts are written with the names
+        DFs = [df.assign(organName=self.organDict.encode(df["organName"].values)) for df in DFs]
+        # The raw dataframes are not available : only the stored stage can be used.
+        self.load_DFs([None] * len(fileList), fileList)
+        if stage == "binned":
+            self._binned[self.freq] = DFs
+        else:
+            self._cleaned[(self.freq, self.minNumBins)] = DFs
+
+        self.make_fit_info()
+
+    def make_fit_info(self):
+        """ Computes the tendencies of the loaded time series and classifies them
+        (fit_info and tendance_info tables).
+        """
+        for _, fun in self.fit_info_stages():
+            fun()
 
-        def compute_p_0(row) :
-            p_0 = ndtr(-row[0]/row[1]) if row[0]>0 else 1.- ndtr(-row[0]/row[1])
-            return p_0
-        fit_info["p_0"] = fit_info[["slope", "slopeErr"]].apply(compute_p_0, axis=1)
-        fit_info["p_0"] = round(fit_info["p_0"], 2)
-        fit_info.loc[ (abs(fit_info["slope"])<1.e-6) & (fit_info["slopeErr"].isnull().values.any()), "p_0"] = 1.
+    def fit_info_stages(self):
+        """ Stages of make_fit_info, to be run in order.
 
-        self.tendance_info = fit_info[["organName", "slope", "slopeErr", "intercept", "p_0"]]
+        :return: list of (stage name, function without arguments)
+        """
+        def tendance():
+            if self.perSource:
+                self._source_tendance = self.compute_source_tendance_DFs()
+                self._df_tendance = self._source_tendance.pop("all")
+            else:
+                self._df_tendance = self.compute_tendance_DFs()
+
+        def classify():
+            self.tendance_info, self._fit_info = self.classify_tendance(self._df_tendance)
+            if self.perSource:
+                self.source_info = pd.concat(
+                    [self.classify_source(self._df_tendance, "all")] +
+                    [self.classify_source(df_tendance, source)
+                     for source, df_tendance in self._source_tendance.items()],
+                    ignore_index=True)
+
+        def sample_errors():
+            self.sample_info = self.compute_sample_errors()
+
+        stages = [("tendance", tendance), ("classify", classify)]
+        if self.sampleFraction is not None:
+            stages.append(("sampleErrors", sample_errors))
+        return stages
+
+    def compute_sample_errors(self, nRep=None, seed=0):
+        """ Sampling errors of the quick-look results. The sampled count of each bin is drawn again
+        from a Poisson distribution (nRep replicates), the replicates go through the cuts, the
+        statistical indicators, the fits (accelerated kernels) and the classification, and are
+        compared to the results of the sample.
+
+        :param nRep: int, optional
+            number of replicates, sampleReplicates by default
+        :param seed: int
+        :return: dataframe (organName, mean_citation, mean_citationErr, variability,
+            variabilityAgree, tendency, tendencyAgree, unstable) in the order of transform() :
+            the Agree columns are the shares of the replicates giving the same label,
+            unstable is True if one of them is lower than stableSeuil.
+        """
+        nRep = nRep or self.sampleReplicates
+        print("TimeSeriesAnalysis : compute_sample_errors :", nRep, "replicates of the sampled counts ...")
+        rng = np.random.default_rng(seed)
+        labels = ["mean_citation", "variability", "tendency"]
+        replicates = []
+        # rows in the order of the names (and dates) : the draws do not depend on the codes
+        ranks = np.argsort(np.argsort(self.organDict.names, kind="mergesort"))
+        binned_DFs = [df.iloc[np.lexsort((df["date"].values, ranks[df["organName"].values]))]
+                      for df in self.extract_binned_DFs]
+        accelerate, self.accelerate = self.accelerate, True
+        try:
+            for rep in range(nRep):
+                c_DFs = []
+                for df, fname in zip(binned_DFs, self._fileList):
+                    fraction = self.get_sample_fraction(fname)
+                    sampled = rng.poisson(np.round(df["binCount"].values * fraction))
+                    df_rep = df[["organName", "date"]].assign(binCount=sampled / fraction)[sampled > 0]
+                    df_rep["numBins"] = df_rep.groupby("organName")["date"].transform("count")
+                    c_DFs.append(df_rep[df_rep["numBins"] > self.minNumBins - 1])
+                df_c = stack_c_DFs(c_DFs, memSeuil=self.memSeuil)
+                statTable = self.compute_stat(df_c, groupKey=self.groupKey, targetCol=self.targetCol,
+                                              intp=self.intp, numBins=self.numBins)
+                df_tendance = self.compute_tendance(df_c, statTable, freq=self.freq, simpFit=self.simpFit,
+                                                    fitMode=self.fitMode)
+                _, fit_info = self.classify_tendance(decode_names(df_tendance, self.organDict, self.groupKey))
+                replicates.append(fit_info[["organName"] + labels])
+        finally:
+            self.accelerate = accelerate
+
+        df_rep = self._fit_info[["organName"] + labels] \
+            .merge(pd.concat(replicates, ignore_index=True), on="organName", how="left", suffixes=("", "Rep"))
+        for col in ["variability", "tendency"]:
+            df_rep[col + "Agree"] = df_rep[col] == df_rep[col + "Rep"]
+        grouped = df_rep.groupby("organName", sort=False)
+        sample_info = self._fit_info[["organName"] + labels].copy()
+        sample_info.insert(2, "mean_citationErr",
+                           np.round(grouped["mean_citationRep"].std().reindex(sample_info["organName"]).values, 1))
+        for col in ["variability", "tendency"]:
+            agree = grouped[col + "Agree"].sum().reindex(sample_info["organName"]).values / nRep
+            sample_info.insert(sample_info.columns.get_loc(col) + 1, col + "Agree", np.round(agree, 2))
+        sample_info["unstable"] = (sample_info[["variabilityAgree", "tendencyAgree"]] < self.stableSeuil).any(axis=1)
+        print("    Unstable classifications :", int(sample_info["unstable"].sum()), "out of", len(sample_info))
+        return sample_info
+
+    def classify_source(self, df_tendance, source):
+        """
+        :param df_tendance: dataframe
+            tendency dataframe of a source
+        :param source: str
+        :return: fit_info table of the source with its slope, slopeErr and a source column
+        """
+        tendance_info, fit_info = self.classify_tendance(df_tendance)
+        fit_info = fit_info.merge(tendance_info[["organName", "slope", "slopeErr"]], on="organName")
+        fit_info.insert(0, "source", source)
+        return fit_info
+
+    def classify_tendance(self, df_tendance):
+        """ Ranks the organisations of a tendency table and labels their count shoot (with respect
+        to medSeuil), variability and tendency.
+
+        :param df_tendance: dataframe
+            tendency dataframe (compute_tendance_DFs)
+        :return: tendance_info and fit_info dataframes
+        """
+        fit_info = df_tendance[ ["organName", "mean", "median", "sigmasRatio", "intercept",
+                                 "slope", "slopeErr", "max", "linePValue", "numBins"] ].copy()\
+            if self.simpFit and self.fitMode == "ls" \
+            else df_tendance[ ["organName", "mean", "median", "sigmasRatio",
+                               "slope", "slopeErr", "max", "numBins", "intercept"] ].copy()
+
+
+        fit_info["citation_rank"] = np.arange(1, len(fit_info)+1)
+
+        # all the labels in one pass over the columns (shocks as in compute_schock_list)
+        numBins = fit_info["numBins"].values
+        with np.errstate(divide="ignore", invalid="ignore"):
+            maxMedianRatio = fit_info["max"].values / fit_info["median"].values
+        values = {"sigmasRatio": fit_info["sigmasRatio"].values, "slope": fit_info["slope"].values,
+                  "nbinR": (numBins - 1.) / numBins, "maxMedianRatio": np.where(np.isinf(maxMedianRatio),
+                                                                                np.nan, maxMedianRatio),
+                  "medSeuil": self.medSeuil}
+        for name, labels in apply_rules(values, self.classRules).items():
+            fit_info[name] = labels
+
+        from scipy.special import ndtr
+
+        slope, slopeErr = fit_info["slope"].values, fit_info["slopeErr"].values
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = ndtr(-slope / slopeErr)
+        p_0 = np.round(np.where(slope > 0, z, 1. - z), 2)
+        if np.isnan(slopeErr).any():
+            p_0[np.abs(slope) < 1.e-6] = 1.
+        fit_info["p_0"] = p_0
+
+        tendance_info = fit_info[["organName", "slope", "slopeErr", "intercept", "p_0"]]
 
         fit_info.rename(columns={"mean": "mean_citation"}, inplace=True)
 
-        self._fit_info = fit_info[["organName", "mean_citation", "citation_rank", "count_shoot", "variability",
-                        "tendency", "p_0", "numBins"]]
+        return tendance_info, fit_info[["organName", "mean_citation", "citation_rank", "count_shoot",
+                                        "variability", "tendency", "p_0", "numBins"]]
+
 
+    def select_columns(self, df):
+        """ Keeps only the name, date and (if countFlag) count columns of an input dataframe
+        and renames them to organName, date and count.
+
+        :param df: dataframe (or Arrow table with the arrow backend)
+        :return: dataframe (Arrow table with the arrow backend)
+        """
+        if self._backend is not None:
+            if self.countFlag :
+                if self.countCol == None :
+                    raise KeyError( "countCol name not specified." )
+                return self._backend.select_columns(df, [self.nameCol, self.dateCol, self.countCol],
+                                                    ["organName", "date", "count"])
+            return self._backend.select_columns(df, [self.nameCol, self.dateCol], ["organName", "date"])
+
+        if self.countFlag :
+            if self.countCol == None :
+                raise KeyError( "countCol name not specified." )
+            elif self.countCol not in df.columns :
+                raise KeyError("{} not found in schema.".format(self.countCol))
+
+            df = df[[self.nameCol, self.dateCol, self.countCol]].copy()
+            df.columns = ["organName", "date", "count"]
+        else :
+            df = df[[self.nameCol, self.dateCol]].copy()
+            df.columns = ["organName", "date"]
+        return df
+
+    def select_rows(self, df, start=None, end=None, organisations=None):
+        """ Keeps the rows of a select_columns output in a date window and/or of some organisations.
+
+        :param df: dataframe (or Arrow table with the arrow backend)
+        :return: dataframe (Arrow table with the arrow backend)
+        """
+        if self._backend is not None:
+            return self._backend.select_rows(df, start, end, organisations, nameCol="organName")
+        return select_rows(df, start, end, organisations, nameCol="organName")
 
     def transform(self) :
         """
@@ -193,14 +630,46 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
         """
         return self._fit_info
 
-    def fit_transform(self, DFs, fileList=None):
+    def get_result_table(self):
+        """
+        :return: dataframe
+            The transform() table completed with the fitted line parameters and the statistical
+            indicators (median, max, sigmasRatio) of each organisation.
+        """
+        return self._fit_info \
+            .merge(self.tendance_info[["organName", "slope", "slopeErr", "intercept"]], on="organName") \
+            .merge(self._df_tendance[["organName", "median", "max", "sigmasRatio"]], on="organName")
+
+    def write_snapshot(self, fpath):
+        """ Writes the result table (get_result_table) as an Arrow IPC file.
+        The file is replaced atomically, so a server reading it (serveModules) never sees
+        a partial snapshot.
+
+        :param fpath: str
+        """
+        write_artefact(self.get_result_table(), fpath)
+
+    def write_history(self, historyDir, runDate=None):
+        """ Appends the result table (get_result_table) to the run history, partitioned by run date
+        and freq (historyModules.py). See historyModules.read_history to read the history of
+        some organisations across the runs.
+
+        :param historyDir: str
+        :param runDate: str, optional
+            "YYYY-MM-DD", today by default
+        :return: path of the written file
+        """
+        return write_run(self.get_result_table(), historyDir, self.freq, runDate=runDate)
+
+    def fit_transform(self, DFs, fileList=None, start=None, end=None, organisations=None):
         """ Performes fit and transform provided by the TimeSeriesAnalysis class.
         :param DFs: list of dataframes
             combined time series.
         :fileList: list of str, optional
+        :start, end, organisations: optional selection (see fit)
         :return: dataframe
         """
-        self.fit(DFs, fileList)
+        self.fit(DFs, fileList, start=start, end=end, organisations=organisations)
         return self.transform()
 
 
@@ -213,11 +682,138 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
         The tendency dataframe
         """
 
-        df_c = self.stackDFs()
-        statTable = self.compute_stat(df_c, groupKey=self.groupKey, targetCol=self.targetCol,
+        return self.tendance_table(self.stackDFs(codes=True))
+
+    def tendance_table(self, df_c):
+        """ Tendency table (statistical indicators, periodicity and fit) of stacked time series.
+
+        :param df_c: dataframe
+            stacked binned dataframes keyed by codes
+        :return: dataframe keyed by names
+        """
+        if self.resultCache is not None:
+            statTable, df_fit = self.cached_stat_fit(df_c)
+        else:
+            statTable = self.compute_stat(df_c, groupKey=self.groupKey, targetCol=self.targetCol,
+                                          intp=self.intp, numBins=self.numBins)
+            df_fit = self.compute_fit(df_c, self.freq, simpFit=self.simpFit, fitMode=self.fitMode)
+        statTable = self.add_periodicity(self.restore_names(statTable), df_c)
+        df_fit = self.restore_names(df_fit, sortKey=None)
+        return statTable.merge(df_fit, on="organName").sort_values("mean", ascending=False)
+
+    def restore_names(self, df, sortKey="mean"):
+        """ Restores the names of a table computed on the codes (see organDict), with the row order
+        of the computations on the names : sorted by name, then by decreasing sortKey (compute_stat).
+
+        :param df: dataframe
+        :param sortKey: str, optional
+        :return: dataframe
+        """
+        df = decode_names(df, self.organDict, self.groupKey) \
+            .sort_values(self.groupKey, kind="mergesort").reset_index(drop=True)
+        return df if sortKey is None else df.sort_values(sortKey, ascending=False)
+
+    def cached_stat_fit(self, df_c):
+        """ Stat table and fit rows of the time series, computed for the organisations missing
+        from the result cache only (see cacheFile). Same tables as compute_stat and compute_fit.
+        The cached rows are keyed by the names, the codes depend on the organisations seen before.
+
+        :param df_c: dataframe
+            stacked binned dataframes (names or codes)
+        :return: stat table and fit dataframe, keyed by the names
+        """
+        params = {"freq": self.freq, "intp": self.intp, "simpFit": self.simpFit, "fitMode": self.fitMode,
+                  "medSeuil": self.medSeuil, "accelerate": bool(self.accelerate),
+                  "arrow": getattr(self, "_backend", None) is not None}
+        keys = series_keys(df_c, params, groupKey=self.groupKey, targetCol=self.targetCol, numBins=self.numBins,
+                           organDict=self.organDict)
+        found = self.resultCache.get_many(keys.values)
+        if not any(stat is not None for stat, _ in found.values()):
+            # the columns of the tables are taken from the computed rows
+            found = {}
+        missing = keys.index[~keys.isin(found)]
+        self.cacheStats = {"hits": len(keys) - len(missing), "computed": len(missing)}
+        print("TimeSeriesAnalysis : cached_stat_fit :", self.cacheStats["hits"], "cached organisations,",
+              len(missing), "to compute.")
+
+        statRows, fitRows = [], []
+        if len(missing):
+            df_missing = df_c[df_c[self.groupKey].isin(missing)]
+            statTable = self.compute_stat(df_missing, groupKey=self.groupKey, targetCol=self.targetCol,
+                                          intp=self.intp, numBins=self.numBins)
+            df_fit = self.compute_fit(df_missing, self.freq, simpFit=self.simpFit, fitMode=self.fitMode)
+            stats = dict(zip(statTable[self.groupKey],
+                             decode_names(statTable, self.organDict, self.groupKey).to_dict("records")))
+            fits = dict(zip(df_fit["organName"], decode_names(df_fit, self.organDict).to_dict("records")))
+            computed = {keys[name]: (stats.get(name), fits.get(name)) for name in missing}
+            self.resultCache.put_many(computed)
+            found.update(computed)
+
+        for stat, fit in (found[key] for key in keys.values):
+            if stat is not None:
+                statRows.append(stat)
+            if fit is not None:
+                fitRows.append(fit)
+        # row order of compute_stat : sorted by name, then by decreasing mean
+        statTable = pd.DataFrame(statRows).sort_values(self.groupKey, kind="mergesort").reset_index(drop=True) \
+            .sort_values("mean", ascending=False)
+        df_fit = pd.DataFrame(fitRows).sort_values("organName", kind="mergesort").reset_index(drop=True)
+        return statTable, df_fit
+
+    def compute_source_tendance_DFs(self):
+        """ Computes the tendencies of each source (data file) and of all the sources together.
+        The time series of all the sources are keyed by the integer sourceIndex * len(organDict) + code,
+        so the statistical indicators and the fits of every source are computed in one pass.
+        (statModules.py, tendanceModules.py)
+
+        return
+        ------
+        dict source -> tendency dataframe, "all" for the combined sources
+        """
+        sources = list(self._fileList)
+        df_c = self.stackDFs(sources=sources, codes=True)
+        print("TimeSeriesAnalysis : compute_source_tendance_DFs :", len(sources), "sources and their union.")
+        source_tendance = {"all": self.tendance_table(df_c.drop(columns=["source", "sourceNumBins"]))}
+
+        nCodes = len(self.organDict)
+        sourceIndex = pd.Categorical(df_c["source"], categories=sources).codes.astype(np.int64)
+        df_keyed = df_c.drop(columns=["source", "numBins"]).rename(columns={"sourceNumBins": "numBins"})
+        df_keyed[self.groupKey] = sourceIndex * nCodes + df_keyed[self.groupKey].values
+        df_keyed = df_keyed.sort_values([self.groupKey, "date"], kind="mergesort")
+
+        statTable = self.compute_stat(df_keyed, groupKey=self.groupKey, targetCol=self.targetCol,
                                       intp=self.intp, numBins=self.numBins)
-        df_tendance = self.compute_tendance(df_c, statTable, freq=self.freq, simpFit=self.simpFit)
-        return df_tendance
+        if self.periodicity:
+            # the FFT length depends on the time range : one pass per source, as on the source alone
+            keys = df_keyed[self.groupKey].values // nCodes
+            df_period = pd.concat([self.compute_periodicity(df_keyed[keys == i], freq=self.freq,
+                                                            groupKey=self.groupKey, targetCol=self.targetCol)
+                                   for i in range(len(sources))], ignore_index=True)
+            statTable = statTable.join(df_period.set_index(self.groupKey), on=self.groupKey)
+        df_fit = self.compute_fit(df_keyed, self.freq, simpFit=self.simpFit, fitMode=self.fitMode)
+
+        def source_rows(df, i):
+            key = df[self.groupKey].values
+            rows = key // nCodes == i
+            return df[rows].assign(**{self.groupKey: (key[rows] % nCodes).astype(np.int32)})
+
+        for i, source in enumerate(sources):
+            # same row order as compute_tendance_DFs on the source alone
+            stat = self.restore_names(source_rows(statTable, i))
+            fit = self.restore_names(source_rows(df_fit, i), sortKey=None)
+            source_tendance[source] = stat.merge(fit, on="organName").sort_values("mean", ascending=False)
+        return source_tendance
+
+    def get_source_comparison(self, columns=("mean_citation", "slope", "tendency", "p_0")):
+        """ Cross-source comparison table (perSource=True).
+
+        :param columns: columns of source_info to compare
+        :return: dataframe with one row per organisation and one column per (column, source)
+        """
+        df = self.source_info.pivot(index="organName", columns="source", values=list(columns))
+        sources = ["all"] + [src for src in df.columns.get_level_values(1).unique() if src != "all"]
+        df = df.reindex(columns=pd.MultiIndex.from_product([list(columns), sources]))
+        return df.loc[self._fit_info["organName"][self._fit_info["organName"].isin(df.index)]]
 
     def compute_stat_DFs(self) :
         """ Computes the statistical indicators of the time series extracted from input dataframes.
@@ -227,10 +823,37 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
         ------
         Table of statistics including the variability parameter sigmasRatio.
         """
-        df_c = self.stackDFs()
-        statTable = self.compute_stat(df_c, groupKey=self.groupKey, targetCol=self.targetCol,
-                                      intp=self.intp, numBins=self.numBins)
-        return statTable
+        df_c = self.stackDFs(codes=True)
+        if self.resultCache is not None:
+            statTable = self.cached_stat_fit(df_c)[0]
+        else:
+            statTable = self.compute_stat(df_c, groupKey=self.groupKey, targetCol=self.targetCol,
+                                          intp=self.intp, numBins=self.numBins)
+        return self.add_periodicity(self.restore_names(statTable), df_c)
+
+    def add_periodicity(self, statTable, df_c):
+        """ Adds the periodicity columns to the stat table if periodicity is set.
+        :param statTable: dataframe
+        :param df_c: dataframe
+            stacked binned dataframes
+        :return: dataframe
+        """
+        if not self.periodicity:
+            return statTable
+        df_period = decode_names(self.compute_periodicity(df_c, freq=self.freq, groupKey=self.groupKey,
+                                                          targetCol=self.targetCol), self.organDict, self.groupKey)
+        return statTable.join(df_period.set_index(self.groupKey), on=self.groupKey)
+
+    def compute_periodicity_DFs(self):
+        """ Computes the autocorrelation and the dominant period of the time series.
+            (statModules.py)
+
+        return
+        ------
+        Dataframe of periodicity indicators per organisation
+        """
+        return self.compute_periodicity(self.stackDFs(), freq=self.freq, groupKey=self.groupKey,
+                                        targetCol=self.targetCol)
 
 
     def get_df(self, DFs):
@@ -243,17 +866,23 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
         return self.stackDFs()
 
 
-    def stackDFs(self):
+    def stackDFs(self, sources=None, codes=False):
         """ Stack the binned input dataframes. (dataBinModules.py)
+        :param sources: list of str, optional
+            source names of the dataframes, kept in a source column.
+        :param codes: boolean
+            True to keep the organisations keyed by their codes (organDict), False to restore the names.
         return
         ------
-        The stacked dataframe
+        The stacked dataframe, sorted by organName and date
         """
         # Filtering the binned dataframes with number of bins > minNumBins
         c_dfs = self.extract_cleand_binned_DFs
         # Concating all binned dataframes
-        df_c = stack_c_DFs(c_dfs, memSeuil=self.memSeuil)
-        return df_c
+        df_c = stack_c_DFs(c_dfs, memSeuil=self.memSeuil, sources=sources)
+        if codes:
+            return df_c
+        return decode_names(df_c, self.organDict, self.groupKey, sort=True)
 
 
     def constrained_tendance_DFs(self):
@@ -267,6 +896,46 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
         df_tendance = self.compute_tendance_DFs()
         return constrained_tendance(df_tendance, noiseRatio=self.noiseRatio, minNumBins=self.minNumBins)
 
+    def bootstrap_tendance_DFs(self, nBoot=1000, mode="bins", alpha=.05, seed=None):
+        """ Computes the bootstrap confidence intervals of the slopes and p_0.
+        (tendanceModules.py)
+
+        return
+        ------
+        The tendency dataframe including the percentile intervals
+        """
+        df_tendance = self.compute_tendance_DFs()
+        df_boot = self.compute_bootstrap_tendance(self.stackDFs(), freq=self.freq, simpFit=self.simpFit,
+                                                  nBoot=nBoot, mode=mode, alpha=alpha, seed=seed)
+        return df_tendance.merge(df_boot, on="organName")
+
+    def rolling_tendance_DFs(self, window=6):
+        """ Computes the tendency of the time series and their rolling tendency over the last
+        `window` bins. (tendanceModules.py)
+
+        return
+        ------
+        The tendency dataframe and the rolling tendency dataframe (one row per organisation and
+        window end date)
+        """
+        df_tendance = self.compute_tendance_DFs()
+        df_rolling = self.compute_rolling_tendance(self.stackDFs(), freq=self.freq, window=window,
+                                                   simpFit=self.simpFit, intp=self.intp)
+        return df_tendance, df_rolling
+
+    def forecast_DFs(self, horizon=1, model="linear", level=.95, **kwargs):
+        """ Forecasts of the next horizon bins of all the organisations with prediction intervals.
+        (tendanceModules.py)
+
+        :param model: "linear", "ses" or "holt"
+        :param kwargs: alpha, beta, maxElements (see Tendance.compute_forecast)
+        return
+        ------
+        Dataframe with one row per organisation and forecast bin
+        """
+        return self.compute_forecast(self.stackDFs(), self.freq, horizon=horizon, model=model, level=level,
+                                     simpFit=self.simpFit, **kwargs)
+
     def compute_schock_list_DFs(self):
         """ Computes the list of organisation containing outliers (shocks) with respect to medSeuil
             (statModules.py)
@@ -278,6 +947,61 @@ class TimeSeriesAnalysis( BinnedOrganisations, StatIndic, Tendance ):
         statTable = self.compute_stat_DFs()
         return self.compute_schock_list(statTable, self.medSeuil)
 
+    def compute_shock_events_DFs(self, halfWindow=3, zSeuil=5.):
+        """ Localises the shocks in time with robust rolling z-scores (statModules.py)
+
+        return
+        ------
+        Dataframe of shock events (organName, date, binCount, median, score) sorted by date
+        """
+        return self.compute_shock_events(self.stackDFs(), halfWindow=halfWindow, zSeuil=zSeuil,
+                                         freq=self.freq)
+
+    def compute_neighbours_DFs(self, topK=10, minCorr=None):
+        """ Computes the topK most correlated partners of each organisation (statModules.py)
+
+        return
+        ------
+        Dataframe of neighbours (organName, neighbour, corr, rank), see get_neighbours to query it
+        """
+        return self.compute_neighbours(self.stackDFs(), freq=self.freq, topK=topK, minCorr=minCorr,
+                                       groupKey=self.groupKey, targetCol=self.targetCol)
+
+    def render_report(self, outDir, lists=("leaders", "mostVar", "constrained"), formats=("png",),
+                      maxWorkers=None, halfWindow=3, zSeuil=5.):
+        """ Renders the plots (binned counts, fitted tendency line and shock events) of the
+            organisations of the selected lists and writes an index page (reportModules.py)
+
+        Parameters
+        ----------
+        outDir : str
+            Output directory of the plots and of index.html
+        lists : list of str or dict
+            Names of the lists to plot among ("leaders", "mostVar", "shocks", "constrained"),
+            or {title: list of organisation names}
+        formats : list of str
+            "png" and/or "svg"
+        maxWorkers : int, optional
+            Number of rendering processes, the number of CPUs by default
+        halfWindow, zSeuil :
+            Shock events parameters (compute_shock_events)
+
+        return
+        ------
+        Path of the index page
+        """
+        from bb8TSA.TSA.reportModules import plot_payloads, render_plots, report_lists, write_index
+
+        lists = report_lists(self, lists)
+        organNames = list(dict.fromkeys(name for names in lists.values() for name in names))
+        df_c = self.stackDFs()
+        payloads = plot_payloads(df_c, self._df_tendance, self.compute_shock_events(df_c, halfWindow=halfWindow,
+                                                                                    zSeuil=zSeuil, freq=self.freq),
+                                 organNames, self.freq, simpFit=self.simpFit, fitMode=self.fitMode)
+        rendered = render_plots(payloads, outDir, formats=formats, maxWorkers=maxWorkers)
+        fit_info = self._fit_info.merge(self.tendance_info[["organName", "slope", "slopeErr"]], on="organName")
+        return write_index(outDir, lists, rendered, fit_info)
+
     def get_most_var_list_DFs(self):
         """ Computes the list of organisation containing most variations in time
             (statModules.py)
@@ -27,10 +27,9 @@ if __name__=="__main__" :
     #file_list = ["C:/Users/M77100/Work/bpi-fr-data-sc-bb8-ts-analysis/test2.parquet"]
     # Normalising the input datasets
     # Making an instance of file_normalisation
-    fn = FileNormalisation( file_list )
-    dfs = fn.get_initial_DFs()
-    normal_dfs = fn.get_Normal_DFs()
-    normalR_dfs = fn.get_NormalReduced_DFs()
+    # The files are read in background threads, two files ahead of the binning
+    fn = FileNormalisation( file_list, prefetch=2 )
+    normalR_dfs = fn.iter_Normal_DFs(reduced=True)
 
     tsa =TimeSeriesAnalysis( noiseRatio=.5, countFlag=True, countCol="count" )
 #    tsa.fit(normalR_dfs, fileList=file_list)
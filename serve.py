@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Serves a result snapshot written by TimeSeriesAnalysis.write_snapshot.
+
+usage : python serve.py results.arrow --port 8080
+        python serve.py results.arrow --unix /tmp/bb8TSA.sock
+"""
+
+import argparse
+import asyncio
+
+from bb8TSA.TSA.serveModules import ResultServer
+
+if __name__=="__main__" :
+
+    parser = argparse.ArgumentParser(description="Query server over a fitted result snapshot.")
+    parser.add_argument("snapshot", help="snapshot file (TimeSeriesAnalysis.write_snapshot)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix", default=None, help="Unix socket path (instead of TCP)")
+    parser.add_argument("--poll", type=float, default=1., help="seconds between snapshot checks")
+    args = parser.parse_args()
+
+    server = ResultServer( args.snapshot, host=args.host, port=args.port, unixSocket=args.unix,
+                           pollInterval=args.poll )
+    try :
+        asyncio.run( server.serve_forever() )
+    except KeyboardInterrupt :
+        print( "serve : stopped." )
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweep over the time series analysis.
+
+usage : python sweep.py file1.parquet file2.parquet --grid freq=M,W --grid medSeuil=10,20 --out sweep.csv
+"""
+
+import argparse
+import pandas as pd
+from time import time
+
+from bb8TSA.FilesPrepration.filesPrepModules import extract_file_list, FileNormalisation
+from bb8TSA.TSA.sweepModules import ParameterSweep, parse_grid, paramTypes
+
+pd.set_option('display.max_rows', 1000)
+pd.set_option('display.max_columns', 20)
+
+t0 = time()
+if __name__=="__main__" :
+
+    parser = argparse.ArgumentParser(description="Parameter sweep over the time series analysis.")
+    parser.add_argument("files", nargs="+", help="input parquet files")
+    parser.add_argument("--grid", action="append", default=[],
+                        help="param=value1,value2,... with param in {}".format(list(paramTypes)))
+    parser.add_argument("--out", default=None, help="output table (.csv or .parquet)")
+    args = parser.parse_args()
+
+    # Verifying the availability of the input files
+    file_list = extract_file_list( args.files )
+    fn = FileNormalisation( file_list, prefetch=2 )
+
+    ps = ParameterSweep( parse_grid(args.grid), noiseRatio=.5, countFlag=True, countCol="count" )
+    df_sweep = ps.fit_transform( fn.iter_Normal_DFs(reduced=True) )
+
+    if args.out is None :
+        print( "sweep : results : \n", df_sweep[:30] )
+    elif args.out.endswith(".parquet") :
+        df_sweep.to_parquet( args.out )
+    else :
+        df_sweep.to_csv( args.out, index=False )
+
+    print( "Time elapsed : ", round( time()-t0, 1 ), "s" )
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Import time benchmark : cold start cost of the command line scripts and of the pool workers,
+measured with python -X importtime in fresh interpreters.
+
+usage : python test/importtime.py [--repeat 5] [--top 8] [--max-ms 1000]
+"""
+import argparse
+import subprocess
+import sys
+from os import path
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+
+# Imports done by each entry point before it starts working
+targets = {"main.py": "import bb8TSA.FilesPrepration.filesPrepModules, bb8TSA.TSA.tsaModules",
+           "sweep.py": "import bb8TSA.FilesPrepration.filesPrepModules, bb8TSA.TSA.sweepModules",
+           "serve.py": "import bb8TSA.TSA.serveModules",
+           "worker": "import multiprocessing.spawn, bb8TSA.TSA.panelModules"}
+
+# Packages which should not be imported before the code using them runs
+deferred = ["matplotlib", "scipy", "pyarrow"]
+
+
+def import_times(code):
+    """ Runs code in a fresh interpreter with -X importtime.
+    :return: dict module -> (self time, cumulative time) in ms, and the list of the top level modules
+    """
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=root,
+                         stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True,
+                         universal_newlines=True).stderr
+    times, topLevel = {}, []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        selfTime, cumTime, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(selfTime) * 1.e-3, int(cumTime) * 1.e-3)
+        if not name.startswith("  "):
+            topLevel.append(name.strip())
+    return times, topLevel
+
+
+def benchmark(code, repeat=5):
+    """
+    :return: (best total import time in ms, import times of the best run, its top level modules)
+    """
+    best = None
+    for _ in range(repeat):
+        times, topLevel = import_times(code)
+        total = sum(times[name][1] for name in topLevel)
+        if best is None or total < best[0]:
+            best = (total, times, topLevel)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time benchmark of the entry points.")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per entry point (the best one is kept)")
+    parser.add_argument("--top", type=int, default=8, help="number of the slowest imports shown")
+    parser.add_argument("--max-ms", type=float, default=None, help="fails if an entry point takes longer")
+    args = parser.parse_args()
+
+    failed = False
+    for target, code in targets.items():
+        total, times, topLevel = benchmark(code, args.repeat)
+        print("{:10s} {:8.1f} ms".format(target, total))
+        # self times summed per package
+        packages = {}
+        for name, (selfTime, _) in times.items():
+            packages[name.split(".")[0]] = packages.get(name.split(".")[0], 0.) + selfTime
+        for name in sorted(packages, key=lambda name: -packages[name])[:args.top]:
+            print("    {:20s} {:8.1f} ms".format(name, packages[name]))
+
+        loaded = sorted(set(packages) & set(deferred))
+        if loaded:
+            print("    Warning : imported at start up :", loaded)
+            failed = True
+        if args.max_ms is not None and total > args.max_ms:
+            print("    Error : more than", args.max_ms, "ms")
+            failed = True
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the accelerated kernels (kernelModules) against the reference implementation :
+stat table and least squares fits of a synthetic panel of binned time series.
+
+usage : python test/kernelbench.py [--orgs 2000] [--bins 24] [--freq M] [--repeat 3]
+"""
+import argparse
+import sys
+import time
+from os import path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from bb8TSA.TSA import kernelModules
+from bb8TSA.TSA.statModules import StatIndic
+from bb8TSA.TSA.tendanceModules import Tendance
+
+
+class Pipeline(StatIndic, Tendance):
+    def __init__(self, accelerate):
+        self.accelerate = accelerate
+        Tendance.__init__(self)
+
+
+def synthetic_panel(nOrgs, nBins, freq="M", seed=0):
+    """
+    :return: stacked binned dataframe (organName, date, binCount, numBins) with random gaps
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2019-01-01", periods=nBins, freq=freq).values
+    rate = rng.lognormal(3., 1., size=(nOrgs, 1)) * (1. + rng.normal(0., .02, size=(nOrgs, 1)) * np.arange(nBins))
+    counts = rng.poisson(np.clip(rate, 0., None))
+    org, b = np.nonzero((counts > 0) & (rng.random(counts.shape) > .1))
+    df = pd.DataFrame({"organName": np.char.add("org", org.astype(str)).astype(object),
+                       "date": dates[b], "binCount": counts[org, b]})
+    df["numBins"] = df.groupby("organName")["binCount"].transform("count")
+    return df[df["numBins"] > 5].reset_index(drop=True)
+
+
+def timed(fun, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fun()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accelerated kernels benchmark.")
+    parser.add_argument("--orgs", type=int, default=2000, help="number of organisations")
+    parser.add_argument("--bins", type=int, default=24, help="number of bins per organisation")
+    parser.add_argument("--freq", default="M")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage (the best one is kept)")
+    args = parser.parse_args()
+
+    df_c = synthetic_panel(args.orgs, args.bins, args.freq)
+    gt = {"groupKey": "organName", "targetCol": "binCount"}
+    stages = {"compute_stat": lambda p: p.compute_stat(df_c, intp=True, **gt),
+              "simple fit": lambda p: p.compute_fit(df_c, args.freq, simpFit=True),
+              "weighted fit": lambda p: p.compute_fit(df_c, args.freq, simpFit=False)}
+
+    # compilation (numba) before timing
+    kernelModules.fit_table(df_c.head(100), args.freq)
+    kernelModules.stat_table(df_c.head(100))
+
+    results = []
+    for name, stage in stages.items():
+        tRef, ref = timed(lambda: stage(Pipeline(False)), args.repeat)
+        tKernel, res = timed(lambda: stage(Pipeline(True)), args.repeat)
+        diff = np.nanmax(np.abs(ref.iloc[:, 1:].values.astype(float) - res.iloc[:, 1:].values.astype(float)))
+        results.append((name, tRef, tKernel, diff))
+
+    print("\nKernels :", kernelModules.KERNELS, ",", len(df_c), "bins of", df_c["organName"].nunique(), "organisations")
+    print("{:14s} {:>12s} {:>12s} {:>8s} {:>10s}".format("stage", "reference s", "kernels s", "speedup", "max diff"))
+    for name, tRef, tKernel, diff in results:
+        print("{:14s} {:12.3f} {:12.3f} {:8.1f} {:10.3g}".format(name, tRef, tKernel, tRef / tKernel, diff))
@@ -1,4 +1,16 @@
+import asyncio
+import tempfile
+from os import path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
 from bb8TSA.TSA.tsaModules import TimeSeriesAnalysis
+from bb8TSA.TSA.organModules import OrganDictionary
+from bb8TSA.TSA.serveModules import ResultServer, query
+from bb8TSA.TSA.sweepModules import ParameterSweep
+from bb8TSA.FilesPrepration.filesPrepModules import FileNormalisation
 
 def some_tests( DFs, fileList ) :
     tsa =TimeSeriesAnalysis( countFlag=True, countCol="count" )
@@ -6,3 +18,435 @@ def some_tests( DFs, fileList ) :
     assert(tsa.get_leader_list_DFs()[:3] == ['ue', 'covid19', 'oms'])
     assert(tsa.get_most_var_list_DFs()[:4] == ['granddébatnational', 'granddébat', 'oms', 'pge'])
     assert(tsa.compute_schock_list_DFs()[:4] == ['ab', 'charliehebdo', 'pge', 'cheminots'])
+
+def server_tests( DFs, fileList ) :
+    tsa =TimeSeriesAnalysis( countFlag=True, countCol="count" )
+    tsa.fit(DFs, fileList)
+    snapshot = path.join( tempfile.mkdtemp(), "results.arrow" )
+    tsa.write_snapshot(snapshot)
+
+    async def run() :
+        server = ResultServer( snapshot, port=0 )
+        await server.start()
+        assert(await query("/leaders?n=3", port=server.port) == (200, ['ue', 'covid19', 'oms']))
+        status, row = await query("/organisation/covid19", port=server.port)
+        assert(status == 200 and row["tendency"] == "Increase")
+        assert((await query("/organisation/nobody", port=server.port))[0] == 404)
+        # a failing query gets a 500 answer, the server keeps serving
+        server.snapshot.leaders = lambda n : {}["leaders"]
+        assert(await query("/leaders?n=3", port=server.port) == (500, {"error": "internal error"}))
+        assert((await query("/status", port=server.port))[0] == 200)
+        await server.close()
+    asyncio.run(run())
+
+def backend_tests( DFs, fileList ) :
+    # the arrow backend reads and normalises the files itself
+    arrow_DFs = FileNormalisation( fileList, backend="arrow" ).get_NormalReduced_DFs()
+    for freq in ["M", "W"] :
+        for intp in [True, False] :
+            tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", freq=freq, intp=intp )
+            tsaArrow = TimeSeriesAnalysis( countFlag=True, countCol="count", freq=freq, intp=intp, backend="arrow" )
+            df_info = tsa.fit_transform( DFs, fileList ).reset_index(drop=True)
+            df_arrow = tsaArrow.fit_transform( arrow_DFs, fileList ).reset_index(drop=True)
+            assert(df_info.equals(df_arrow))
+            for df, df_a in zip(tsa.extract_cleand_binned_DFs, tsaArrow.extract_cleand_binned_DFs) :
+                assert(df.reset_index(drop=True).equals(df_a))
+            assert(tsa.compute_stat_DFs().equals(tsaArrow.compute_stat_DFs()))
+
+def kernel_tests( DFs, fileList ) :
+    # accelerated kernels against the reference implementation (rounding boundaries aside)
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count" )
+    tsa.fit( DFs, fileList )
+    df_c = tsa.stackDFs()
+    for intp in [True, False] :
+        tsa.accelerate = False
+        statTable = tsa.compute_stat( df_c, intp=intp, groupKey="organName", targetCol="binCount" )
+        tsa.accelerate = True
+        assert(statTable.equals(tsa.compute_stat( df_c, intp=intp, groupKey="organName", targetCol="binCount" )))
+    for simpFit in [True, False] :
+        tsa.accelerate = False
+        df_fit = tsa.compute_fit( df_c, tsa.freq, simpFit=simpFit )
+        tsa.accelerate = True
+        df_kernel = tsa.compute_fit( df_c, tsa.freq, simpFit=simpFit )
+        assert(list(df_fit.columns) == list(df_kernel.columns))
+        assert((df_fit["organName"] == df_kernel["organName"]).all())
+        assert(np.allclose(df_fit.iloc[:, 1:].values.astype(float), df_kernel.iloc[:, 1:].values.astype(float),
+                           atol=.11, equal_nan=True))
+
+def cache_tests( DFs, fileList ) :
+    # an organisation absent from the first run changes the codes of the others, not their cache keys
+    cacheFile = path.join( tempfile.mkdtemp(), "results.sqlite" )
+    df_info = TimeSeriesAnalysis( countFlag=True, countCol="count" ).fit_transform( DFs, fileList )
+    first = sorted(set(DFs[0]["organName"]) | set(DFs[1]["organName"]))[0]
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", cacheFile=cacheFile )
+    tsa.fit_transform( [df[df["organName"] != first] for df in DFs], fileList )
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", cacheFile=cacheFile )
+    df_cached = tsa.fit_transform( DFs, fileList )
+    assert(tsa.cacheStats["computed"] == 1 and tsa.cacheStats["hits"] == len(df_info) - 1)
+    assert(df_cached.reset_index(drop=True).equals(df_info.reset_index(drop=True)))
+
+def rolling_tests( DFs, fileList ) :
+    # rolling tendencies against the fit and the stat table of the sliced windows
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count" )
+    tsa.fit( DFs, fileList )
+    df_c = tsa.stackDFs()
+    window = 6
+    for simpFit in [True, False] :
+        for intp in [True, False] :
+            df_rolling = tsa.compute_rolling_tendance( df_c, tsa.freq, window=window, simpFit=simpFit, intp=intp )
+            for name in ['ue', 'covid19', 'oms'] :
+                df_organ = df_c[df_c["organName"] == name].sort_values("date")
+                rows = df_rolling[df_rolling["organName"] == name]
+                for end in [window - 1, (window + len(df_organ)) // 2 - 1, len(df_organ) - 1] :
+                    df_window = df_organ.iloc[end - window + 1:end + 1]
+                    row = rows[rows["date"] == df_window["date"].values[-1]].iloc[0]
+                    df_fit = tsa.compute_fit( df_window, tsa.freq, simpFit=simpFit )
+                    statTable = tsa.compute_stat( df_window, intp=intp, groupKey="organName", targetCol="binCount" )
+                    assert(abs(row["slope"] - df_fit["slope"].values[0]) < .11)
+                    assert(abs(row["slopeErr"] - df_fit["slopeErr"].values[0]) < .11)
+                    assert(abs(row["sigma"] - statTable["sigma"].values[0]) <= .5)
+                    assert(abs(row["sigmasRatio"] - statTable["sigmasRatio"].values[0]) < .051)
+
+def huber_tests( DFs, fileList ) :
+    # a count shoot in the last bin does not flip the robust tendencies
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count" )
+    tsa.fit( DFs, fileList )
+    df_c = tsa.stackDFs()
+    last = df_c["date"] == df_c.groupby("organName")["date"].transform("max")
+    df_shoot = df_c.copy()
+    df_shoot.loc[last, "binCount"] = 10 * df_c.groupby("organName")["binCount"].transform("max")[last]
+    # series with most of their bins on a line : zero median absolute residual
+    df_ue = df_c[df_c["organName"] == "ue"]
+    x = np.arange(len(df_ue))
+    for name, y in [("flat", 100. + 0. * x), ("line", 100. + 5. * x)] :
+        y[-1] = 5000.
+        df_shoot = pd.concat([df_shoot, df_ue.assign(organName=name, binCount=y)], ignore_index=True)
+    numBins = df_c.groupby("organName")["date"].count()
+    for simpFit in [True, False] :
+        df_fit = tsa.compute_fit( df_c, tsa.freq, simpFit=simpFit, fitMode="huber" ).set_index("organName")
+        df_ls = tsa.compute_fit( df_shoot, tsa.freq, simpFit=simpFit ).set_index("organName")
+        df_huber = tsa.compute_fit( df_shoot, tsa.freq, simpFit=simpFit, fitMode="huber" ).set_index("organName")
+        # significant robust tendencies (see p_0)
+        names = df_fit.index[(abs(df_fit["slope"]) > 2 * df_fit["slopeErr"]) & (numBins.reindex(df_fit.index) >= 12)]
+        assert(len(names) > 0)
+        assert((np.sign(df_huber.loc[names, "slope"]) == np.sign(df_fit.loc[names, "slope"])).all())
+        assert(abs(df_ls.loc["flat", "slope"]) > 45)
+        assert(abs(df_huber.loc["flat", "slope"]) < 5)
+        assert(abs(df_huber.loc["line", "slope"] - np.degrees(np.arctan(5.))) < .5)
+        # only the shoot is down weighted, the slope errors are not zero
+        assert((df_huber.loc[["flat", "line"], "downWeighted"] == 1).all())
+        assert((df_huber.loc[["flat", "line"], "slopeErr"] > 0).all())
+
+def resume_tests( DFs, fileList ) :
+    # analyses resumed from the artefacts of a run with the same parameters only
+    artefactDir = tempfile.mkdtemp()
+    df_info = TimeSeriesAnalysis( countFlag=True, countCol="count", artefactDir=artefactDir ) \
+        .fit_transform( DFs, fileList ).reset_index(drop=True)
+    # a windowed fit writes other artefacts
+    TimeSeriesAnalysis( countFlag=True, countCol="count", artefactDir=artefactDir ) \
+        .fit( DFs, fileList, start="2020-01-01", end="2020-06-30" )
+    for stage in ["binned", "clean"] :
+        tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", artefactDir=artefactDir )
+        tsa.resume( fileList, stage=stage )
+        assert(tsa.transform().reset_index(drop=True).equals(df_info))
+        for params in [{"countFlag": False}, {"countFlag": True, "countCol": "count", "freq": "W"}] :
+            tsa = TimeSeriesAnalysis( artefactDir=artefactDir, **params )
+            try :
+                tsa.resume( fileList, stage=stage )
+                assert(False)
+            except ValueError :
+                pass
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", artefactDir=artefactDir )
+    tsa.resume( fileList, start="2020-01-01", end="2020-06-30" )
+    assert(len(tsa.transform()) < len(df_info))
+
+def pushdown_tests( DFs, fileList ) :
+    # windows and organisations pushed down to the scan against a selection at fit time
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count" )
+    tsa.fit( DFs, fileList )
+    organisations = tsa.get_leader_list_DFs()[:30]
+    # the first window excludes the 2019 file
+    selections = [("2020-01-01", "2020-12-31", None), ("2019-03-01", "2020-06-30", organisations)]
+    for backend in ["pandas", "arrow"] :
+        full_DFs = FileNormalisation( fileList, backend=backend ).get_NormalReduced_DFs()
+        for start, end, organs in selections :
+            df_info = TimeSeriesAnalysis( countFlag=True, countCol="count", backend=backend ) \
+                .fit_transform( full_DFs, fileList, start=start, end=end, organisations=organs )
+            read_DFs = FileNormalisation( fileList, backend=backend, start=start, end=end,
+                                          organisations=organs ).get_NormalReduced_DFs()
+            df_read = TimeSeriesAnalysis( countFlag=True, countCol="count", backend=backend ) \
+                .fit_transform( read_DFs, fileList )
+            assert(len(df_info) > 0 and df_read.reset_index(drop=True).equals(df_info.reset_index(drop=True)))
+
+def sample_tests( DFs, fileList ) :
+    # quick-look mode : a full sample gives the exact results
+    df_info = TimeSeriesAnalysis( countFlag=True, countCol="count" ).fit_transform( DFs, fileList )
+    fn = FileNormalisation( fileList, sample=1. )
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", sampleFraction=fn.sampleFractions )
+    assert(tsa.fit_transform( fn.get_NormalReduced_DFs(), fileList ).equals(df_info))
+    assert(list(tsa.sample_info.columns) == ["organName", "mean_citation", "mean_citationErr", "variability",
+                                             "variabilityAgree", "tendency", "tendencyAgree", "unstable"])
+    assert((tsa.sample_info["organName"].values == df_info["organName"].values).all())
+    # row groups sampled among those left by the date window (files sorted by date)
+    tmpDir = tempfile.mkdtemp()
+    files = [path.join( tmpDir, path.basename(file) ) for file in fileList]
+    for file, fpath in zip(fileList, files) :
+        pd.read_parquet( file ).sort_values("date").to_parquet( fpath, row_group_size=20000, index=False )
+    start, end = "2020-01-15", "2020-08-31"
+    for backend in ["pandas", "arrow"] :
+        read_DFs = FileNormalisation( files, backend=backend, start=start, end=end ).get_NormalReduced_DFs()
+        df_info = TimeSeriesAnalysis( countFlag=True, countCol="count", backend=backend ).fit_transform( read_DFs, files )
+        fn = FileNormalisation( files, backend=backend, start=start, end=end, sample=1., sampleMode="rowGroups" )
+        df_sample = TimeSeriesAnalysis( countFlag=True, countCol="count", backend=backend ) \
+            .fit_transform( fn.get_NormalReduced_DFs(), files )
+        assert(df_sample.equals(df_info))
+        fn = FileNormalisation( files, backend=backend, start=start, end=end, sample=.5, sampleMode="rowGroups" )
+        for df in fn.get_NormalReduced_DFs() :
+            dates = pd.Series(df["date"].to_pandas() if backend == "arrow" else df["date"])
+            assert(((dates >= start) & (dates <= end)).all())
+        # only the row groups whose date statistics overlap the window are sampled
+        meta = pq.ParquetFile( files[1] ).metadata
+        stats = [meta.row_group(i).column(meta.schema.names.index("date")).statistics for i in range(meta.num_row_groups)]
+        nGroups = sum(st.max >= start and st.min < "2020-09-01" for st in stats)
+        assert(nGroups < meta.num_row_groups)
+        assert(fn.sampleFractions[files[1]] == round(.5 * nGroups) / nGroups)
+
+def neighbours_tests( DFs, fileList ) :
+    # co-citation correlations against np.corrcoef of the zero-filled series, sparse and dense products
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count" )
+    tsa.fit( DFs, fileList )
+    df_c = tsa.stackDFs()
+    months = df_c["date"].dt.to_period("M")
+    X = df_c.pivot_table( index="organName", columns=months, values="binCount", aggfunc="sum", fill_value=0 )
+    X = X.reindex( columns=pd.period_range(months.min(), months.max(), freq="M"), fill_value=0 )
+    corr = pd.DataFrame( np.corrcoef(X.values), index=X.index, columns=X.index )
+    topK = 5
+    df_sparse = tsa.compute_neighbours( df_c, freq=tsa.freq, topK=topK, maxElements=1.e5, maxDensity=1.1 )
+    df_dense = tsa.compute_neighbours( df_c, freq=tsa.freq, topK=topK, maxDensity=0. )
+    assert(df_sparse.equals(df_dense))
+    ref = corr.values[X.index.get_indexer(df_dense["organName"]), X.index.get_indexer(df_dense["neighbour"])]
+    assert(np.allclose(df_dense["corr"].values, ref, atol=5.e-4, rtol=0.))
+    # the kept partners are the most correlated ones
+    np.fill_diagonal(corr.values, -np.inf)
+    best = -np.sort(-np.nan_to_num(corr.values, nan=-np.inf), axis=1)[:, :topK]
+    for name, df in df_dense.groupby("organName") :
+        expected = best[X.index.get_loc(name)]
+        expected = expected[np.isfinite(expected)]
+        assert(np.allclose(df["corr"].values, expected, atol=5.e-4, rtol=0.))
+
+def source_tests( DFs, fileList ) :
+    # per-source results against a plain fit of all the files and of each file alone
+    for params in [{}, {"fitMode": "huber"}, {"freq": "W", "intp": False, "periodicity": True}] :
+        tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", perSource=True, **params )
+        df_info = tsa.fit_transform( DFs, fileList )
+        assert(df_info.equals(TimeSeriesAnalysis( countFlag=True, countCol="count", **params ).fit_transform( DFs, fileList )))
+        for df, file in zip(DFs, fileList) :
+            tsaFile = TimeSeriesAnalysis( countFlag=True, countCol="count", **params )
+            tsaFile.fit( [df], [file] )
+            assert(tsa._source_tendance[file].reset_index(drop=True).equals(tsaFile._df_tendance.reset_index(drop=True)))
+            df_source = tsa.source_info[tsa.source_info["source"] == file].reset_index(drop=True)
+            assert(df_source.equals(tsaFile.classify_source( tsaFile._df_tendance, file )))
+
+def classify_tests( DFs, fileList ) :
+    # vectorised labels against the sequential assignments they replaced, boundary values included
+    from scipy.special import ndtr
+
+    def classify( fit_info, medSeuil ) :
+        fit_info = fit_info.copy()
+        shock_list = fit_info.loc[(fit_info["max"] / fit_info["median"]).replace(np.inf, np.nan) > medSeuil, "organName"]
+        fit_info["count_shoot"] = "No"
+        fit_info.loc[ fit_info["organName"].isin(shock_list), "count_shoot" ] = "Yes"
+        nbinR = (fit_info["numBins"]-1.)/fit_info["numBins"]
+        fit_info["variability"] = ""
+        fit_info.loc[fit_info["sigmasRatio"]<=1, "variability"]="Low"
+        fit_info.loc[fit_info["sigmasRatio"]<=nbinR, "variability"]="None"
+        fit_info.loc[fit_info["sigmasRatio"]>1, "variability"]="Moderate"
+        fit_info.loc[fit_info["sigmasRatio"]>=2, "variability"]="high"
+        fit_info["tendency"] = "Const"
+        fit_info.loc[fit_info["slope"]<-1.e-6, "tendency"] = "Decrease"
+        fit_info.loc[fit_info["slope"]>1.e-6, "tendency"] = "Increase"
+        return fit_info[["organName", "count_shoot", "variability", "tendency"]].reset_index(drop=True)
+
+    for params in [{}, {"simpFit": False}, {"fitMode": "huber"}, {"freq": "W", "medSeuil": 5.}] :
+        tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", **params )
+        tsa.fit( DFs, fileList )
+        df_edge = tsa._df_tendance.iloc[:6].copy()
+        df_edge["organName"] = ["edge" + str(i) for i in range(6)]
+        df_edge["sigmasRatio"] = [1., 2., (df_edge["numBins"].values[2]-1.)/df_edge["numBins"].values[2], .5, np.nan, 1.5]
+        df_edge["slope"] = [0., 1.e-6, -1.e-6, 1.e-7, 3., -3.]
+        df_edge["slopeErr"] = [np.nan, 1., 1., 1., 1., 1.]
+        df_edge["median"] = [0., 1., 2., 0., 1., 3.]
+        df_edge["max"] = [5., tsa.medSeuil, 2. * tsa.medSeuil + 1., 0., np.nan, 3.]
+        df_tendance = pd.concat([tsa._df_tendance, df_edge], ignore_index=True)
+        _, fit_info = tsa.classify_tendance( df_tendance )
+        labels = fit_info[["organName", "count_shoot", "variability", "tendency"]].astype(str)
+        assert(labels.equals(classify( df_tendance, tsa.medSeuil )))
+        # p_0 as computed row by row
+        p_0 = [round(ndtr(-s/e) if s > 0 else 1. - ndtr(-s/e), 2) for s, e in df_tendance[["slope", "slopeErr"]].values]
+        p_0 = np.where(np.abs(df_tendance["slope"]) < 1.e-6, 1., p_0)
+        assert(np.array_equal(fit_info["p_0"].values, p_0, equal_nan=True))
+
+def cached_tests( DFs, fileList ) :
+    # cold and warm cached runs give the tables of an uncached run, the parameters are part of the keys
+    cacheFile = path.join( tempfile.mkdtemp(), "results.sqlite" )
+    # the combined series of a per-source run are cached by the first run
+    for params, cold in [({}, False), ({"simpFit": True}, False), ({"fitMode": "huber"}, False),
+                         ({"freq": "W", "intp": False, "periodicity": True}, False), ({"accelerate": True}, False),
+                         ({"perSource": True}, True)] :
+        tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", **params )
+        df_info = tsa.fit_transform( DFs, fileList )
+        statTable = tsa.compute_stat_DFs()
+        for cached in [cold, True] :
+            tsaCached = TimeSeriesAnalysis( countFlag=True, countCol="count", cacheFile=cacheFile, **params )
+            assert(tsaCached.fit_transform( DFs, fileList ).equals(df_info))
+            assert(tsaCached.cacheStats["hits"] == (len(df_info) if cached else 0))
+            assert(tsaCached._df_tendance.equals(tsa._df_tendance))
+            assert(tsaCached.compute_stat_DFs().equals(statTable))
+            if params.get("perSource") :
+                assert(tsaCached.source_info.equals(tsa.source_info))
+
+def codes_tests( DFs, fileList ) :
+    # tables computed on the int32 codes against the computations on the names
+    arrow_DFs = FileNormalisation( fileList, backend="arrow" ).get_NormalReduced_DFs()
+    for backend, b_DFs in [("pandas", DFs), ("arrow", arrow_DFs)] :
+        tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", backend=backend )
+        df_info = tsa.fit_transform( b_DFs, fileList )
+        df_c = tsa.stackDFs()
+        assert(df_c["organName"].dtype == object)
+        statTable = tsa.compute_stat( df_c, groupKey="organName", targetCol="binCount", intp=tsa.intp )
+        df_fit = tsa.compute_fit( df_c, tsa.freq, simpFit=tsa.simpFit, fitMode=tsa.fitMode )
+        df_tendance = statTable.merge(df_fit, on="organName").sort_values("mean", ascending=False)
+        assert(tsa._df_tendance.reset_index(drop=True).equals(df_tendance.reset_index(drop=True)))
+        assert(tsa.compute_stat_DFs().reset_index(drop=True).equals(statTable.reset_index(drop=True)))
+        # a shared dictionary whose codes are not in the order of the names
+        organDict = OrganDictionary( ["zz"] + sorted(df_c["organName"].unique(), reverse=True) )
+        tsaShared = TimeSeriesAnalysis( countFlag=True, countCol="count", backend=backend, organDict=organDict )
+        assert(tsaShared.fit_transform( b_DFs, fileList ).equals(df_info))
+        assert(tsaShared.stackDFs().equals(df_c))
+        assert(tsaShared._df_tendance.equals(tsa._df_tendance))
+
+def sweep_tests( DFs, fileList ) :
+    # each combination of the sweep against a separate analysis with its parameters
+    grid = {"freq": ["M", "W"], "simpFit": [True, False], "medSeuil": [20., 5.]}
+    df_sweep = ParameterSweep( grid, countFlag=True, countCol="count" ).fit_transform( DFs, fileList )
+    assert(len(df_sweep.groupby(list(grid)).size()) == 8)
+    for freq in grid["freq"] :
+        for simpFit in grid["simpFit"] :
+            for medSeuil in grid["medSeuil"] :
+                tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", freq=freq, simpFit=simpFit, medSeuil=medSeuil )
+                df_info = tsa.fit_transform( DFs, fileList ).reset_index(drop=True)
+                df = df_sweep[(df_sweep["freq"] == freq) & (df_sweep["simpFit"] == simpFit) &
+                              (df_sweep["medSeuil"] == medSeuil)].reset_index(drop=True)
+                assert(df[df_info.columns].equals(df_info))
+                df_tendance = tsa.tendance_info.reset_index(drop=True)
+                assert(df["slope"].equals(df_tendance["slope"]) and df["slopeErr"].equals(df_tendance["slopeErr"]))
+                constrained = tsa.constrained_tendance_DFs()["organName"]
+                assert(df["constrained"].equals(df["organName"].isin(constrained)))
+                assert(df["most_variable"].equals(df["organName"].isin(tsa.get_most_var_list_DFs())))
+
+def bootstrap_tests( DFs, fileList ) :
+    # seeded bootstrap intervals contain the fitted slopes, and collapse on an exact line
+    for simpFit in [True, False] :
+        tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", simpFit=simpFit )
+        tsa.fit( DFs, fileList )
+        for mode in ["bins", "residuals"] :
+            df_boot = tsa.bootstrap_tendance_DFs( nBoot=500, mode=mode, seed=0 )
+            assert(len(df_boot) == len(tsa.transform()))
+            assert(((df_boot["slopeLow"] <= df_boot["slope"]) & (df_boot["slope"] <= df_boot["slopeHigh"])).all())
+            assert(((0. <= df_boot["p_0Low"]) & (df_boot["p_0Low"] <= df_boot["p_0High"]) & (df_boot["p_0High"] <= 1.)).all())
+            assert(df_boot.equals(tsa.bootstrap_tendance_DFs( nBoot=500, mode=mode, seed=0 )))
+    df_ue = tsa.stackDFs().query("organName == 'ue'")
+    df_line = df_ue.assign(organName="line", binCount=100. + 5. * np.arange(len(df_ue)))
+    df_boot = tsa.compute_bootstrap_tendance( df_line, tsa.freq, simpFit=True, nBoot=200, mode="residuals", seed=0 )
+    slope = tsa.compute_fit( df_line, tsa.freq, simpFit=True )["slope"].values[0]
+    assert((df_boot["slopeLow"] == slope).all() and (df_boot["slopeHigh"] == slope).all())
+    assert((df_boot["slopeBootErr"] == 0.).all())
+
+def events_tests( DFs, fileList ) :
+    # injected spikes are reported at their bins, the other organisations are not affected
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count" )
+    tsa.fit( DFs, fileList )
+    df_c = tsa.stackDFs()
+    df_events = tsa.compute_shock_events( df_c, freq=tsa.freq )
+    df_ue = df_c[df_c["organName"] == "ue"]
+    spike = df_ue.index[len(df_ue) // 2]
+    df_spike = df_c.copy()
+    df_spike.loc[spike, "binCount"] = 50 * df_ue["binCount"].max()
+    # a flat serie : median 100, scale sqrt(100)
+    df_flat = df_ue.assign(organName="flat", binCount=100.)
+    df_flat.loc[df_flat.index[10], "binCount"] = 1000.
+    df_spiked = tsa.compute_shock_events( pd.concat([df_spike, df_flat], ignore_index=True), freq=tsa.freq )
+    for df, reported in [(df_events, False), (df_spiked, True)] :
+        rows = df[df["organName"] == "ue"]
+        assert((rows["date"] == df_c.loc[spike, "date"]).any() == reported)
+    rows = df_spiked[df_spiked["organName"] == "flat"]
+    assert(len(rows) == 1 and rows["date"].values[0] == df_flat["date"].values[10])
+    assert(rows["median"].values[0] == 100. and rows["score"].values[0] == 90.)
+    others = ~df_spiked["organName"].isin(["ue", "flat"])
+    assert(df_spiked[others].reset_index(drop=True).equals(df_events[df_events["organName"] != "ue"].reset_index(drop=True)))
+
+def periodicity_tests( DFs, fileList ) :
+    # synthetic periodic series get their period, a trend alone is not periodic
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", freq="W", periodicity=True )
+    tsa.fit( DFs, fileList )
+    df_ue = tsa.stackDFs().query("organName == 'ue'")
+    t = np.arange(len(df_ue))
+    df_synth = pd.concat([df_ue.assign(organName="p" + str(period), binCount=100. + 2. * t + 50. * np.sin(2 * np.pi * t / period))
+                          for period in [4, 8, 16]] +
+                         [df_ue.assign(organName="trend", binCount=100. + 2. * t)], ignore_index=True)
+    df_period = tsa.compute_periodicity( df_synth, freq="W" ).set_index("organName")
+    for period in [4, 8, 16] :
+        row = df_period.loc["p" + str(period)]
+        # resolution of the frequency grid of the FFT
+        assert(abs(row["period"] - period) < .15 and abs(row["periodDays"] - 7 * period) <= 1. and row["periodic"])
+    assert(not df_period.loc["trend", "periodic"])
+    # the periodicity columns of the stat table
+    statTable = tsa.compute_stat_DFs()
+    assert({"acf1", "period", "periodDays", "periodPower", "periodAcf", "periodic"} <= set(statTable.columns))
+
+def forecast_tests( DFs, fileList ) :
+    # linear series on regular weekly bins are forecast exactly, with empty intervals
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count", freq="W" )
+    dates = pd.date_range("2020-01-05", periods=40, freq="7D")
+    lines = [("up", 100., 3.), ("down", 500., -4.), ("flat", 50., 0.)]
+    df_c = pd.concat([pd.DataFrame({"organName": name, "date": dates, "binCount": a + b * np.arange(40.), "numBins": 40})
+                      for name, a, b in lines], ignore_index=True)
+    for model, simpFit in [("linear", True), ("linear", False), ("holt", True)] :
+        df_forecast = tsa.compute_forecast( df_c, "W", horizon=3, model=model, simpFit=simpFit )
+        for name, a, b in lines :
+            rows = df_forecast[df_forecast["organName"] == name]
+            assert((rows["step"].values == [1, 2, 3]).all())
+            assert((rows["date"].values == (dates[-1] + pd.to_timedelta([7, 14, 21], unit="D")).values).all())
+            for col in ["forecast", "lower", "upper"] :
+                assert(np.allclose(rows[col].values, a + b * np.arange(40., 43.)))
+    # intervals around the forecasts of the fitted series
+    tsa = TimeSeriesAnalysis( countFlag=True, countCol="count" )
+    tsa.fit( DFs, fileList )
+    for model in ["linear", "ses", "holt"] :
+        df_forecast = tsa.forecast_DFs( horizon=2, model=model )
+        assert(len(df_forecast) == 2 * len(tsa.transform()))
+        assert(((df_forecast["lower"] <= df_forecast["forecast"]) & (df_forecast["forecast"] <= df_forecast["upper"])).all())
+
+def afit_tests( DFs, fileList ) :
+    # the coroutines give the results of fit_transform, with the progress of each stage
+    for start, end in [(None, None), ("2019-03-01", "2020-06-30")] :
+        df_info = TimeSeriesAnalysis( countFlag=True, countCol="count" ).fit_transform( DFs, fileList, start=start, end=end )
+        tsa = TimeSeriesAnalysis( countFlag=True, countCol="count" )
+        assert(asyncio.run(tsa.afit_transform( DFs, fileList, start=start, end=end )).equals(df_info))
+
+    async def sources() :
+        for df in DFs :
+            yield df
+
+    async def stages( tsa, DFs ) :
+        return [progress async for progress in tsa.afit_stages( DFs, fileList )]
+
+    df_info = TimeSeriesAnalysis( countFlag=True, countCol="count" ).fit_transform( DFs, fileList )
+    reads = FileNormalisation( fileList, prefetch=2 ).iter_Normal_DFs( reduced=True )
+    for b_DFs in [sources(), reads] :
+        tsa = TimeSeriesAnalysis( countFlag=True, countCol="count" )
+        progress = asyncio.run(stages( tsa, b_DFs ))
+        assert([(p["stage"], p["source"], p["step"], p["total"]) for p in progress] ==
+               [("binned", fileList[0], 1, 4), ("binned", fileList[1], 2, 4), ("tendance", None, 3, 4), ("classify", None, 4, 4)])
+        assert(tsa.transform().equals(df_info))
+